@@ -0,0 +1,106 @@
+"""
+Cache of remote Recurly resources, for read-only lookups.
+
+Two layers are available:
+
+- a request scope (see RecurlyResourceCacheMiddleware and request_scope()),
+  within which a resource is fetched at most once, and shared as is;
+- the Django cache RESOURCE_CACHE_ALIAS, in which the XML of resources is
+  kept for RESOURCE_CACHE_TTL seconds (disabled by default), across requests
+  and processes.
+
+Push notifications invalidate the entries of their account and subscription.
+Code about to modify remote data must not use this cache (see the "cached"
+argument of Account.get_recurly_account() and Subscription.get_recurly_subscription()).
+"""
+import hashlib
+import threading
+from contextlib import contextmanager
+from xml.etree import ElementTree
+
+from django.core.cache import caches
+
+from . import conf
+from .utils import recurly
+
+_local = threading.local()
+
+
+def _get_request_scope():
+    return getattr(_local, "resources", None)
+
+
+def begin_request_scope():
+    _local.resources = {}
+
+
+def end_request_scope():
+    _local.resources = None
+
+
+@contextmanager
+def request_scope():
+    """Shares fetched resources until exit (nested scopes share the outermost one)."""
+    if _get_request_scope() is not None:
+        yield
+        return
+    begin_request_scope()
+    try:
+        yield
+    finally:
+        end_request_scope()
+
+
+def _get_cache_key(resource_class, key):
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return "django_recurly:resource:%s:%s" % (resource_class.nodename, hashlib.sha1(key).hexdigest())
+
+
+def get_resource(resource_class, key):
+    """Cached counterpart of resource_class.get(key)."""
+    cache_key = _get_cache_key(resource_class, key)
+    scope = _get_request_scope()
+    if scope is not None and cache_key in scope:
+        return scope[cache_key]
+
+    resource = None
+    if conf.RESOURCE_CACHE_TTL:
+        xml = caches[conf.RESOURCE_CACHE_ALIAS].get(cache_key)
+        if xml is not None:
+            resource = resource_class.from_element(ElementTree.fromstring(xml))
+
+    if resource is None:
+        resource = resource_class.get(key)
+        if conf.RESOURCE_CACHE_TTL:
+            caches[conf.RESOURCE_CACHE_ALIAS].set(cache_key, ElementTree.tostring(resource._elem),
+                                                  conf.RESOURCE_CACHE_TTL)
+
+    if scope is not None:
+        scope[cache_key] = resource
+    return resource
+
+
+def invalidate_resource(resource_class, key):
+    cache_key = _get_cache_key(resource_class, key)
+    scope = _get_request_scope()
+    if scope is not None:
+        scope.pop(cache_key, None)
+    if conf.RESOURCE_CACHE_TTL:
+        caches[conf.RESOURCE_CACHE_ALIAS].delete(cache_key)
+
+
+def get_account(account_code):
+    return get_resource(recurly.Account, account_code)
+
+
+def get_subscription(uuid):
+    return get_resource(recurly.Subscription, uuid)
+
+
+def invalidate(account_code=None, subscription_uuid=None):
+    """Drops the cached remote account and/or subscription."""
+    if account_code:
+        invalidate_resource(recurly.Account, account_code)
+    if subscription_uuid:
+        invalidate_resource(recurly.Subscription, subscription_uuid)
@@ -37,6 +37,95 @@ TIME_ZONE = getattr(settings, 'TIME_ZONE', 'UTC')
 RECURLY_ACCOUNT_CODE_TO_USER = getattr(settings, 'RECURLY_ACCOUNT_CODE_TO_USER',
     None)
 
+# When enabled, the push notification view only stores the raw notification
+# in the PushNotification inbox table and returns immediately; the signals are
+# then fired by the "recurlyinbox" management command.
+NOTIFICATION_INBOX = getattr(settings, 'RECURLY_NOTIFICATION_INBOX', False)
+
+# Number of inbox notifications claimed at once by a worker
+NOTIFICATION_INBOX_BATCH_SIZE = getattr(settings, 'RECURLY_NOTIFICATION_INBOX_BATCH_SIZE', 100)
+
+# Failing notifications are retried this many times before being marked as "failed"
+NOTIFICATION_INBOX_MAX_ATTEMPTS = getattr(settings, 'RECURLY_NOTIFICATION_INBOX_MAX_ATTEMPTS', 5)
+
+# Notifications stuck in "processing" state for longer than this (eg. after
+# a worker crash) are put back in the queue
+NOTIFICATION_INBOX_STALE_SECONDS = getattr(settings, 'RECURLY_NOTIFICATION_INBOX_STALE_SECONDS', 600)
+
+# If > 0, inbox notifications are only processed once they are this many
+# seconds old, and all pending notifications of a same account are then
+# coalesced into a single account resync (plus one sync per payment)
+NOTIFICATION_COALESCE_WINDOW = getattr(settings, 'RECURLY_NOTIFICATION_COALESCE_WINDOW', 0)
+
+# When enabled, digests of received push notifications are kept in a ledger
+# for NOTIFICATION_LEDGER_TTL seconds, and redeliveries of the same
+# notification by Recurly (eg. after a timeout) are ignored
+NOTIFICATION_LEDGER = getattr(settings, 'RECURLY_NOTIFICATION_LEDGER', False)
+NOTIFICATION_LEDGER_TTL = getattr(settings, 'RECURLY_NOTIFICATION_LEDGER_TTL', 7 * 24 * 3600)
+
+# When enabled, payment notifications are mirrored straight from their
+# transaction data, without fetching the transaction and its invoice from
+# Recurly; such payments are flagged for a later "recurlysync --verify-payments"
+TRUST_PAYMENT_NOTIFICATIONS = getattr(settings, 'RECURLY_TRUST_PAYMENT_NOTIFICATIONS', False)
+
+# Number of worker threads used by the "recurlyinbox" and "recurlysync"
+# commands; work is sharded by account_code, so that a given account is
+# always handled serially. The default of 1 processes everything inline.
+WORKER_SHARDS = getattr(settings, 'RECURLY_WORKER_SHARDS', 1)
+
+# If > 0, independent API calls of a full account resync (account, billing
+# info, subscriptions) are issued concurrently, by a process-wide pool of this
+# many threads; by default they are issued one after the other.
+REMOTE_FETCH_WORKERS = getattr(settings, 'RECURLY_REMOTE_FETCH_WORKERS', 0)
+
+# Connections to the Recurly API are kept alive and reused (see transport.py):
+# at most HTTP_POOL_SIZE idle connections are kept per host, for at most
+# HTTP_POOL_IDLE_TIMEOUT seconds. Set HTTP_POOL_SIZE to 0 to open a new
+# connection for each API call, like the bare recurly client.
+HTTP_POOL_SIZE = getattr(settings, 'RECURLY_HTTP_POOL_SIZE', 10)
+HTTP_POOL_IDLE_TIMEOUT = getattr(settings, 'RECURLY_HTTP_POOL_IDLE_TIMEOUT', 30)
+
+# Socket timeout (in seconds) of API calls, None for the system default
+HTTP_TIMEOUT = getattr(settings, 'RECURLY_HTTP_TIMEOUT', None)
+
+# Remote accounts and subscriptions read through Account.get_recurly_account()
+# and Subscription.get_recurly_subscription() are kept this many seconds in the
+# RESOURCE_CACHE_ALIAS Django cache (0 disables it). They can also be shared
+# within a request, with "django_recurly.middleware.RecurlyResourceCacheMiddleware".
+RESOURCE_CACHE_TTL = getattr(settings, 'RECURLY_RESOURCE_CACHE_TTL', 0)
+RESOURCE_CACHE_ALIAS = getattr(settings, 'RECURLY_RESOURCE_CACHE_ALIAS', 'default')
+
+# When enabled, API calls are counted and timed per endpoint (see metrics.py),
+# and passed to METRICS_SINKS: callables (or dotted paths to them) receiving
+# each metrics.ApiCall, eg. "django_recurly.metrics.logging_sink"
+METRICS = getattr(settings, 'RECURLY_METRICS', False)
+METRICS_SINKS = getattr(settings, 'RECURLY_METRICS_SINKS', ())
+
+# Bulk API calls (eg. of the "recurlysync" command) are paced against the
+# rate limit of the Recurly API (see throttling.py), leaving this share of
+# each rate limit window to interactive calls, like checkouts. Bulk calls
+# rejected with "429 Too Many Requests" are retried up to THROTTLE_MAX_RETRIES times.
+THROTTLE = getattr(settings, 'RECURLY_THROTTLE', True)
+THROTTLE_RESERVED_SHARE = getattr(settings, 'RECURLY_THROTTLE_RESERVED_SHARE', 0.2)
+THROTTLE_MAX_RETRIES = getattr(settings, 'RECURLY_THROTTLE_MAX_RETRIES', 3)
+
+# Idempotent (GET) API calls failing with a network error or a 5xx status are
+# retried up to RETRY_ATTEMPTS times, after a jittered exponential backoff of
+# at most RETRY_BACKOFF * 2**n (and RETRY_BACKOFF_MAX) seconds (see resilience.py).
+RETRY_ATTEMPTS = getattr(settings, 'RECURLY_RETRY_ATTEMPTS', 2)
+RETRY_BACKOFF = getattr(settings, 'RECURLY_RETRY_BACKOFF', 0.5)
+RETRY_BACKOFF_MAX = getattr(settings, 'RECURLY_RETRY_BACKOFF_MAX', 5)
+
+# Once at least CIRCUIT_BREAKER_THRESHOLD of the last CIRCUIT_BREAKER_WINDOW
+# API calls (and CIRCUIT_BREAKER_MIN_CALLS of them) failed, API calls fail fast
+# with RecurlyUnavailableError (a recurly.errors.ServiceUnavailableError, so
+# that callers handle it like a 503) for CIRCUIT_BREAKER_COOLDOWN seconds, after
+# which a single trial call decides whether to resume. None disables it.
+CIRCUIT_BREAKER_THRESHOLD = getattr(settings, 'RECURLY_CIRCUIT_BREAKER_THRESHOLD', 0.5)
+CIRCUIT_BREAKER_WINDOW = getattr(settings, 'RECURLY_CIRCUIT_BREAKER_WINDOW', 20)
+CIRCUIT_BREAKER_MIN_CALLS = getattr(settings, 'RECURLY_CIRCUIT_BREAKER_MIN_CALLS', 10)
+CIRCUIT_BREAKER_COOLDOWN = getattr(settings, 'RECURLY_CIRCUIT_BREAKER_COOLDOWN', 30)
+
 
 # Configure the Recurly client
 recurly.API_KEY = API_KEY
@@ -52,3 +141,6 @@ if DEFAULT_CURRENCY is not None:
 
 if BASE_URI is not None:
     recurly.BASE_URI = BASE_URI
+
+if HTTP_TIMEOUT is not None:
+    recurly.SOCKET_TIMEOUT_SECONDS = HTTP_TIMEOUT
@@ -1,7 +1,37 @@
+from xml.etree import ElementTree
+
+import recurly.errors
+
+
 
 class PreVerificationTransactionRecurlyError(Exception):
     def __init__(self, transaction_error_code):
         self.transaction_error_code = transaction_error_code
 
     def __str__(self):
-        return "InCorrect Payment Info, Pls recheck transaction_error_code: {}".format(self.transaction_error_code)
\ No newline at end of file
+        return "InCorrect Payment Info, Pls recheck transaction_error_code: {}".format(self.transaction_error_code)
+
+
+class InvalidNotificationError(Exception):
+    def __init__(self, notification_type):
+        self.notification_type = notification_type
+
+    def __str__(self):
+        return "Invalid push notification type: {}".format(self.notification_type)
+
+
+class RecurlyUnavailableError(recurly.errors.ServiceUnavailableError):
+    """Raised instead of calling the API while the circuit breaker is open, like a 503 response."""
+
+    def __init__(self, retry_at):
+        self.retry_at = retry_at
+        error = ElementTree.Element("error")
+        ElementTree.SubElement(error, "symbol").text = "service_unavailable"
+        ElementTree.SubElement(error, "description").text = str(self)
+        super(RecurlyUnavailableError, self).__init__(ElementTree.tostring(error))
+
+    def __reduce__(self):
+        return type(self), (self.retry_at,)
+
+    def __str__(self):
+        return "Recurly API calls are failing, circuit breaker open until {}".format(self.retry_at)
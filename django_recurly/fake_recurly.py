@@ -0,0 +1,807 @@
+"""
+In-process stand-in for the Recurly API (v2), for offline tests and benchmarks.
+
+FakeRecurlyServer keeps accounts, billing infos, acquisitions, subscriptions,
+plans and their add-ons, invoices, transactions, coupons and redemptions in
+memory, seeded with the XML fixtures of tests/data/resources, and serves them
+like Recurly does: links and actions as hrefs to itself, paginated lists,
+ETags, 404 and 422 errors. Creating a subscription also creates the invoice
+and the purchase transaction of its first period.
+
+Each response is delayed by "latency" seconds, and may be replaced by a fault:
+first the ones queued in "faults" (an error status, or "drop" for no response
+at all), then random errors ("error_status") at "error_rate", drawn from a
+seeded generator so that runs are reproducible. Without "keep_alive", the
+connection is closed after each response, without telling the client (like
+idle connections dropped by a load balancer).
+
+Usage:
+
+    with fake_recurly_api(latency=0.05) as server:
+        server.add_plan("gold", unit_amount_in_cents={"EUR": 800})
+        create_and_sync_recurly_account(...)
+        server.faults = [503]
+        ...
+        server.requests  # eg. ["POST /v2/accounts", "GET /v2/accounts/jane/billing_info"]
+        server.connections  # number of connections accepted
+"""
+import collections
+import copy
+import glob
+import itertools
+import os.path
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from hashlib import md5
+from xml.etree import ElementTree
+
+import recurly
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qsl, quote, unquote, urlencode, urlsplit
+
+from django_recurly.utils import use_api_base_uri
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "data", "resources")
+
+DEFAULT_PER_PAGE = 50
+
+# states matched by the "live" filter of subscription lists
+LIVE_SUBSCRIPTION_STATES = ("active", "canceled", "future", "in_trial", "paused")
+
+# list filters, as (query parameter, child element)
+LIST_FILTERS = (("state", "state"), ("type", "action"))
+
+DROP = "drop"
+
+# actions of subscriptions ("<a name=...>" elements), per state
+SUBSCRIPTION_ACTIONS = {
+    "active": ("cancel", "terminate", "postpone"),
+    "canceled": ("reactivate", "terminate"),
+}
+
+
+class FakeApiError(Exception):
+
+    def __init__(self, status, symbol, description, field=None):
+        super(FakeApiError, self).__init__(description)
+        self.status = status
+        self.symbol = symbol
+        self.description = description
+        self.field = field
+
+    def to_element(self):
+        if self.field:  # validation error
+            errors = ElementTree.Element("errors")
+            ElementTree.SubElement(errors, "error", field=self.field, symbol=self.symbol).text = self.description
+            return errors
+        error = ElementTree.Element("error")
+        ElementTree.SubElement(error, "symbol").text = self.symbol
+        ElementTree.SubElement(error, "description").text = self.description
+        return error
+
+
+def _not_found(description):
+    return FakeApiError(404, "not_found", description)
+
+
+def _invalid(field, symbol, description):
+    return FakeApiError(422, symbol, description, field=field)
+
+
+## XML helpers ##
+
+def _now():
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def _set(elem, tag, value):
+    """Sets the child "tag" of elem to this value (typed like Recurly does, None being nil)."""
+    child = elem.find(tag)
+    if child is None:
+        child = ElementTree.SubElement(elem, tag)
+    child.clear()
+    if value is None:
+        child.set("nil", "nil")
+    elif isinstance(value, bool):
+        child.set("type", "boolean")
+        child.text = "true" if value else "false"
+    elif isinstance(value, int):
+        child.set("type", "integer")
+        child.text = str(value)
+    elif isinstance(value, datetime):
+        child.set("type", "datetime")
+        child.text = value.strftime("%Y-%m-%dT%H:%M:%SZ")
+    else:
+        child.text = value
+    return child
+
+
+def _setdefault(elem, tag, value):
+    if elem.find(tag) is None:
+        _set(elem, tag, value)
+
+
+def _get_text(elem, tag, default=None):
+    child = elem.find(tag)
+    if child is None or child.get("nil") is not None or not (child.text or "").strip():
+        return default
+    return child.text.strip()
+
+
+def _get_int(elem, tag, default=0):
+    value = _get_text(elem, tag)
+    return default if value is None else int(value)
+
+
+def _get_amount(elem, tag, currency):
+    """Amount in this currency of a money element, eg. the unit_amount_in_cents of a plan."""
+    return _get_int(elem, "%s/%s" % (tag, currency))
+
+
+def _merge(elem, changes, exclude=()):
+    """Overrides the children of elem with those of the "changes" element."""
+    for change in changes:
+        if change.tag in exclude:
+            continue
+        previous = elem.find(change.tag)
+        if previous is not None:
+            elem.remove(previous)
+        elem.append(copy.deepcopy(change))
+    return elem
+
+
+def _strip_links(elem):
+    """Copy of a fetched resource element, without its links and actions."""
+    stripped = ElementTree.Element(elem.tag)
+    for child in elem:
+        if child.tag != "a" and not ("href" in child.attrib and not len(child)):
+            stripped.append(copy.deepcopy(child))
+    return stripped
+
+
+class FakeResource(object):
+
+    def __init__(self, nodename, elem, links=(), actions=()):
+        self.nodename = nodename
+        self.elem = elem  # data, without links
+        self.links = collections.OrderedDict(links)  # tag -> path
+        self.actions = list(actions)  # (name, method)
+
+
+class FakeRecurlyServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Resources are stored by path (eg. "accounts/jane", unquoted), and lists
+    as the paths of their members (eg. "accounts/jane/subscriptions"), which
+    are all served by GET and HEAD; writes are dispatched through ROUTES.
+    """
+    daemon_threads = True
+
+    ROUTES = (
+        ("POST", r"accounts", "create_account"),
+        ("PUT", r"accounts/([^/]+)", "update_account"),
+        ("DELETE", r"accounts/([^/]+)", "close_account"),
+        ("PUT", r"accounts/([^/]+)/reopen", "reopen_account"),
+        ("PUT", r"accounts/([^/]+)/billing_info", "update_billing_info"),
+        ("DELETE", r"accounts/([^/]+)/billing_info", "delete_billing_info"),
+        ("POST", r"accounts/([^/]+)/acquisition", "update_acquisition"),
+        ("PUT", r"accounts/([^/]+)/acquisition", "update_acquisition"),
+        ("POST", r"accounts/([^/]+)/subscriptions", "create_subscription"),
+        ("POST", r"subscriptions", "create_subscription"),
+        ("PUT", r"subscriptions/([^/]+)", "update_subscription"),
+        ("PUT", r"subscriptions/([^/]+)/(cancel|terminate|reactivate|postpone)", "change_subscription_state"),
+        ("POST", r"plans", "create_plan"),
+        ("PUT", r"plans/([^/]+)", "update_plan"),
+        ("DELETE", r"plans/([^/]+)", "delete_plan"),
+        ("POST", r"plans/([^/]+)/add_ons", "create_add_on"),
+        ("POST", r"coupons", "create_coupon"),
+        ("POST", r"coupons/([^/]+)/redeem", "redeem_coupon"),
+    )
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0, error_rate=0, error_status=503, seed=0,
+                 fixtures_directory=FIXTURES_DIRECTORY, taxes=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeRecurlyHandler)
+        self.base_uri = "http://%s:%d/v2/" % self.server_address[:2]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.taxes = taxes  # else, like sites without taxes, tax_exempt isn't returned
+        self.keep_alive = True
+        self.faults = []
+        self.requests = []  # "METHOD /path" of all requests received
+        self.connections = 0
+
+        self.lock = threading.RLock()
+        self.resources = {}
+        self.lists = {}
+        self._random = random.Random(seed)
+        self._invoice_numbers = itertools.count(1001)
+        self._routes = [(method, re.compile(pattern + "$"), name) for (method, pattern, name) in self.ROUTES]
+
+        if fixtures_directory:
+            self.load_fixtures(fixtures_directory)
+
+    def url(self, path):
+        return self.base_uri + quote(path, safe="/")
+
+    def _add(self, path, resource, lists=()):
+        self.resources[path] = resource
+        for list_path in lists:
+            self.lists.setdefault(list_path, []).append(path)
+        return path
+
+    def _get(self, path, description):
+        try:
+            return self.resources[path]
+        except KeyError:
+            raise _not_found("Couldn't find %s" % description)
+
+    ## Faults ##
+
+    def get_fault(self):
+        with self.lock:
+            if self.faults:
+                return self.faults.pop(0)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self.error_status
+        return None
+
+    ## Rendering ##
+
+    def render(self, path):
+        resource = self.resources[path]
+        elem = ElementTree.Element(resource.nodename, href=self.url(path))
+        for tag, link_path in resource.links.items():
+            ElementTree.SubElement(elem, tag, href=self.url(link_path))
+        for child in resource.elem:
+            if child.tag == "tax_exempt" and not self.taxes:
+                continue
+            elem.append(copy.deepcopy(child))
+        for name, method in resource.actions:
+            ElementTree.SubElement(elem, "a", name=name, href=self.url(path + "/" + name), method=method)
+        return elem
+
+    def render_list(self, path, params):
+        """Returns the page of the list at this path, and its pagination headers."""
+        members = [self.resources[member_path] for member_path in self.lists[path]]
+        paths = list(self.lists[path])
+        for param, tag in LIST_FILTERS:
+            value = params.get(param)
+            if value:
+                accepted = LIVE_SUBSCRIPTION_STATES if value == "live" else (value,)
+                paths = [member_path for (member_path, member) in zip(paths, members)
+                         if _get_text(member.elem, tag) in accepted]
+                members = [self.resources[member_path] for member_path in paths]
+
+        per_page = int(params.get("per_page") or DEFAULT_PER_PAGE)
+        cursor = int(params.get("cursor") or 0)
+        elem = ElementTree.Element(path.rsplit("/", 1)[-1], type="array")
+        elem.extend(self.render(member_path) for member_path in paths[cursor:cursor + per_page])
+
+        headers = {"X-Records": str(len(paths))}
+        if cursor + per_page < len(paths):
+            params = dict(params, cursor=cursor + per_page, per_page=per_page)
+            headers["Link"] = '<%s?%s>; rel="next"' % (self.url(path), urlencode(sorted(params.items())))
+        return elem, headers
+
+    ## Dispatching ##
+
+    def dispatch(self, method, path, params, body):
+        """Returns the (status, element or None, headers) of the response to this request."""
+        if method in ("GET", "HEAD"):
+            if path in self.resources:
+                return 200, self.render(path), {}
+            if path in self.lists:
+                elem, headers = self.render_list(path, params)
+                return 200, elem, headers
+            raise _not_found("Couldn't find resource at %s" % path)
+
+        for route_method, pattern, name in self._routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                try:
+                    elem = ElementTree.fromstring(body) if body.strip() else ElementTree.Element("empty")
+                except ElementTree.ParseError:
+                    raise FakeApiError(400, "bad_request", "The provided XML was invalid.")
+                status, result_path = getattr(self, name)(elem, params, *match.groups())
+                if result_path is None:
+                    return status, None, {}
+                headers = {"Location": self.url(result_path)} if status == 201 else {}
+                return status, self.render(result_path), headers
+
+        raise _not_found("Couldn't find resource at %s" % path)
+
+    ## Accounts ##
+
+    def _create_account(self, elem):
+        account_code = _get_text(elem, "account_code")
+        if not account_code:
+            raise _invalid("account.account_code", "blank", "can't be blank")
+        path = "accounts/" + account_code
+        if path in self.resources:
+            raise _invalid("account.account_code", "taken", "has already been taken")
+
+        data = _merge(ElementTree.Element("account"), elem, exclude=("billing_info", "account_acquisition"))
+        _setdefault(data, "state", "active")
+        _setdefault(data, "hosted_login_token", uuid.uuid4().hex)
+        _setdefault(data, "created_at", _now())
+        _setdefault(data, "updated_at", _now())
+
+        sublists = ("invoices", "redemptions", "subscriptions", "transactions")
+        self._add(path, FakeResource("account", data, [(name, path + "/" + name) for name in sublists]),
+                  lists=["accounts"])
+        for name in sublists:
+            self.lists[path + "/" + name] = []
+
+        if elem.find("billing_info") is not None:
+            self._set_billing_info(account_code, elem.find("billing_info"))
+        return path
+
+    def _get_account(self, account_code):
+        return self._get("accounts/" + account_code, "Account with account_code = %s" % account_code)
+
+    def create_account(self, elem, params):
+        return 201, self._create_account(elem)
+
+    def update_account(self, elem, params, account_code):
+        account = self._get_account(account_code)
+        _merge(account.elem, elem, exclude=("account_code", "billing_info", "state"))
+        _set(account.elem, "updated_at", _now())
+        if elem.find("billing_info") is not None:
+            self._set_billing_info(account_code, elem.find("billing_info"))
+        return 200, "accounts/" + account_code
+
+    def close_account(self, elem, params, account_code):
+        account = self._get_account(account_code)
+        _set(account.elem, "state", "closed")
+        _set(account.elem, "closed_at", _now())
+        return 204, None
+
+    def reopen_account(self, elem, params, account_code):
+        account = self._get_account(account_code)
+        _set(account.elem, "state", "active")
+        _set(account.elem, "closed_at", None)
+        return 200, "accounts/" + account_code
+
+    ## Billing infos ##
+
+    def _set_billing_info(self, account_code, elem):
+        """Replaces the billing info of an account, keeping only the first and last digits of the card number."""
+        data = _merge(ElementTree.Element("billing_info"), elem,
+                      exclude=("number", "verification_value", "account"))
+        number = re.sub(r"\D", "", _get_text(elem, "number", ""))
+        if number:
+            if len(number) < 12:
+                raise _invalid("billing_info.number", "invalid", "is not a valid credit card number")
+            _set(data, "first_six", number[:6])
+            _set(data, "last_four", number[-4:])
+            _set(data, "card_type", {"4": "Visa", "5": "MasterCard", "3": "American Express"}.get(number[0], "Unknown"))
+
+        account_path = "accounts/" + account_code
+        path = account_path + "/billing_info"
+        self._add(path, FakeResource("billing_info", data, [("account", account_path)]))
+        self.resources[account_path].links["billing_info"] = path
+        return path
+
+    def update_billing_info(self, elem, params, account_code):
+        self._get_account(account_code)
+        return 200, self._set_billing_info(account_code, elem)
+
+    def delete_billing_info(self, elem, params, account_code):
+        account = self._get_account(account_code)
+        self._get("accounts/%s/billing_info" % account_code, "BillingInfo")
+        del self.resources["accounts/%s/billing_info" % account_code]
+        del account.links["billing_info"]
+        return 204, None
+
+    ## Acquisitions ##
+
+    def update_acquisition(self, elem, params, account_code):
+        self._get_account(account_code)
+        path = "accounts/%s/acquisition" % account_code
+        created = path not in self.resources
+        if created:
+            data = ElementTree.Element("account_acquisition")
+            _set(data, "created_at", _now())
+            self._add(path, FakeResource("account_acquisition", data, [("account", "accounts/" + account_code)]))
+        data = self.resources[path].elem
+        _merge(data, elem, exclude=("account_code",))
+        _set(data, "updated_at", _now())
+        return (201 if created else 200), path
+
+    ## Plans ##
+
+    def add_plan(self, plan_code, name=None, unit_amount_in_cents=None, plan_interval_length=1,
+                 plan_interval_unit="months", add_ons=()):
+        """
+        Adds a plan to the catalog, with amounts given per currency (eg.
+        {"EUR": 800}), and add-ons as (add_on_code, unit_amount_in_cents) pairs.
+        """
+        def _money(tag, amounts):
+            elem = ElementTree.Element(tag)
+            for currency, amount in sorted((amounts or {}).items()):
+                ElementTree.SubElement(elem, currency, type="integer").text = str(amount)
+            return elem
+
+        with self.lock:
+            plan = ElementTree.Element("plan")
+            _set(plan, "plan_code", plan_code)
+            _set(plan, "name", name or plan_code)
+            _set(plan, "plan_interval_length", plan_interval_length)
+            _set(plan, "plan_interval_unit", plan_interval_unit)
+            plan.append(_money("unit_amount_in_cents", unit_amount_in_cents))
+            self._create_plan(plan)
+
+            for add_on_code, add_on_amounts in add_ons:
+                add_on = ElementTree.Element("add_on")
+                _set(add_on, "add_on_code", add_on_code)
+                _set(add_on, "name", add_on_code)
+                _set(add_on, "default_quantity", 1)
+                add_on.append(_money("unit_amount_in_cents", add_on_amounts))
+                self.create_add_on(add_on, {}, plan_code)
+
+    def _create_plan(self, elem):
+        plan_code = _get_text(elem, "plan_code")
+        if not plan_code:
+            raise _invalid("plan.plan_code", "blank", "can't be blank")
+        path = "plans/" + plan_code
+        if path in self.resources:
+            raise _invalid("plan.plan_code", "taken", "has already been taken")
+
+        data = _merge(ElementTree.Element("plan"), elem, exclude=("add_ons",))
+        _setdefault(data, "created_at", _now())
+        _setdefault(data, "updated_at", _now())
+        self.lists[path + "/add_ons"] = []
+        return self._add(path, FakeResource("plan", data, [("add_ons", path + "/add_ons")]), lists=["plans"])
+
+    def _get_plan(self, plan_code, field="subscription.plan_code"):
+        try:
+            return self.resources["plans/" + (plan_code or "")]
+        except KeyError:
+            raise _invalid(field, "invalid", "is invalid")
+
+    def create_plan(self, elem, params):
+        return 201, self._create_plan(elem)
+
+    def update_plan(self, elem, params, plan_code):
+        plan = self._get("plans/" + plan_code, "Plan with plan_code = %s" % plan_code)
+        _merge(plan.elem, elem, exclude=("plan_code", "add_ons"))
+        _set(plan.elem, "updated_at", _now())
+        return 200, "plans/" + plan_code
+
+    def delete_plan(self, elem, params, plan_code):
+        self._get("plans/" + plan_code, "Plan with plan_code = %s" % plan_code)
+        del self.resources["plans/" + plan_code]
+        self.lists["plans"].remove("plans/" + plan_code)
+        return 204, None
+
+    def create_add_on(self, elem, params, plan_code):
+        self._get("plans/" + plan_code, "Plan with plan_code = %s" % plan_code)
+        add_on_code = _get_text(elem, "add_on_code")
+        if not add_on_code:
+            raise _invalid("add_on.add_on_code", "blank", "can't be blank")
+        path = "plans/%s/add_ons/%s" % (plan_code, add_on_code)
+        if path in self.resources:
+            raise _invalid("add_on.add_on_code", "taken", "has already been taken")
+
+        data = _merge(ElementTree.Element("add_on"), elem)
+        _setdefault(data, "created_at", _now())
+        _setdefault(data, "updated_at", _now())
+        return 201, self._add(path, FakeResource("add_on", data, [("plan", "plans/" + plan_code)]),
+                              lists=["plans/%s/add_ons" % plan_code])
+
+    ## Subscriptions ##
+
+    def _set_plan(self, data, plan_code, currency, unit_amount_in_cents=None):
+        plan = self._get_plan(plan_code)
+        previous = data.find("plan")
+        if previous is not None:
+            data.remove(previous)
+        plan_elem = ElementTree.Element("plan", href=self.url("plans/" + plan_code))
+        _set(plan_elem, "plan_code", plan_code)
+        _set(plan_elem, "name", _get_text(plan.elem, "name"))
+        data.insert(0, plan_elem)
+        if unit_amount_in_cents is None:
+            unit_amount_in_cents = _get_amount(plan.elem, "unit_amount_in_cents", currency)
+        _set(data, "unit_amount_in_cents", unit_amount_in_cents)
+        return plan
+
+    def _get_subscription_add_ons(self, plan_code, elem, currency):
+        add_ons = ElementTree.Element("subscription_add_ons", type="array")
+        for add_on_elem in (elem if elem is not None else ()):
+            add_on_code = _get_text(add_on_elem, "add_on_code")
+            add_on = self.resources.get("plans/%s/add_ons/%s" % (plan_code, add_on_code))
+            if add_on is None:
+                raise _invalid("subscription.subscription_add_ons.add_on_code", "invalid", "is invalid")
+            subscription_add_on = ElementTree.SubElement(add_ons, "subscription_add_on")
+            _set(subscription_add_on, "add_on_code", add_on_code)
+            _set(subscription_add_on, "quantity", _get_int(add_on_elem, "quantity", 1))
+            _set(subscription_add_on, "unit_amount_in_cents", _get_int(
+                add_on_elem, "unit_amount_in_cents", _get_amount(add_on.elem, "unit_amount_in_cents", currency)))
+        return add_ons
+
+    def _set_subscription_state(self, subscription, state):
+        _set(subscription.elem, "state", state)
+        subscription.actions = [(name, "put") for name in SUBSCRIPTION_ACTIONS.get(state, ())]
+
+    def _add_subscription(self, account_code, data):
+        subscription_uuid = _get_text(data, "uuid")
+        subscription = FakeResource("subscription", data, [("account", "accounts/" + account_code)])
+        self._set_subscription_state(subscription, _get_text(data, "state", "active"))
+        return self._add("subscriptions/" + subscription_uuid, subscription,
+                         lists=["subscriptions", "accounts/%s/subscriptions" % account_code])
+
+    def _invoice(self, account_code, subscription_path, amount, currency):
+        """Creates the invoice, and the successful purchase transaction, of a subscription charge."""
+        now = _now()
+        account_path = "accounts/" + account_code
+        invoice_number = next(self._invoice_numbers)
+        invoice = ElementTree.Element("invoice")
+        _set(invoice, "uuid", uuid.uuid4().hex)
+        _set(invoice, "state", "collected")
+        _set(invoice, "invoice_number", invoice_number)
+        _set(invoice, "subtotal_in_cents", amount)
+        _set(invoice, "total_in_cents", amount)
+        _set(invoice, "currency", currency)
+        _set(invoice, "created_at", now)
+        invoice_path = self._add("invoices/%d" % invoice_number,
+                                 FakeResource("invoice", invoice, [("account", account_path)]),
+                                 lists=["invoices", account_path + "/invoices"])
+
+        transaction_uuid = uuid.uuid4().hex
+        transaction = ElementTree.Element("transaction")
+        _set(transaction, "uuid", transaction_uuid)
+        _set(transaction, "action", "purchase")
+        _set(transaction, "amount_in_cents", amount)
+        _set(transaction, "currency", currency)
+        _set(transaction, "status", "success")
+        _set(transaction, "source", "subscription")
+        _set(transaction, "reference", str(self._random.randint(1000000, 9999999)))
+        _set(transaction, "test", True)
+        _set(transaction, "created_at", now)
+        self._add("transactions/" + transaction_uuid, FakeResource("transaction", transaction, [
+            ("account", account_path), ("invoice", invoice_path), ("subscription", subscription_path),
+        ]), lists=["transactions", account_path + "/transactions"])
+
+    def create_subscription(self, elem, params, account_code=None):
+        account_elem = elem.find("account")
+        if account_code is None:
+            if account_elem is None or not _get_text(account_elem, "account_code"):
+                raise _invalid("subscription.account.account_code", "blank", "can't be blank")
+            account_code = _get_text(account_elem, "account_code")
+        plan_code = _get_text(elem, "plan_code")
+        self._get_plan(plan_code)  # before any account creation
+        currency = _get_text(elem, "currency", "USD")
+        add_ons = self._get_subscription_add_ons(plan_code, elem.find("subscription_add_ons"), currency)
+
+        if "accounts/" + account_code not in self.resources:
+            if account_elem is None:
+                self._get_account(account_code)  # 404
+            self._create_account(account_elem)
+        elif account_elem is not None and account_elem.find("billing_info") is not None:
+            self._set_billing_info(account_code, account_elem.find("billing_info"))
+
+        now = _now()
+        data = ElementTree.Element("subscription")
+        plan = self._set_plan(data, plan_code, currency, _get_int(elem, "unit_amount_in_cents", None))
+        _set(data, "uuid", uuid.uuid4().hex)
+        _set(data, "currency", currency)
+        _set(data, "quantity", _get_int(elem, "quantity", 1))
+        _set(data, "activated_at", now)
+        _set(data, "updated_at", now)
+        _set(data, "canceled_at", None)
+        _set(data, "expires_at", None)
+        _set(data, "current_period_started_at", now)
+        length = _get_int(plan.elem, "plan_interval_length", 1)
+        days = length if _get_text(plan.elem, "plan_interval_unit") == "days" else 30 * length
+        _set(data, "current_period_ends_at", now + timedelta(days=days))
+        _set(data, "trial_started_at", None)
+        _set(data, "trial_ends_at", None)
+        data.append(add_ons)
+        path = self._add_subscription(account_code, data)
+
+        amount = _get_int(data, "unit_amount_in_cents") * _get_int(data, "quantity") + sum(
+            _get_int(add_on, "unit_amount_in_cents") * _get_int(add_on, "quantity") for add_on in add_ons)
+        if amount:
+            self._invoice(account_code, path, amount, currency)
+        return 201, path
+
+    def update_subscription(self, elem, params, subscription_uuid):
+        subscription = self._get("subscriptions/" + subscription_uuid, "Subscription with uuid = %s" % subscription_uuid)
+        data = subscription.elem
+        if _get_text(elem, "timeframe") == "renewal":
+            data = ElementTree.Element("pending_subscription", type="subscription")
+            _merge(data, subscription.elem, exclude=("state", "current_period_started_at", "current_period_ends_at",
+                                                           "pending_subscription"))
+
+        currency = _get_text(data, "currency", "USD")
+        plan_code = _get_text(elem, "plan_code")
+        if plan_code and plan_code != _get_text(data, "plan/plan_code"):
+            self._set_plan(data, plan_code, currency, _get_int(elem, "unit_amount_in_cents", None))
+        if elem.find("subscription_add_ons") is not None:
+            _merge(data, [self._get_subscription_add_ons(_get_text(data, "plan/plan_code"),
+                                                         elem.find("subscription_add_ons"), currency)])
+        _merge(data, elem, exclude=("plan_code", "timeframe", "subscription_add_ons", "account", "uuid", "state"))
+
+        if data is not subscription.elem:
+            _merge(subscription.elem, [data])
+        _set(subscription.elem, "updated_at", _now())
+        return 200, "subscriptions/" + subscription_uuid
+
+    def change_subscription_state(self, elem, params, subscription_uuid, action):
+        subscription = self._get("subscriptions/" + subscription_uuid, "Subscription with uuid = %s" % subscription_uuid)
+        state = _get_text(subscription.elem, "state")
+        if action not in SUBSCRIPTION_ACTIONS.get(state, ()):
+            raise FakeApiError(400, "invalid_transition", "The subscription cannot be %s when %s" % (action, state))
+
+        data = subscription.elem
+        now = _now()
+        if action == "cancel":
+            self._set_subscription_state(subscription, "canceled")
+            _set(data, "canceled_at", now)
+            expires_at = copy.deepcopy(data.find("current_period_ends_at"))
+            expires_at.tag = "expires_at"
+            _merge(data, [expires_at])
+        elif action == "terminate":
+            self._set_subscription_state(subscription, "expired")
+            _set(data, "expires_at", now)
+        elif action == "reactivate":
+            self._set_subscription_state(subscription, "active")
+            _set(data, "canceled_at", None)
+            _set(data, "expires_at", None)
+        else:  # postpone
+            ends_at = ElementTree.Element("current_period_ends_at", type="datetime")
+            ends_at.text = params.get("next_renewal_date") or _get_text(data, "current_period_ends_at")
+            _merge(data, [ends_at])
+        _set(data, "updated_at", now)
+        return 200, "subscriptions/" + subscription_uuid
+
+    ## Coupons ##
+
+    def create_coupon(self, elem, params):
+        coupon_code = _get_text(elem, "coupon_code")
+        if not coupon_code:
+            raise _invalid("coupon.coupon_code", "blank", "can't be blank")
+        path = "coupons/" + coupon_code
+        if path in self.resources:
+            raise _invalid("coupon.coupon_code", "taken", "has already been taken")
+
+        data = _merge(ElementTree.Element("coupon"), elem)
+        _setdefault(data, "state", "redeemable")
+        _setdefault(data, "created_at", _now())
+        return 201, self._add(path, FakeResource("coupon", data, actions=[("redeem", "post")]), lists=["coupons"])
+
+    def redeem_coupon(self, elem, params, coupon_code):
+        coupon = self._get("coupons/" + coupon_code, "Coupon with coupon_code = %s" % coupon_code)
+        account_code = _get_text(elem, "account_code")
+        if "accounts/%s" % account_code not in self.resources:
+            raise _invalid("redemption.account_code", "invalid", "is invalid")
+
+        redemption_uuid = uuid.uuid4().hex
+        data = ElementTree.Element("redemption")
+        _set(data, "uuid", redemption_uuid)
+        _set(data, "single_use", _get_text(coupon.elem, "duration") == "single_use")
+        _set(data, "total_discounted_in_cents", 0)
+        _set(data, "currency", _get_text(elem, "currency", "USD"))
+        _set(data, "state", "active")
+        _set(data, "created_at", _now())
+        account_path = "accounts/" + account_code
+        return 201, self._add("%s/redemptions/%s" % (account_path, redemption_uuid),
+                              FakeResource("redemption", data, [("coupon", "coupons/" + coupon_code),
+                                                                ("account", account_path)]),
+                              lists=[account_path + "/redemptions"])
+
+    ## Fixtures ##
+
+    def load_fixtures(self, directory=FIXTURES_DIRECTORY):
+        """
+        Adds the accounts and subscriptions (with their plan) of the XML files
+        of this directory, linked like their hrefs tell.
+        """
+        elems = []
+        for path in sorted(glob.glob(os.path.join(directory, "*"))):
+            with open(path, "rb") as f:
+                elems.append(ElementTree.fromstring(f.read()))
+
+        account_codes = {}  # href of the account in links -> account_code
+        with self.lock:
+            for elem in sorted(elems, key=lambda elem: elem.tag != "account"):
+                if elem.tag == "account":
+                    account_path = self._create_account(_strip_links(elem))
+                    account_code = account_path.split("/", 1)[1]
+                    account_codes[elem.get("href")] = account_code
+                    for link in elem:
+                        if "href" in link.attrib and not len(link):
+                            account_codes[link.get("href").rsplit("/", 1)[0]] = account_code
+
+                elif elem.tag == "subscription":
+                    account_href = elem.find("account").get("href")
+                    account_code = account_codes.get(account_href) or unquote(account_href.rsplit("/", 1)[1])
+                    data = _strip_links(elem)
+                    plan_code = _get_text(data, "plan/plan_code")
+                    if "plans/" + plan_code not in self.resources:
+                        self.add_plan(plan_code, _get_text(data, "plan/name"))
+                    data.find("plan").set("href", self.url("plans/" + plan_code))
+                    self._add_subscription(account_code, data)
+
+
+class FakeRecurlyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def handle_request(self):
+        server = self.server
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("content-length") or 0))
+        with server.lock:
+            server.requests.append("%s %s" % (self.command, url.path))
+
+        fault = server.get_fault()
+        if server.latency:
+            time.sleep(server.latency)
+        if fault == DROP:
+            self.close_connection = True
+            return
+
+        headers = {}
+        if fault:
+            status, elem = fault, FakeApiError(fault, "service_unavailable", "Injected fault").to_element()
+        elif not url.path.startswith("/v2/"):
+            status, elem = 404, _not_found("Unknown API version").to_element()
+        else:
+            path = unquote(url.path[len("/v2/"):]).strip("/")
+            try:
+                with server.lock:
+                    status, elem, headers = server.dispatch(self.command, path, dict(parse_qsl(url.query)), body)
+            except FakeApiError as e:
+                status, elem = e.status, e.to_element()
+
+        xml = b"" if elem is None else ElementTree.tostring(elem, encoding="UTF-8")
+        if status == 200 and self.command == "GET":
+            headers["ETag"] = '"%s"' % md5(xml).hexdigest()
+            if self.headers.get("if-none-match") == headers["ETag"]:
+                status, xml = 304, b""
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(xml)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(xml)
+        if not server.keep_alive:
+            self.close_connection = True
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def fake_recurly_api(**kwargs):
+    """Serves a FakeRecurlyServer (see its arguments) from a thread, and points the recurly client to it meanwhile."""
+    server = FakeRecurlyServer(**kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    previous_settings = (recurly.API_KEY, recurly.BASE_URI, recurly.VALID_DOMAINS)
+    recurly.API_KEY = recurly.API_KEY or "fake"
+    use_api_base_uri(server.base_uri)
+    try:
+        yield server
+    finally:
+        recurly.API_KEY, recurly.BASE_URI, recurly.VALID_DOMAINS = previous_settings
+        server.shutdown()
+        server.server_close()
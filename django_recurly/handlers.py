@@ -6,8 +6,12 @@ notification action and the details of the action.
 
 http://docs.recurly.com/push-notifications
 """
+import logging
+
 from django_recurly import signals
 
+logger = logging.getLogger(__name__)
+
 
 # Push notification signal handlers
 
@@ -17,18 +21,41 @@ def new(sender, **kwargs):
     We do these at the same time (rather than using
     the new_account signal) to avoid concurrency problems.
     """
+    if kwargs.get("coalesced"):
+        return  # already sync'ed by the notification inbox worker
     from django_recurly import models
     models.Account.handle_notification(**kwargs)
 
 
 def update(sender, **kwargs):
     """Update a subscription and account"""
+    if kwargs.get("coalesced"):
+        return  # already sync'ed by the notification inbox worker
     from django_recurly import models
     models.Account.handle_notification(**kwargs)
 
 
+def plan(sender, **kwargs):
+    """Mirror the plan of a subscription, if missing in the local catalog
+
+    Best effort only: a failure mustn't fail the notification, as the plan is
+    mirrored on its first local lookup anyway.
+    """
+    if kwargs.get("coalesced"):
+        return  # mirrored on the first local lookup instead
+    plan_code = getattr(kwargs.get("subscription"), "plan_code", None)
+    if plan_code:
+        from django_recurly import provisioning
+        try:
+            provisioning.get_local_plan(plan_code)
+        except Exception:
+            logger.exception("Failed to mirror plan %s", plan_code)
+
+
 def payment(sender, **kwargs):
     """Update a payment and account"""
+    if kwargs.get("coalesced"):
+        return  # already sync'ed by the notification inbox worker
     from django_recurly import models
     models.Payment.handle_notification(**kwargs)
 
@@ -37,6 +64,8 @@ def payment(sender, **kwargs):
 #signals.new_account_notification.connect(new)
 signals.new_subscription_notification.connect(new)
 signals.updated_subscription_notification.connect(update)
+signals.new_subscription_notification.connect(plan)
+signals.updated_subscription_notification.connect(plan)
 signals.expired_subscription_notification.connect(update)
 signals.canceled_subscription_notification.connect(update)
 signals.renewed_subscription_notification.connect(update)
@@ -50,6 +79,24 @@ signals.failed_payment_notification.connect(payment)
 signals.successful_refund_notification.connect(payment)
 signals.void_payment_notification.connect(payment)
 
+# Notifications handled above, grouped by the kind of remote sync they trigger
+ACCOUNT_NOTIFICATION_TYPES = (
+    "new_subscription_notification",
+    "updated_subscription_notification",
+    "expired_subscription_notification",
+    "canceled_subscription_notification",
+    "renewed_subscription_notification",
+    "reactivated_account_notification",
+    "canceled_account_notification",
+    "billing_info_updated_notification",
+)
+PAYMENT_NOTIFICATION_TYPES = (
+    "successful_payment_notification",
+    "failed_payment_notification",
+    "successful_refund_notification",
+    "void_payment_notification",
+)
+
 
 ## Model signal handlers ##
 
@@ -0,0 +1,179 @@
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+import recurly
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from six.moves import BaseHTTPServer, socketserver
+
+from django_recurly import transport
+from django_recurly.utils import percentile, use_api_base_uri
+
+ACCOUNT_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<account href="https://api.recurly.com/v2/accounts/1">
+  <account_code>1</account_code>
+  <state>active</state>
+  <email>verena@test.com</email>
+  <first_name>Verena</first_name>
+  <last_name>Test</last_name>
+  <created_at type="datetime">2011-10-25T12:00:00Z</created_at>
+</account>"""
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers any GET with the same account, over keep-alive HTTP/1.1."""
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1  # headers and body are sent at once (see handle_one_request's flush)
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(ACCOUNT_XML)))
+        self.end_headers()
+        self.wfile.write(ACCOUNT_XML)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, certfile, keyfile):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.lock = threading.Lock()
+        self.connections = 0  # i.e. TLS handshakes
+
+
+def generate_certificate(directory):
+    """Returns the (certfile, keyfile) of a self-signed certificate for localhost, made with openssl."""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                           "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                           "-keyout", keyfile, "-out", certfile],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def run_requests(requests, concurrency):
+    """Fetches an account "requests" times from "concurrency" threads, and returns the latencies."""
+    lock = threading.Lock()
+    remaining = [requests]
+    latencies = []
+
+    def _work():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+            start = time.time()
+            recurly.Account.get("1")
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=_work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+
+        make_option('--requests',
+            dest='requests',
+            type='int',
+            default=200,
+            help='Number of API calls per run'),
+        make_option('--concurrency',
+            dest='concurrency',
+            type='int',
+            default=1,
+            help='Number of concurrent calling threads'),
+
+        make_option('--certfile',
+            dest='certfile',
+            default=None,
+            help='Certificate for "localhost" used by the stand-in server (default: generated with openssl)'),
+        make_option('--keyfile',
+            dest='keyfile',
+            default=None,
+            help='Private key of --certfile'),
+    )
+
+    help = "Compare API calls with and without the pooled keep-alive transport, against a local TLS stand-in for the Recurly API."
+
+    def handle(self, *args, **options):
+        directory = None
+        certfile, keyfile = options['certfile'], options['keyfile']
+        if not certfile:
+            directory = tempfile.mkdtemp()
+            try:
+                certfile, keyfile = generate_certificate(directory)
+            except (OSError, subprocess.CalledProcessError) as e:
+                shutil.rmtree(directory)
+                raise CommandError("Could not generate a certificate with openssl (%s), use --certfile/--keyfile" % e)
+
+        server = StandInServer(certfile, keyfile or certfile)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        previous_settings = (recurly.API_KEY, recurly.BASE_URI, recurly.VALID_DOMAINS, recurly.CA_CERTS_FILE,
+                             transport.get_pool())
+        recurly.API_KEY = recurly.API_KEY or "benchmark"
+        use_api_base_uri("https://localhost:%d/v2/" % server.server_address[1])
+        recurly.CA_CERTS_FILE = certfile
+
+        print("%-12s %8s %8s %8s %8s %10s" % ("transport", "calls/s", "p50 ms", "p95 ms", "p99 ms", "handshakes"))
+        try:
+            for name, pool in (("default", None), ("pooled", transport.ConnectionPool())):
+                if pool is None:
+                    transport.uninstall()
+                else:
+                    transport.install(pool)
+
+                connections = server.connections
+                start = time.time()
+                latencies = [latency * 1000 for latency in
+                             run_requests(options['requests'], options['concurrency'])]
+                elapsed = time.time() - start
+
+                print("%-12s %8.1f %8.1f %8.1f %8.1f %10d" % (
+                    name,
+                    len(latencies) / elapsed,
+                    percentile(latencies, 50),
+                    percentile(latencies, 95),
+                    percentile(latencies, 99),
+                    server.connections - connections,
+                ))
+        finally:
+            (recurly.API_KEY, recurly.BASE_URI, recurly.VALID_DOMAINS, recurly.CA_CERTS_FILE, previous_pool) = \
+                previous_settings
+            if previous_pool is None:
+                transport.uninstall()
+            else:
+                transport.install(previous_pool)
+            server.shutdown()
+            server.server_close()
+            if directory:
+                shutil.rmtree(directory)
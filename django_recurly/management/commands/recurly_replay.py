@@ -0,0 +1,186 @@
+import base64
+import glob
+import os
+import threading
+import time
+from xml.etree import ElementTree
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from optparse import make_option
+
+from django_recurly import conf, views
+from django_recurly.utils import percentile, use_api_base_uri
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                 "tests", "data", "push_notifications")
+
+
+def load_notifications(directory):
+    """
+    Returns (notification_type, xml) pairs for the files of a directory laid
+    out like tests/data/push_notifications/*/* (or flat).
+    """
+    paths = sorted(glob.glob(os.path.join(directory, "*", "*")) + glob.glob(os.path.join(directory, "*")))
+    notifications = []
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            xml = f.read()
+        try:
+            notification_type = ElementTree.fromstring(xml.strip()).tag
+        except ElementTree.ParseError:
+            continue  # not a notification
+        notifications.append((notification_type, xml))
+    return notifications
+
+
+def replay_notifications(notifications, concurrency=1, rate=None, authentication=None):
+    """
+    POSTs notifications to the push_notifications view, from "concurrency"
+    threads, and at most "rate" requests per second overall.
+
+    Returns a list of (notification_type, status_code, seconds, query_count) tuples.
+    """
+    factory = RequestFactory()
+    extra = {}
+    if authentication:
+        if not isinstance(authentication, bytes):
+            authentication = authentication.encode("utf-8")
+        extra["HTTP_AUTHORIZATION"] = "Basic " + base64.b64encode(authentication).decode("ascii")
+
+    lock = threading.Lock()
+    pending = list(enumerate(notifications))
+    pending.reverse()
+    results = []
+    started = time.time()
+
+    def _post(notification_type, xml):
+        request = factory.post("/notification/", xml, content_type="text/xml", **extra)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            try:
+                status_code = views.push_notifications(request).status_code
+            except Exception:
+                status_code = 500
+            seconds = time.time() - start
+        return notification_type, status_code, seconds, len(queries)
+
+    def _work():
+        try:
+            while True:
+                with lock:
+                    if not pending:
+                        break
+                    index, (notification_type, xml) = pending.pop()
+                if rate:
+                    delay = started + index / float(rate) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                result = _post(notification_type, xml)
+                with lock:
+                    results.append(result)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=_work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+
+        make_option('--directory',
+            dest='directory',
+            default=DEFAULT_DIRECTORY,
+            help='Directory of notification XML files (default: the test fixtures)'),
+        make_option('--repeat',
+            dest='repeat',
+            type='int',
+            default=1,
+            help='Number of times each notification is posted'),
+
+        make_option('--concurrency',
+            dest='concurrency',
+            type='int',
+            default=1,
+            help='Number of concurrent posting threads'),
+        make_option('--rate',
+            dest='rate',
+            type='float',
+            default=None,
+            help='Maximum number of notifications posted per second'),
+
+        make_option('--authentication',
+            dest='authentication',
+            default=conf.HTTP_AUTHENTICATION,
+            help='"user:password" for basic authentication (default: RECURLY_HTTP_AUTHENTICATION)'),
+        make_option('--api-base-uri',
+            dest='api_base_uri',
+            default=None,
+            help='Base URI of the (fake) Recurly API used by notification handlers, eg. http://127.0.0.1:8123/v2/'),
+        make_option('--fake-api',
+            action='store_true',
+            dest='fake_api',
+            default=False,
+            help='Run notification handlers against an in-process fake Recurly API, seeded with the test fixtures'),
+        make_option('--fake-api-latency',
+            dest='fake_api_latency',
+            type='float',
+            default=0,
+            help='Seconds added to each response of the fake Recurly API'),
+        make_option('--fake-api-error-rate',
+            dest='fake_api_error_rate',
+            type='float',
+            default=0,
+            help='Share of responses of the fake Recurly API replaced by a 503 error'),
+    )
+
+    help = "Replay push notifications through the webhook view, and report its throughput, latencies and DB queries. Beware, handlers really run against the configured database and Recurly API."
+
+    def handle(self, *args, **options):
+        notifications = load_notifications(options['directory'])
+        if not notifications:
+            raise CommandError("No notification found in %s" % options['directory'])
+
+        if options['fake_api']:
+            from django_recurly.fake_recurly import fake_recurly_api
+            with fake_recurly_api(latency=options['fake_api_latency'], error_rate=options['fake_api_error_rate']):
+                self.replay(notifications, options)
+            return
+
+        if options['api_base_uri']:
+            use_api_base_uri(options['api_base_uri'])
+        self.replay(notifications, options)
+
+    def replay(self, notifications, options):
+        start = time.time()
+        results = replay_notifications(notifications * options['repeat'],
+                                       concurrency=options['concurrency'],
+                                       rate=options['rate'],
+                                       authentication=options['authentication'])
+        elapsed = time.time() - start
+
+        print("%d notifications posted in %.2fs (%.1f/s), with %d threads." %
+              (len(results), elapsed, len(results) / elapsed, options['concurrency']))
+        print("%-40s %6s %6s %8s %8s %8s %8s" % ("type", "count", "errors", "p50 ms", "p95 ms", "p99 ms", "queries"))
+
+        for notification_type in sorted(set(result[0] for result in results)):
+            type_results = [result for result in results if result[0] == notification_type]
+            latencies = [result[2] * 1000 for result in type_results]
+            print("%-40s %6d %6d %8.1f %8.1f %8.1f %8.1f" % (
+                notification_type,
+                len(type_results),
+                len([result for result in type_results if result[1] >= 400]),
+                percentile(latencies, 50),
+                percentile(latencies, 95),
+                percentile(latencies, 99),
+                sum(result[3] for result in type_results) / float(len(type_results)),
+            ))
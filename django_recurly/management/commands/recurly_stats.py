@@ -0,0 +1,92 @@
+import sys
+import time
+
+from django.core.management import get_commands, load_command_class
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from django_recurly import metrics, resilience, throttling
+
+
+def _reinstall_metrics(install):
+    """
+    (Un)installs metrics under the wrappers of throttling and resilience, as
+    monkey.py does at startup, so that each attempt is recorded without the
+    pacing delays, retries and backoffs.
+    """
+    throttle, breaker = throttling.get_throttle(), resilience.get_breaker()
+    resilience.uninstall()
+    throttling.uninstall()
+    if install:
+        metrics.install()
+    else:
+        metrics.uninstall()
+    if throttle is not None:
+        throttling.install(throttle)
+    if breaker is not None:
+        resilience.install(breaker)
+
+
+def print_stats(by_caller=False):
+    stats = metrics.get_stats(by_caller=by_caller)
+    columns = ("caller",) if by_caller else ()
+    print(("%-40s " * len(columns) + "%-6s %-45s %6s %6s %8s %8s %8s  %s") %
+          (columns + ("method", "endpoint", "calls", "errors", "avg ms", "p95 ms", "KB", "statuses")))
+
+    for key in sorted(stats, key=lambda key: tuple(str(part) for part in key)):
+        endpoint_stats = stats[key]
+        p95 = endpoint_stats.get_percentile_bound(95)
+        print(("%-40s " * len(columns) + "%-6s %-45s %6d %6d %8.1f %8s %8.1f  %s") % (
+            tuple(str(part) for part in key) + (
+                endpoint_stats.count,
+                endpoint_stats.errors,
+                endpoint_stats.seconds * 1000 / endpoint_stats.count,
+                "<=%d" % p95 if p95 is not None else ">%d" % metrics.HISTOGRAM_BUCKETS_MS[-2],
+                endpoint_stats.bytes / 1024.0,
+                ", ".join("%s: %d" % item for item in sorted(endpoint_stats.statuses.items(), key=str)),
+            )))
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+
+        make_option('--by-caller',
+            action='store_true',
+            dest='by_caller',
+            default=False,
+            help='Break down API calls by calling provisioning function'),
+    )
+
+    args = "-- <command> [command options]"
+
+    help = "Run another management command, and report the Recurly API calls it made, per endpoint (eg. recurly_stats -- recurlysync --account 1234)."
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Which command should be run? Eg. recurly_stats -- recurlysync --plans")
+
+        name = args[0]
+        try:
+            app_name = get_commands()[name]
+        except KeyError:
+            raise CommandError("Unknown command: %r" % name)
+        command = load_command_class(app_name, name)
+
+        was_installed = metrics.is_installed()
+        if not was_installed:
+            _reinstall_metrics(install=True)
+        metrics.reset_stats()
+
+        start = time.time()
+        try:
+            command.run_from_argv([sys.argv[0], name] + list(args[1:]))
+        finally:
+            print("")
+            print("Recurly API calls of '%s', in %.2fs:" % (" ".join(args), time.time() - start))
+            print_stats(by_caller=options['by_caller'])
+            counters = resilience.get_counters()
+            if counters:
+                print("Circuit breaker %(state)s: %(failures)d failures, %(retries)d retries, "
+                      "%(rejected)d calls rejected, opened %(opened)d times" % counters)
+            if not was_installed:
+                _reinstall_metrics(install=False)
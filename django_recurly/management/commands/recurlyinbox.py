@@ -0,0 +1,76 @@
+import time
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from django_recurly import conf
+from django_recurly.notifications import process_pending_notifications, \
+    requeue_stale_notifications, purge_processed_notifications, purge_expired_notification_receipts
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+
+        make_option('--batch-size',
+            dest='batch_size',
+            type='int',
+            default=conf.NOTIFICATION_INBOX_BATCH_SIZE,
+            help='Number of notifications claimed at once'),
+        make_option('--shards',
+            dest='shards',
+            type='int',
+            default=conf.WORKER_SHARDS,
+            help='Number of worker threads, notifications being sharded by account'),
+
+        make_option('--loop',
+            action='store_true',
+            dest='loop',
+            default=False,
+            help='Keep waiting for new notifications once the inbox is drained'),
+        make_option('--sleep',
+            dest='sleep',
+            type='float',
+            default=1.0,
+            help='Seconds to wait between polls of an empty inbox, in loop mode'),
+
+        make_option('--purge-days',
+            dest='purge_days',
+            type='int',
+            default=None,
+            help='Delete processed notifications older than this number of days'),
+    )
+
+    help = "Process the push notifications stored in the inbox (see RECURLY_NOTIFICATION_INBOX), by firing the corresponding signals."
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['purge_days'] is not None:
+            deleted = purge_processed_notifications(older_than_days=options['purge_days'])
+            if verbosity:
+                print("Purged %d processed notifications." % deleted)
+
+        deleted = purge_expired_notification_receipts()
+        if verbosity > 1:
+            print("Purged %d expired notification receipts." % deleted)
+
+        total_processed = total_failed = 0
+
+        while True:
+            requeue_stale_notifications()
+            processed, failed = process_pending_notifications(batch_size=options['batch_size'],
+                                                             shards=options['shards'])
+            total_processed += processed
+            total_failed += failed
+
+            if verbosity > 1 and (processed or failed):
+                print("Batch done: %d processed, %d failed." % (processed, failed))
+
+            if processed or failed:
+                continue  # inbox might not be empty yet
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+        if verbosity:
+            print("Inbox drained: %d notifications processed, %d failed." % (total_processed, total_failed))
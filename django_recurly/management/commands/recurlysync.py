@@ -5,8 +5,20 @@ from django.conf import settings
 from optparse import make_option
 
 from django.contrib.auth.models import User
+from django_recurly import conf, throttling
 from django_recurly.utils import dump, recurly
-from django_recurly.models import Account, BillingInfo, Subscription, Payment
+from django_recurly.models import BillingInfo, Payment
+from django_recurly.provisioning import get_linked_account_code, refresh_local_subscription, sync_plan, \
+    sync_plans, update_full_local_data_for_account_code, update_local_account_data_from_recurly_resource, \
+    update_local_subscription_data_from_recurly_resource
+from django_recurly.workers import ShardedProcessPool, ShardedWorkerPool
+
+PROGRESS_INTERVAL = 100  # records
+
+
+def print_progress(done, submitted, failed):
+    if done % PROGRESS_INTERVAL == 0:
+        print("%d/%d records synced so far, %d failed." % (done, submitted, failed))
 
 
 class Command(BaseCommand):
@@ -38,24 +50,89 @@ class Command(BaseCommand):
         make_option('--payment',
             dest='payment',
             help='Sync the specified payment by transaction uuid'),
+        make_option('--verify-payments',
+            action='store_true',
+            dest='verify_payments',
+            default=False,
+            help='Confirm payments mirrored from push notifications only'),
+
+        make_option('--plans',
+            action='store_true',
+            dest='plans',
+            default=False,
+            help='Sync the whole plan catalog (removing local plans deleted in Recurly)'),
+        make_option('--plan',
+            dest='plan',
+            help='Sync the specified plan by plan_code'),
+
+        make_option('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Override local records even if their remote data is unchanged since last sync'),
+
+        make_option('--shards',
+            dest='shards',
+            type='int',
+            default=conf.WORKER_SHARDS,
+            help='Number of worker threads, records being sharded by account'),
+        make_option('--workers',
+            dest='workers',
+            type='int',
+            default=0,
+            help='Number of worker processes (instead of --shards threads), records being sharded by account'),
     )
 
-    help = "Update local Django-Recurly data by querying Recurly. Recurly is assumed to be the point of authority, and this command will overwrite any local discprepancies (unless '--dry-run' is specified)."
+    help = "Update local Django-Recurly data by querying Recurly. Recurly is assumed to be the point of authority, and this command will overwrite any local discprepancies (unless '--dry-run' is specified). Records whose remote data is unchanged since last sync are skipped, so use '--force' to override local changes made meanwhile."
 
     def handle(self, *args, **options):
+        # leave room in the API rate limit for checkouts and other interactive calls
+        previous_priority = throttling.set_default_priority(throttling.BULK)
+        try:
+            self.run(options)
+        finally:
+            throttling.set_default_priority(previous_priority)  # eg. when called by call_command()
+
+    def run(self, options):
+        if options['workers'] > 1:
+            pool = ShardedProcessPool(processes=options['workers'], progress=print_progress)
+            pool.start()  # before any query, as it closes the DB connection
+        else:
+            pool = ShardedWorkerPool(shards=options['shards'])
+
+        # records are processed by the pool while the next pages of them are listed
+        try:
+            something_chosen = self.sync(pool, options)
+        finally:
+            failed_jobs = pool.join()
+
+        # Print help by default
+        if not something_chosen:
+            self.print_help(None, None)
+            sys.exit(1)
+
+        for job in failed_jobs:
+            print("ERROR: Sync failed for account_code %s: %r" % (job.account_code, job.exception))
+        if pool.submitted:
+            print("%d records synced, %d failed." % (pool.submitted - len(failed_jobs), len(failed_jobs)))
+
+    def sync(self, pool, options):
+        """Submits the chosen sync jobs to the pool, runs the others, and returns whether something was chosen."""
         something_chosen = False
 
         # Account(s)
         if options['accounts']:
             something_chosen = True
 
+            owner_map = getattr(settings, 'RECURLY_OWNER_MAP', {})
+
             for recurly_account in recurly.Account.all():
-                if recurly_account.account_code in settings.RECURLY_OWNER_MAP:
+                if recurly_account.account_code in owner_map:
                     try:
                         old, new = (recurly_account.account_code,
-                            settings.RECURLY_OWNER_MAP[recurly_account.account_code])
+                            owner_map[recurly_account.account_code])
                         recurly_account.account_code = User.objects.get(
-                            email=settings.RECURLY_OWNER_MAP[recurly_account.account_code]).pk
+                            email=owner_map[recurly_account.account_code]).pk
                         print("NOTICE: Mapped %s to %s (%s)." % (old, new,
                             recurly_account.account_code))
                     except User.DoesNotExist:
@@ -63,49 +140,62 @@ class Command(BaseCommand):
                               recurly_account.account_code)
                         continue
 
-                try:
-                    account = Account.sync_account(recurly_account=recurly_account)
-                except User.DoesNotExist:
-                    print("No user for Recurly account with account_code %s" % recurly_account.account_code)
+                pool.submit(recurly_account.account_code,
+                            update_local_account_data_from_recurly_resource,
+                            recurly_account=recurly_account, force=options['force'])
 
         if options['account']:
             something_chosen = True
 
-            Account.sync_account(account_code=options['account'])
+            update_full_local_data_for_account_code(account_code=options['account'], force=options['force'])
 
         # Subscription(s)
         if options['subscriptions']:
             something_chosen = True
 
-            # Sync all 'live' subscriptions
-            for recurly_subscription in recurly.Subscription.all_live():
-                subscription = Subscription.sync_subscription(recurly_subscription=recurly_subscription)
-
-            # Now do the same with 'expired' subscriptions
-            for recurly_subscription in recurly.Subscription.all_expired():
-                subscription = Subscription.sync_subscription(recurly_subscription=recurly_subscription)
+            # Sync all 'live' subscriptions, then do the same with 'expired' subscriptions
+            for recurly_subscriptions in (recurly.Subscription.all(state='live'), recurly.Subscription.all(state='expired')):
+                for recurly_subscription in recurly_subscriptions:
+                    pool.submit(get_linked_account_code(recurly_subscription),
+                                update_local_subscription_data_from_recurly_resource,
+                                recurly_subscription=recurly_subscription, force=options['force'])
 
         if options['subscription']:
             something_chosen = True
 
-            Subscription.sync(uuid=options['subscription'])
+            refresh_local_subscription(uuid=options['subscription'], force=options['force'])
 
         # Payment(s)
         if options['payments']:
             something_chosen = True
 
-            for recurly_transaction in recurly.Transaction.all(type='purchase'):
-                payment = Payment.sync_payment(recurly_transaction=recurly_transaction)
-
-            for recurly_transaction in recurly.Transaction.all(type='refund'):
-                payment = Payment.sync_payment(recurly_transaction=recurly_transaction)
+            for transaction_type in ('purchase', 'refund'):
+                for recurly_transaction in recurly.Transaction.all(type=transaction_type):
+                    pool.submit(get_linked_account_code(recurly_transaction),
+                                Payment.sync_payment, recurly_transaction=recurly_transaction,
+                                force=options['force'])
 
         if options['payment']:
             something_chosen = True
 
-            Payment.sync_payment(uuid=options['payment'])
+            Payment.sync_payment(uuid=options['payment'], force=options['force'])
 
-        # Print help by default
-        if not something_chosen:
-            self.print_help(None, None)
-            sys.exit(1)
+        if options['verify_payments']:
+            something_chosen = True
+
+            payments = Payment.objects.filter(needs_verification=True).select_related("account").order_by("id")
+            for payment in payments.iterator():
+                pool.submit(payment.account_id and payment.account.account_code, payment.verify)
+
+        # Plan(s)
+        if options['plans']:
+            something_chosen = True
+
+            sync_plans(force=options['force'])
+
+        if options['plan']:
+            something_chosen = True
+
+            sync_plan(recurly.Plan.get(options['plan']), force=options['force'])
+
+        return something_chosen
@@ -0,0 +1,266 @@
+"""
+Instrumentation of the API calls of the recurly client.
+
+Once installed (see RECURLY_METRICS), each call is recorded with its
+endpoint template (eg. "accounts/{code}/subscriptions"), status, latency and
+response size, and attributed to the innermost calling function declared with
+api_caller() (provisioning functions are). Each ApiCall is then:
+
+- aggregated in this process (see get_stats(), and the "recurly_stats"
+  command which reports the calls made by another command);
+- passed to the sinks of RECURLY_METRICS_SINKS and add_sink(), eg.
+  logging_sink or a make_statsd_sink() callback.
+"""
+import functools
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import recurly
+from django.utils.module_loading import import_string
+from six.moves.urllib.parse import urlsplit
+
+from . import conf
+
+logger = logging.getLogger(__name__)
+
+ApiCall = namedtuple("ApiCall", "method endpoint status seconds bytes caller")
+
+# upper bounds (in ms) of latency histogram buckets, the last one being unbounded
+HISTOGRAM_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, None)
+
+# placeholders of identifiers following collections in API paths, "{uuid}" by default
+ENDPOINT_PLACEHOLDERS = {
+    "accounts": "{code}",
+    "add_ons": "{code}",
+    "coupons": "{code}",
+    "invoices": "{number}",
+    "plans": "{code}",
+}
+
+
+def get_endpoint_template(url):
+    """Returns the API path of a URL, with identifiers replaced by placeholders."""
+    path = urlsplit(url).path.strip("/")
+    parts = path.split("/")
+    if parts and parts[0] in ("v2", "v3"):
+        parts = parts[1:]
+    for index in range(1, len(parts), 2):  # collection/id/collection/id...
+        parts[index] = ENDPOINT_PLACEHOLDERS.get(parts[index - 1], "{uuid}")
+    return "/".join(parts)
+
+
+## Attribution of calls ##
+
+_local = threading.local()
+
+
+def get_current_caller():
+    callers = getattr(_local, "callers", None)
+    return callers[-1] if callers else None
+
+
+@contextmanager
+def api_caller(name):
+    """Attributes the API calls made within this block (by this thread) to "name"."""
+    callers = getattr(_local, "callers", None)
+    if callers is None:
+        callers = _local.callers = []
+    callers.append(name)
+    try:
+        yield
+    finally:
+        callers.pop()
+
+
+def attribute_calls(func):
+    """Decorator attributing the API calls made by a function to its name."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with api_caller(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def bind_caller(func):
+    """Wraps func so that, run in another thread, its calls are attributed to the current caller."""
+    caller = get_current_caller()
+    if caller is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with api_caller(caller):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+## Aggregation ##
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.statuses = {}
+        self.histogram = [0] * len(HISTOGRAM_BUCKETS_MS)
+
+    def add(self, call):
+        self.count += 1
+        if call.status is None or call.status >= 400:
+            self.errors += 1
+        self.seconds += call.seconds
+        self.bytes += call.bytes
+        self.statuses[call.status] = self.statuses.get(call.status, 0) + 1
+        milliseconds = call.seconds * 1000
+        for index, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if bound is None or milliseconds <= bound:
+                self.histogram[index] += 1
+                break
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.histogram = [a + b for (a, b) in zip(self.histogram, other.histogram)]
+
+    def get_percentile_bound(self, percent):
+        """Upper bound (in ms, None if unbounded) of the histogram bucket holding this percentile."""
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS_MS, self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+
+_stats_lock = threading.Lock()
+_stats = {}  # (caller, method, endpoint) -> EndpointStats
+
+
+def _aggregate(call):
+    key = (call.caller, call.method, call.endpoint)
+    with _stats_lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = EndpointStats()
+        stats.add(call)
+
+
+def get_stats(by_caller=False):
+    """
+    Returns a copy of the stats of this process, as a dict of EndpointStats
+    keyed by (method, endpoint), or (caller, method, endpoint) if by_caller.
+    """
+    result = {}
+    with _stats_lock:
+        for (caller, method, endpoint), stats in _stats.items():
+            key = (caller, method, endpoint) if by_caller else (method, endpoint)
+            result.setdefault(key, EndpointStats()).merge(stats)
+    return result
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+## Sinks ##
+
+_sinks = []
+
+
+def add_sink(sink):
+    """Registers a callable receiving each ApiCall."""
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+def logging_sink(call):
+    logger.info("Recurly API %s %s: %s in %.1f ms, %d bytes (%s)", call.method, call.endpoint,
+                call.status, call.seconds * 1000, call.bytes, call.caller)
+
+
+def make_statsd_sink(client, prefix="recurly"):
+    """
+    Returns a sink for statsd-like clients (having incr() and timing() methods),
+    eg. "recurly.GET.accounts.code.subscriptions.200".
+    """
+    def statsd_sink(call):
+        name = "%s.%s.%s" % (prefix, call.method, call.endpoint.replace("/", ".").replace("{", "").replace("}", ""))
+        client.incr("%s.%s" % (name, call.status or "error"))
+        client.timing(name, call.seconds * 1000)
+    return statsd_sink
+
+
+def record(method, url, status, seconds, size, caller=None):
+    call = ApiCall(method, get_endpoint_template(url), status, seconds, size,
+                   caller if caller is not None else get_current_caller())
+    _aggregate(call)
+    for sink in _sinks:
+        try:
+            sink(call)
+        except Exception:
+            logger.exception("Metrics sink %r failed", sink)
+    return call
+
+
+## Instrumentation of the client ##
+
+_original_http_request = recurly.Resource.__dict__["http_request"]
+_wrapped_http_request = _original_http_request  # the implementation in place when installed
+_installed = False
+
+
+def _get_response_size(response):
+    try:
+        return int(response.getheader("content-length") or 0)
+    except (AttributeError, ValueError):
+        return 0
+
+
+def _instrumented_http_request(cls, url, method='GET', body=None, headers=None):
+    start = time.time()
+    response = None
+    try:
+        response = _wrapped_http_request.__get__(None, cls)(url, method, body, headers)
+        return response
+    finally:
+        record(method, url, getattr(response, "status", None), time.time() - start,
+               _get_response_size(response) if response is not None else 0)
+
+
+def is_installed():
+    return _installed
+
+
+def install():
+    """Instruments the recurly client, and loads the sinks of RECURLY_METRICS_SINKS."""
+    global _wrapped_http_request, _installed
+    if _installed:
+        return
+    for sink in conf.METRICS_SINKS:
+        add_sink(import_string(sink) if isinstance(sink, str) else sink)
+    _wrapped_http_request = recurly.Resource.__dict__["http_request"]
+    recurly.Resource.http_request = classmethod(_instrumented_http_request)
+    _installed = True
+
+
+def uninstall():
+    """Restores the previous implementation (wrappers installed since then must be uninstalled first)."""
+    global _installed
+    if _installed:
+        recurly.Resource.http_request = _wrapped_http_request
+        _installed = False
+    del _sinks[:]
@@ -0,0 +1,17 @@
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:  # Django < 1.10
+    MiddlewareMixin = object
+
+from django_recurly import cache
+
+
+class RecurlyResourceCacheMiddleware(MiddlewareMixin):
+    """Fetches each remote Recurly account or subscription at most once per request."""
+
+    def process_request(self, request):
+        cache.begin_request_scope()
+
+    def process_response(self, request, response):
+        cache.end_request_scope()
+        return response
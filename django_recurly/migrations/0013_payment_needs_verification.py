@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-17 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_recurly', '0012_notificationreceipt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='needs_verification',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
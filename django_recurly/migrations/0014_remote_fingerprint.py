@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-17 13:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_recurly', '0013_payment_needs_verification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='remote_fingerprint',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='billinginfo',
+            name='remote_fingerprint',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='remote_fingerprint',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='remote_fingerprint',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
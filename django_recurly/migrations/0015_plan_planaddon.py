@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-17 16:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_recurly', '0014_remote_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Plan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('plan_code', models.CharField(max_length=50, unique=True)),
+                ('name', models.CharField(blank=True, max_length=255, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('plan_interval_length', models.IntegerField(blank=True, null=True)),
+                ('plan_interval_unit', models.CharField(blank=True, max_length=20, null=True)),
+                ('trial_interval_length', models.IntegerField(blank=True, null=True)),
+                ('trial_interval_unit', models.CharField(blank=True, max_length=20, null=True)),
+                ('total_billing_cycles', models.IntegerField(blank=True, null=True)),
+                ('unit_amount_in_cents', models.TextField(blank=True, null=True)),
+                ('setup_fee_in_cents', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(blank=True, null=True)),
+                ('remote_fingerprint', models.CharField(blank=True, max_length=40, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='PlanAddOn',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('add_on_code', models.CharField(max_length=200)),
+                ('name', models.CharField(blank=True, max_length=255, null=True)),
+                ('default_quantity', models.IntegerField(blank=True, null=True)),
+                ('optional', models.NullBooleanField(default=None)),
+                ('unit_amount_in_cents', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(blank=True, null=True)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='plan_add_ons', to='django_recurly.Plan')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='planaddon',
+            unique_together=set([('plan', 'add_on_code')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-17 18:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_recurly', '0015_plan_planaddon'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='remote_etag',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='remote_last_modified',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='remote_etag',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='remote_last_modified',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
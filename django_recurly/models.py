@@ -1,6 +1,7 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import Case, Value, When
 from django.db.models import Q
 from django.contrib.auth.models import User
 from django_extensions.db.models import TimeStampedModel
@@ -10,16 +11,20 @@ from django.core.exceptions import ValidationError
 
 from django_recurly import monkey  # patches recurly client
 from django_recurly import conf
+from django_recurly import cache as resource_cache
 from django_recurly.utils import recurly
 # Do these here to ensure the handlers get hooked up
 from django_recurly import handlers
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save
 import importlib
+import json
+import operator
+from xml.etree import ElementTree
 
 import logging, sys
 logger = logging.getLogger(__name__)
 
-__all__ = ("Account", "Subscription", "User", "Payment", "Token")
+__all__ = ("Account", "Subscription", "User", "Payment", "Token", "Plan", "PlanAddOn")
 
 
 BLANKABLE_FIELD_ARGS = dict(blank=True, null=True)
@@ -66,26 +71,152 @@ class LiveSubscriptionsManager(models.Manager):
                 .filter(Q(state__in=Subscription.LIVE_STATES)))
 
 
+class SaveDirtyQuerySet(models.QuerySet):
+
+    def _bulk_update(self, instances, field_names):
+        """Writes the given columns of saved instances, with one UPDATE ... CASE query per batch."""
+        fields = [self.model._meta.get_field(name) for name in field_names]
+        batch_size = max(1, connections[self.db].ops.bulk_batch_size(["pk", "pk"] + fields, instances))
+
+        for start in range(0, len(instances), batch_size):
+            batch = instances[start:start + batch_size]
+            updates = {}
+            for field in fields:
+                whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field))
+                         for obj in batch]
+                updates[field.name] = Case(*whens, output_field=field)
+            self.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
+
+    def bulk_save_dirty(self, instances):
+        """
+        Saves many SaveDirtyModel instances at once: new ones with a single
+        bulk_create(), and modified ones with one UPDATE per set of dirty
+        fields. Unmodified instances are skipped. pre_save and post_save
+        signals are sent as by save().
+
+        Primary keys of created instances are set when the DB backend
+        supports it, or when the model has a UNIQUE_LOOKUP_FIELD. Else they
+        can't be told apart from new instances: no post_save signal is sent
+        for them, and they mustn't be saved again.
+
+        Returns the (created, updated) lists of instances.
+        """
+        created = []
+        updated_by_fields = {}
+        seen = set()
+        for obj in instances:
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            if not obj.pk or obj._state.adding:
+                created.append(obj)
+            elif obj.is_dirty():
+                for field in obj._meta.concrete_fields:
+                    if getattr(field, "auto_now", False):
+                        field.pre_save(obj, add=False)
+                updated_by_fields.setdefault(tuple(sorted(obj._get_update_fields())), []).append(obj)
+
+        if not created and not updated_by_fields:
+            return [], []
+
+        for obj in created:
+            pre_save.send(sender=self.model, instance=obj, raw=False, using=self.db, update_fields=None)
+        for (field_names, objs) in updated_by_fields.items():
+            for obj in objs:
+                pre_save.send(sender=self.model, instance=obj, raw=False, using=self.db,
+                              update_fields=frozenset(field_names))
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            if created:
+                self.bulk_create(created)
+                unique_field = getattr(self.model, "UNIQUE_LOOKUP_FIELD", None)
+                if unique_field and any(obj.pk is None for obj in created):
+                    pks = dict(self.filter(**{unique_field + "__in": [getattr(obj, unique_field) for obj in created]})
+                               .order_by().values_list(unique_field, "pk"))
+                    for obj in created:
+                        obj.pk = pks[getattr(obj, unique_field)]
+                for obj in created:
+                    if obj.pk is not None:
+                        obj._state.adding = False
+                        obj._state.db = self.db
+
+            for (field_names, objs) in updated_by_fields.items():
+                self._bulk_update(objs, field_names)
+
+        # same bookkeeping as SaveDirtyModel.save()
+        updated = []
+        for (field_names, objs) in updated_by_fields.items():
+            for obj in objs:
+                obj._take_state_snapshot()
+                post_save.send(sender=self.model, instance=obj, created=False,
+                               update_fields=frozenset(field_names), raw=False, using=self.db)
+            updated.extend(objs)
+        for obj in created:
+            if obj._state.adding:
+                continue  # unknown primary key
+            obj._take_state_snapshot()
+            post_save.send(sender=self.model, instance=obj, created=True,
+                           update_fields=None, raw=False, using=self.db)
+
+        return created, updated
+
+
+SaveDirtyManager = models.Manager.from_queryset(SaveDirtyQuerySet)
+
+
 class SaveDirtyModel(models.Model):
     """Save only when new or modified."""
 
+    objects = SaveDirtyManager()
+
     SMART_SAVE_FORCE = False
     SMART_SAVE_IGNORE_FIELDS = ()
 
     class Meta:
         abstract = True
 
+    _partial_save = False  # whether save() is only writing dirty columns
+
     def __init__(self, *args, **kwargs):
         super(SaveDirtyModel, self).__init__(*args, **kwargs)
-        self._original_state = self._as_dict()
-        self._previous_state = self._original_state
+        # compact snapshots, see _get_tracked_fields()
+        self._original_values = self._get_tracked_values()
+        self._previous_values = self._original_values
+
+    @classmethod
+    def _get_tracked_fields(cls):
+        """
+        Returns the names of the fields whose changes are tracked, and a
+        getter returning their current values as a tuple, computed once per class.
+        """
+        if "_tracked_fields" not in cls.__dict__:
+            fields = [field for field in cls._meta.fields  # m2m changes do not require a save
+                      if field.name not in cls.SMART_SAVE_IGNORE_FIELDS]
+            names = tuple(field.name for field in fields)
+            getter = operator.attrgetter(*[field.attname for field in fields])
+            if len(fields) == 1:
+                getter = lambda instance, _getter=getter: (_getter(instance),)
+            cls._tracked_fields = (names, getter)
+        return cls._tracked_fields
+
+    def _get_tracked_values(self):
+        return self._get_tracked_fields()[1](self)
+
+    def _take_state_snapshot(self):
+        """To be called once the current state of the instance is saved in DB."""
+        self._previous_values = self._original_values
+        self._original_values = self._get_tracked_values()
+
+    @property
+    def _original_state(self):
+        return dict(zip(self._get_tracked_fields()[0], self._original_values))
+
+    @property
+    def _previous_state(self):
+        return dict(zip(self._get_tracked_fields()[0], self._previous_values))
 
     def _iter_fields(self):
-        for field in self._meta.fields:  # m2m changes do not require a save
-            if field.name in self.SMART_SAVE_IGNORE_FIELDS:
-                continue
-            field_name = ('%s_id' % field.name) if field.rel else field.name
-            yield (field.name, getattr(self, field_name))
+        return zip(self._get_tracked_fields()[0], self._get_tracked_values())
 
     def _as_dict(self):
         return dict(self._iter_fields())
@@ -93,30 +224,53 @@ class SaveDirtyModel(models.Model):
     def is_dirty(self):
         if not self.pk:
             return True
-        for field, value in self._iter_fields():
-            if value != self._original_state[field]:
-                return True
-        return False
+        return self._get_tracked_values() != self._original_values
 
     def dirty_fields(self, names_only=False):
         diff = [] if names_only else {}
-        for field, value in self._iter_fields():
-            if value != self._original_state[field]:
+        names = self._get_tracked_fields()[0]
+        for field, value, original_value in zip(names, self._get_tracked_values(), self._original_values):
+            if value != original_value:
                 if names_only:
                     diff.append(field)
                 else:
                     diff[field] = {
                         'new': value,
-                        'old': self._original_state[field],
+                        'old': original_value,
                     }
         return diff
 
+    def _get_update_fields(self):
+        """Columns to write when saving this existing instance."""
+        update_fields = set(self.dirty_fields(names_only=True))
+        update_fields.update(self.SMART_SAVE_IGNORE_FIELDS)  # changes of these are not tracked
+        update_fields.update(field.name for field in self._meta.concrete_fields
+                             if getattr(field, "auto_now", False))
+        return update_fields
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        updated = super(SaveDirtyModel, self)._do_update(base_qs, using, pk_val, values, update_fields,
+                                                         forced_update)
+        if not updated and self._partial_save:
+            # the row was deleted meanwhile (eg. by a concurrent sync): insert it again whole, like a full save
+            self._do_insert(type(self)._base_manager, using, self._meta.local_concrete_fields,
+                            update_pk=False, raw=False)
+            updated = True
+        return updated
+
     def save(self, *args, **kwargs):
         self._force_save = kwargs.pop('force', self.SMART_SAVE_FORCE)
         if self._force_save or self.is_dirty():
-            super(SaveDirtyModel, self).save(*args, **kwargs)
-            self._previous_state = self._original_state
-            self._original_state = self._as_dict()
+            self._partial_save = bool(not self._force_save and self.pk and not self._state.adding and not args
+                                      and not kwargs.get('force_insert') and kwargs.get('update_fields') is None)
+            if self._partial_save:
+                # only send modified columns (and not eg. big "xml" fields)
+                kwargs['update_fields'] = self._get_update_fields()
+            try:
+                super(SaveDirtyModel, self).save(*args, **kwargs)
+            finally:
+                self._partial_save = False
+            self._take_state_snapshot()
         else:
             logger.debug("Skipping save for %s (pk: %s) because it hasn't changed.", self.__class__.__name__, self.pk or "None")
 
@@ -164,7 +318,14 @@ class Account(SaveDirtyModel, TimeStampedModel):
     updated_at = models.DateTimeField(**BLANKABLE_FIELD_ARGS)
     closed_at = models.DateTimeField(**BLANKABLE_FIELD_ARGS)
 
-    objects = models.Manager()
+    # sha1 of the remote XML payload last mirrored, allowing modelify to skip unchanged records
+    remote_fingerprint = models.CharField(max_length=40, **BLANKABLE_CHARFIELD_ARGS)
+
+    # HTTP validators of the remote resource last fetched, for conditional GETs (see provisioning.py)
+    remote_etag = models.CharField(max_length=255, **BLANKABLE_CHARFIELD_ARGS)
+    remote_last_modified = models.CharField(max_length=64, **BLANKABLE_CHARFIELD_ARGS)
+
+    objects = SaveDirtyManager()
     active = ActiveAccountManager()
 
     class Meta:
@@ -308,9 +469,15 @@ class Account(SaveDirtyModel, TimeStampedModel):
                 rented_movie_ids.append(subscription_add_on.add_on_code.partition("movie_")[2])
         return rented_movie_ids
 
-    def get_recurly_account(self):
-        # TODO: (IW) Cache/store account object
-        return recurly.Account.get(self.account_code)
+    def get_recurly_account(self, cached=True):
+        """
+        Returns the remote account, from the resource cache unless cached=False
+        (which must be used before modifying it, see cache.py).
+        """
+        if not cached:
+            resource_cache.invalidate(account_code=self.account_code)
+            return recurly.Account.get(self.account_code)
+        return resource_cache.get_account(self.account_code)
 
     def get_recurly_invoices(self):
         return self.get_recurly_account().invoices()
@@ -467,6 +634,9 @@ class BillingInfo(SaveDirtyModel):
 
     updated_at = models.DateTimeField(**BLANKABLE_FIELD_ARGS)
 
+    # sha1 of the remote XML payload last mirrored, allowing modelify to skip unchanged records
+    remote_fingerprint = models.CharField(max_length=40, **BLANKABLE_CHARFIELD_ARGS)
+
     @property
     def billing_type(self):
         if self.paypal_billing_agreement_id:
@@ -540,6 +710,7 @@ class BillingInfo(SaveDirtyModel):
         self.last_four = None
         self.paypal_billing_agreement_id = None
         self.updated_at = None
+        self.remote_fingerprint = None
         self.save()
 
 
@@ -597,7 +768,14 @@ class Subscription(SaveDirtyModel):
 
     xml = models.TextField(**BLANKABLE_FIELD_ARGS)
 
-    objects = models.Manager()
+    # sha1 of the remote XML payload last mirrored, allowing modelify to skip unchanged records
+    remote_fingerprint = models.CharField(max_length=40, **BLANKABLE_CHARFIELD_ARGS)
+
+    # HTTP validators of the remote resource last fetched, for conditional GETs (see provisioning.py)
+    remote_etag = models.CharField(max_length=255, **BLANKABLE_CHARFIELD_ARGS)
+    remote_last_modified = models.CharField(max_length=64, **BLANKABLE_CHARFIELD_ARGS)
+
+    objects = SaveDirtyManager()
     live_subscriptions = LiveSubscriptionsManager()
 
     class Meta:
@@ -652,9 +830,15 @@ class Subscription(SaveDirtyModel):
             return True
         return False
 
-    def get_recurly_subscription(self):
-        # TODO: (IW) Cache/store subscription object
-        return recurly.Subscription.get(self.uuid)
+    def get_recurly_subscription(self, cached=True):
+        """
+        Returns the remote subscription, from the resource cache unless
+        cached=False (which must be used before modifying it, see cache.py).
+        """
+        if not cached:
+            resource_cache.invalidate(subscription_uuid=self.uuid)
+            return recurly.Subscription.get(self.uuid)
+        return resource_cache.get_subscription(self.uuid)
 
     def get_pending_subscription_or_none(self):
         recurly_subscription = self.get_recurly_subscription()
@@ -741,7 +925,7 @@ class Subscription(SaveDirtyModel):
     def reactivate(self):
         """Reactivate the canceled subscription so it renews at the end of the
         current billing cycle"""
-        recurly_subscription = self.get_recurly_subscription()
+        recurly_subscription = self.get_recurly_subscription(cached=False)
         if recurly_subscription.state == 'canceled':
             recurly_subscription.reactivate()
 
@@ -791,7 +975,14 @@ class Subscription(SaveDirtyModel):
 
     @classmethod
     def __get_plans(class_):
-        return [plan.name for plan in recurly.Plan.all()]
+        """
+        Names of the plans of the local catalog, which is only mirrored here
+        if empty: "recurlysync --plans" must run periodically to refresh it.
+        """
+        if not Plan.objects.exists():
+            from django_recurly.provisioning import sync_plans
+            sync_plans()  # empty mirror
+        return list(Plan.objects.order_by("id").values_list("name", flat=True))
 
     @classmethod
     def ______sync_subscription(class_, recurly_subscription=None, uuid=None):
@@ -831,6 +1022,64 @@ class SubscriptionAddOn(SaveDirtyModel):
     address = models.CharField(max_length=200, **BLANKABLE_CHARFIELD_ARGS)
 
 
+def _load_amounts(amounts):
+    return json.loads(amounts) if amounts else {}
+
+
+class Plan(SaveDirtyModel):
+    """Local mirror of the plan catalog, see provisioning.get_local_plan()."""
+
+    UNIQUE_LOOKUP_FIELD = "plan_code"
+
+    plan_code = models.CharField(max_length=50, unique=True)
+    name = models.CharField(max_length=255, **BLANKABLE_CHARFIELD_ARGS)
+    description = models.TextField(**BLANKABLE_FIELD_ARGS)
+    plan_interval_length = models.IntegerField(**BLANKABLE_FIELD_ARGS)
+    plan_interval_unit = models.CharField(max_length=20, **BLANKABLE_CHARFIELD_ARGS)
+    trial_interval_length = models.IntegerField(**BLANKABLE_FIELD_ARGS)
+    trial_interval_unit = models.CharField(max_length=20, **BLANKABLE_CHARFIELD_ARGS)
+    total_billing_cycles = models.IntegerField(**BLANKABLE_FIELD_ARGS)
+
+    # JSON mappings of amounts per currency, eg. {"EUR": 800, "USD": 1000}
+    unit_amount_in_cents = models.TextField(**BLANKABLE_FIELD_ARGS)
+    setup_fee_in_cents = models.TextField(**BLANKABLE_FIELD_ARGS)
+
+    created_at = models.DateTimeField(**BLANKABLE_FIELD_ARGS)
+    updated_at = models.DateTimeField(**BLANKABLE_FIELD_ARGS)
+
+    # sha1 of the remote XML payload last mirrored, allowing modelify to skip unchanged records
+    remote_fingerprint = models.CharField(max_length=40, **BLANKABLE_CHARFIELD_ARGS)
+
+    def __str__(self):
+        return self.plan_code
+
+    def get_unit_amounts_in_cents(self):
+        return _load_amounts(self.unit_amount_in_cents)
+
+    def get_setup_fees_in_cents(self):
+        return _load_amounts(self.setup_fee_in_cents)
+
+
+class PlanAddOn(SaveDirtyModel):
+    plan = models.ForeignKey(Plan, related_name="plan_add_ons")
+    add_on_code = models.CharField(max_length=200)
+    name = models.CharField(max_length=255, **BLANKABLE_CHARFIELD_ARGS)
+    default_quantity = models.IntegerField(**BLANKABLE_FIELD_ARGS)
+    optional = models.NullBooleanField(default=None)
+
+    # JSON mapping of amounts per currency, eg. {"EUR": 800, "USD": 1000}
+    unit_amount_in_cents = models.TextField(**BLANKABLE_FIELD_ARGS)
+
+    created_at = models.DateTimeField(**BLANKABLE_FIELD_ARGS)
+    updated_at = models.DateTimeField(**BLANKABLE_FIELD_ARGS)
+
+    class Meta:
+        unique_together = ("plan", "add_on_code")
+
+    def get_unit_amounts_in_cents(self):
+        return _load_amounts(self.unit_amount_in_cents)
+
+
 # TODO - update fields of this model according to recurly.Transaction
 class Payment(SaveDirtyModel):
 
@@ -871,6 +1120,12 @@ class Payment(SaveDirtyModel):
     details = models.TextField(**BLANKABLE_FIELD_ARGS)
     xml = models.TextField(**BLANKABLE_FIELD_ARGS)
 
+    # Set when built from push notification data only (see RECURLY_TRUST_PAYMENT_NOTIFICATIONS)
+    needs_verification = models.BooleanField(default=False, db_index=True)
+
+    # sha1 of the remote XML payload last mirrored, allowing modelify to skip unchanged records
+    remote_fingerprint = models.CharField(max_length=40, **BLANKABLE_CHARFIELD_ARGS)
+
     class Meta:
         ordering = ["-id"]
         get_latest_by = "id"
@@ -882,12 +1137,12 @@ class Payment(SaveDirtyModel):
         return recurly.Invoice.get(self.invoice_id)
 
     @classmethod
-    def sync_payment(class_, recurly_transaction=None, uuid=None):
+    def sync_payment(class_, recurly_transaction=None, uuid=None, force=False):
         if recurly_transaction is None:
             recurly_transaction = recurly.Transaction.get(uuid)
 
         logger.debug("Payment.sync: %s", recurly_transaction.uuid)
-        payment = modelify(recurly_transaction, class_, remove_empty=True, follow=['account'])
+        payment = modelify(recurly_transaction, class_, remove_empty=True, follow=['account'], force=force)
         payment.xml = recurly_transaction.as_log_output(full=True)
 
         if payment.invoice_id is None:
@@ -907,6 +1162,9 @@ class Payment(SaveDirtyModel):
 
     @classmethod
     def handle_notification(class_, **kwargs):
+        if conf.TRUST_PAYMENT_NOTIFICATIONS:
+            return class_.create_from_notification(**kwargs)
+
         # Get latest transaction details from Recurly
         recurly_transaction = recurly.Transaction.get(kwargs.get("transaction").id)
 
@@ -928,6 +1186,63 @@ class Payment(SaveDirtyModel):
 
         return payment
 
+    @classmethod
+    def create_from_notification(class_, **kwargs):
+        """Create or update a payment from the transaction data of a push
+        notification, without any remote call.
+
+        The payment is flagged with needs_verification, so that it gets
+        confirmed later against the Recurly API (see verify()).
+        """
+        notification_transaction = kwargs.get("transaction")
+        notification_account = kwargs.get("account")
+
+        def _get(name):
+            return getattr(notification_transaction, name, None)
+
+        payment = class_.objects.filter(transaction_id=_get("id")).first()
+        if payment is None:
+            payment = class_(transaction_id=_get("id"))
+
+        if notification_account is not None:
+            payment.account = Account.objects.filter(account_code=notification_account.account_code).first()
+
+        payment.invoice_id = _get("invoice_id") or payment.invoice_id
+        payment.action = (_get("action") or "").lower()
+        payment.status = (_get("status") or "").lower()
+        payment.amount_in_cents = _get("amount_in_cents")
+        payment.created_at = _get("date")
+        payment.message = _get("message") or ""
+        payment.reference = _get("reference") or None
+
+        xml = kwargs.get("xml")
+        payment.xml = xml.decode("utf-8") if isinstance(xml, bytes) else xml
+
+        payment.needs_verification = True
+        payment.remote_fingerprint = None
+        payment.save()
+        return payment
+
+    def verify(self):
+        """Override the data of this payment with the current state of its
+        remote transaction, and clear its needs_verification flag.
+
+        The payment is also linked to its account, if it was mirrored since
+        the notification."""
+        from django_recurly.provisioning import get_linked_account_code, modelify
+
+        recurly_transaction = self.get_transaction()
+        payment = modelify(recurly_transaction, Payment, existing_instance=self, remove_empty=True, save=False)
+        payment.invoice_id = recurly_transaction.invoice().uuid
+        payment.xml = ElementTree.tostring(recurly_transaction._elem).decode("utf-8")  # as fetched
+        if payment.account_id is None:
+            account_code = get_linked_account_code(recurly_transaction)
+            if account_code is not None:
+                payment.account = Account.objects.filter(account_code=account_code).first()
+        payment.needs_verification = False
+        payment.save()
+        return payment
+
 
 class Token(TimeStampedModel):
     """Tokens are returned from successful Recurly.js submissions as a way to
@@ -947,6 +1262,48 @@ class Token(TimeStampedModel):
     xml = models.TextField(**BLANKABLE_FIELD_ARGS)
 
 
+class PushNotification(TimeStampedModel):
+    """
+    Inbox of raw push notifications received from Recurly.
+
+    Used when RECURLY_NOTIFICATION_INBOX is enabled: the webhook view only
+    stores the notification body here, and the "recurlyinbox" management
+    command later dispatches it to the usual signal handlers.
+    """
+
+    NOTIFICATION_STATES = (
+        ("pending", "Pending"),         # Waiting to be processed
+        ("processing", "Processing"),   # Claimed by a worker
+        ("processed", "Processed"),     # Signals fired successfully
+        ("failed", "Failed"),           # Gave up after too many attempts
+    )
+
+    notification_type = models.CharField(max_length=100)
+    account_code = models.CharField(max_length=50, db_index=True, **BLANKABLE_CHARFIELD_ARGS)
+
+    state = models.CharField(max_length=20, default="pending", choices=NOTIFICATION_STATES, db_index=True)
+    claim_token = models.CharField(max_length=32, db_index=True, **BLANKABLE_CHARFIELD_ARGS)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(**BLANKABLE_FIELD_ARGS)
+    processed_at = models.DateTimeField(**BLANKABLE_FIELD_ARGS)
+
+    xml = models.TextField()
+
+    class Meta:
+        ordering = ["id"]
+        get_latest_by = "id"
+
+
+class NotificationReceipt(models.Model):
+    """
+    Ledger of recently received push notifications, used to ignore the
+    redeliveries of Recurly when RECURLY_NOTIFICATION_LEDGER is enabled.
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    notification_type = models.CharField(max_length=100)
+    account_code = models.CharField(max_length=50, **BLANKABLE_CHARFIELD_ARGS)
+    received_at = models.DateTimeField(default=timezone.now, db_index=True)
+
 
 class GiftCardMemo(TimeStampedModel):
     """
@@ -2,6 +2,8 @@
 import six
 import recurly.errors
 
+from django_recurly import conf, metrics, resilience, throttling, transport
+
 # these errors don't have proper python3 compatibility
 
 def validationerror__unicode__(self):
@@ -31,3 +33,37 @@ def __getpath_fixed__(self, name):
 assert recurly.Subscription.__getpath__
 recurly.Subscription.__getpath__ = __getpath_fixed__
 recurly.Subscription.attributes += ("plan_name",)
+
+
+# the refresh of resources from the XML returned by writes only drops the local
+# values of declared attributes, so others (eg. the full BillingInfo given at
+# account creation, or an Account "address") kept shadowing the returned data
+
+_original_update_from_element = recurly.Resource.update_from_element
+
+def update_from_element_fixed(self, elem):
+    for name in list(self.__dict__):
+        if not name.startswith("_") and not hasattr(type(self), name):
+            del self.__dict__[name]
+    return _original_update_from_element(self, elem)
+
+recurly.Resource.update_from_element = update_from_element_fixed
+
+
+# keep-alive connections to the Recurly API
+if conf.HTTP_POOL_SIZE:
+    transport.install()
+
+# per-endpoint counts and latencies of API calls
+if conf.METRICS:
+    metrics.install()
+
+# pacing of bulk API calls against the rate limit (installed after metrics,
+# so that they record each attempt, without the pacing delays)
+if conf.THROTTLE:
+    throttling.install()
+
+# retries of idempotent calls and circuit breaker (outermost, so that calls
+# fail fast without waiting for the rate limit when Recurly is down)
+if conf.RETRY_ATTEMPTS or conf.CIRCUIT_BREAKER_THRESHOLD:
+    resilience.install()
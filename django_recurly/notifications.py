@@ -0,0 +1,394 @@
+"""
+Dispatching of Recurly push notifications to django signals.
+
+Notifications are either dispatched inline by the webhook view, or stored in
+the PushNotification inbox (see RECURLY_NOTIFICATION_INBOX) and dispatched
+later, in batches, by the "recurlyinbox" management command.
+
+In the latter case, bursts of notifications concerning the same account can
+be coalesced (see RECURLY_NOTIFICATION_COALESCE_WINDOW): the remote data is
+then sync'ed once for the whole group, and signals are fired with an extra
+"coalesced=True" argument so that the default handlers skip their own sync.
+
+Redeliveries of already received notifications can be ignored thanks to a
+ledger of notification digests (see RECURLY_NOTIFICATION_LEDGER).
+"""
+import datetime
+import hashlib
+import logging
+import threading
+import uuid
+from xml.etree import ElementTree
+
+from django.db import IntegrityError, transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from . import cache as resource_cache
+from . import conf, handlers, provisioning, signals
+from .exceptions import InvalidNotificationError
+from .models import NotificationReceipt, Payment, PushNotification
+from .utils import recurly
+from .workers import ShardedWorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+def _get_notification_signal(notification_type):
+    signal = getattr(signals, notification_type, None)
+    if not isinstance(signal, Signal):
+        raise InvalidNotificationError(notification_type)
+    return signal
+
+
+def parse_notification(xml):
+    """
+    Returns the objects extracted from a raw notification body.
+    """
+    objects = recurly.objects_for_push_notification(xml.strip())
+    _get_notification_signal(objects['type'])
+    return objects
+
+
+def send_notification_signals(xml, objects, **extra):
+    signal = _get_notification_signal(objects['type'])
+
+    account = objects.get('account')
+    logger.debug("Received Recurly push notification (type: '%s', account_code: '%s')",
+                 objects['type'], getattr(account, "account_code", None))
+
+    # cached remote data of the account is outdated
+    resource_cache.invalidate(account_code=getattr(account, "account_code", None),
+                              subscription_uuid=getattr(objects.get('subscription'), "uuid", None))
+
+    signals.push_notification.send(sender=recurly, xml=xml, **dict(objects, **extra))
+    signal.send(sender=recurly, xml=xml, **dict(objects, **extra))
+
+
+def dispatch_notification(xml):
+    """
+    Parses a raw notification body, and fires the corresponding signals.
+
+    Returns the objects extracted from the notification.
+    """
+    objects = parse_notification(xml)
+    send_notification_signals(xml, objects)
+    return objects
+
+
+def peek_notification(xml):
+    """
+    Returns the (type, account_code) of a raw notification body, without
+    building the full recurly resources.
+    """
+    try:
+        notification_el = ElementTree.fromstring(xml.strip())
+    except ElementTree.ParseError:
+        raise InvalidNotificationError(None)
+
+    notification_type = notification_el.tag
+    _get_notification_signal(notification_type)
+    return notification_type, notification_el.findtext("account/account_code")
+
+
+def enqueue_notification(xml):
+    """
+    Stores a raw notification body in the inbox, without any remote call.
+
+    Only the root tag and the account code are extracted, so that obviously
+    invalid notifications are rejected right away.
+    """
+    notification_type, account_code = peek_notification(xml)
+    resource_cache.invalidate(account_code=account_code)
+
+    if isinstance(xml, bytes):
+        xml = xml.decode("utf-8")
+
+    return PushNotification.objects.create(
+        notification_type=notification_type,
+        account_code=account_code,
+        xml=xml,
+    )
+
+
+_ledger_stats_lock = threading.Lock()
+_ledger_stats = {"hits": 0, "misses": 0}
+
+
+def _count_ledger_lookup(key):
+    with _ledger_stats_lock:
+        _ledger_stats[key] += 1
+
+
+def get_ledger_stats():
+    """Returns the counts of duplicate ("hits") and new ("misses") notifications seen by this process."""
+    with _ledger_stats_lock:
+        return dict(_ledger_stats)
+
+
+def reset_ledger_stats():
+    with _ledger_stats_lock:
+        _ledger_stats.update(hits=0, misses=0)
+
+
+def get_notification_digest(xml):
+    """
+    Fingerprint of a notification, identical for all redeliveries of it
+    (type, account_code, subscription uuid, transaction id, timestamps...).
+    """
+    if not isinstance(xml, bytes):
+        xml = xml.encode("utf-8")
+    return hashlib.sha1(xml.strip()).hexdigest()
+
+
+def _get_ledger_threshold():
+    return timezone.now() - datetime.timedelta(seconds=conf.NOTIFICATION_LEDGER_TTL)
+
+
+def is_known_notification(digest):
+    return NotificationReceipt.objects.filter(digest=digest, received_at__gte=_get_ledger_threshold()).exists()
+
+
+def record_notification_receipt(digest, notification_type, account_code):
+    """
+    Adds a notification to the ledger.
+
+    Returns False if it was already there (eg. concurrent redelivery).
+    """
+    # an expired receipt must not prevent recording the notification again
+    NotificationReceipt.objects.filter(digest=digest, received_at__lt=_get_ledger_threshold()).delete()
+    try:
+        with transaction.atomic():
+            NotificationReceipt.objects.create(digest=digest,
+                                               notification_type=notification_type,
+                                               account_code=account_code)
+    except IntegrityError:
+        return False
+    return True
+
+
+def purge_expired_notification_receipts():
+    deleted, _ = NotificationReceipt.objects.filter(received_at__lt=_get_ledger_threshold()).delete()
+    return deleted
+
+
+def _handle_notification(xml):
+    if conf.NOTIFICATION_INBOX:
+        # signals will be fired later by the "recurlyinbox" command
+        enqueue_notification(xml)
+    else:
+        dispatch_notification(xml)
+
+
+def receive_notification(xml):
+    """
+    Entry point for notifications posted by Recurly to the webhook view.
+
+    Returns False if the notification was ignored as a redelivery.
+    """
+    if not conf.NOTIFICATION_LEDGER:
+        _handle_notification(xml)
+        return True
+
+    digest = get_notification_digest(xml)
+    notification_type, account_code = peek_notification(xml)
+
+    if is_known_notification(digest):
+        logger.debug("Ignoring redelivered %s for account_code '%s'", notification_type, account_code)
+        _count_ledger_lookup("hits")
+        return False
+
+    if conf.NOTIFICATION_INBOX:
+        # receipt and inbox entry are stored together, so that it's enqueued exactly once
+        with transaction.atomic():
+            if not record_notification_receipt(digest, notification_type, account_code):
+                _count_ledger_lookup("hits")
+                return False
+            enqueue_notification(xml)
+    else:
+        # receipt is only stored on success, so that Recurly can redeliver on errors
+        dispatch_notification(xml)
+        record_notification_receipt(digest, notification_type, account_code)
+
+    _count_ledger_lookup("misses")
+    return True
+
+
+def requeue_stale_notifications(stale_seconds=None):
+    """
+    Puts back in the queue notifications claimed by workers which died
+    before finishing their job.
+    """
+    if stale_seconds is None:
+        stale_seconds = conf.NOTIFICATION_INBOX_STALE_SECONDS
+    threshold = timezone.now() - datetime.timedelta(seconds=stale_seconds)
+    return (PushNotification.objects
+            .filter(state="processing", modified__lt=threshold)
+            .update(state="pending", claim_token=None, modified=timezone.now()))
+
+
+def claim_pending_notifications(batch_size=None, coalesce_window=0):
+    """
+    Atomically marks a batch of pending notifications as being processed by
+    the current worker, and returns them in reception order.
+
+    With a coalesce_window (in seconds), only notifications older than this
+    window are eligible, but all other pending notifications of their
+    accounts are claimed along with them.
+    """
+    batch_size = batch_size or conf.NOTIFICATION_INBOX_BATCH_SIZE
+    claim_token = uuid.uuid4().hex
+
+    eligible = PushNotification.objects.filter(state="pending")
+    if coalesce_window:
+        eligible = eligible.filter(created__lte=timezone.now() - datetime.timedelta(seconds=coalesce_window))
+
+    pending_ids = list(eligible.order_by("id").values_list("id", flat=True)[:batch_size])
+    if not pending_ids:
+        return []
+
+    # other workers may have claimed some of these rows in the meantime
+    (PushNotification.objects
+     .filter(id__in=pending_ids, state="pending")
+     .update(state="processing", claim_token=claim_token, modified=timezone.now()))
+
+    if coalesce_window:
+        account_codes = set(PushNotification.objects
+                            .filter(claim_token=claim_token, account_code__isnull=False)
+                            .values_list("account_code", flat=True))
+        (PushNotification.objects
+         .filter(account_code__in=account_codes, state="pending")
+         .update(state="processing", claim_token=claim_token, modified=timezone.now()))
+
+    return list(PushNotification.objects.filter(claim_token=claim_token).order_by("id"))
+
+
+def _record_success(notification):
+    now = timezone.now()
+    (PushNotification.objects
+     .filter(pk=notification.pk)
+     .update(state="processed", claim_token=None, attempts=notification.attempts + 1,
+             processed_at=now, modified=now))
+
+
+def _record_failure(notification, error):
+    attempts = notification.attempts + 1
+    state = "failed" if attempts >= conf.NOTIFICATION_INBOX_MAX_ATTEMPTS else "pending"
+    (PushNotification.objects
+     .filter(pk=notification.pk)
+     .update(state=state, claim_token=None, attempts=attempts,
+             last_error=repr(error), modified=timezone.now()))
+
+
+def process_notification(notification):
+    """
+    Fires the signals of a claimed inbox notification, and records the outcome.
+
+    Returns True on success.
+    """
+    try:
+        dispatch_notification(notification.xml.encode("utf-8"))
+    except Exception as e:
+        logger.exception("Processing of %s %s failed", notification.notification_type, notification.pk)
+        _record_failure(notification, e)
+        return False
+
+    _record_success(notification)
+    return True
+
+
+def sync_coalesced_notifications(account_code, parsed_notifications):
+    """
+    Performs, once for a whole group of notifications of the same account,
+    the remote sync that default handlers would perform for each of them.
+    """
+    needs_account_sync = False
+    payment_notifications = {}  # transaction id -> latest notification objects
+
+    for objects in parsed_notifications:
+        if objects['type'] in handlers.ACCOUNT_NOTIFICATION_TYPES:
+            needs_account_sync = True
+        elif objects['type'] in handlers.PAYMENT_NOTIFICATION_TYPES:
+            payment_notifications[objects['transaction'].id] = objects
+
+    if needs_account_sync:
+        provisioning.update_full_local_data_for_account_code(account_code=account_code)
+
+    for objects in payment_notifications.values():
+        Payment.handle_notification(**objects)
+
+
+def process_notification_group(account_code, notifications):
+    """
+    Processes together the claimed inbox notifications of an account.
+
+    Returns True on success.
+    """
+    try:
+        xmls = [notification.xml.encode("utf-8") for notification in notifications]
+        parsed_notifications = [parse_notification(xml) for xml in xmls]
+
+        logger.debug("Coalescing %d notifications for account_code '%s'", len(notifications), account_code)
+        sync_coalesced_notifications(account_code, parsed_notifications)
+
+        for xml, objects in zip(xmls, parsed_notifications):
+            send_notification_signals(xml, objects, coalesced=True)
+    except Exception as e:
+        logger.exception("Processing of %d notifications for account_code '%s' failed",
+                         len(notifications), account_code)
+        for notification in notifications:
+            _record_failure(notification, e)
+        return False
+
+    for notification in notifications:
+        _record_success(notification)
+    return True
+
+
+def _group_by_account_code(notifications):
+    groups = {}
+    ordered_groups = []
+    for notification in notifications:
+        if notification.account_code is None:
+            ordered_groups.append((None, [notification]))
+        elif notification.account_code in groups:
+            groups[notification.account_code].append(notification)
+        else:
+            groups[notification.account_code] = [notification]
+            ordered_groups.append((notification.account_code, groups[notification.account_code]))
+    return ordered_groups
+
+
+def _process_account_notifications(account_code, notifications, coalesce):
+    """Returns the number of these notifications which were processed successfully."""
+    if coalesce and account_code is not None:
+        return len(notifications) if process_notification_group(account_code, notifications) else 0
+    return len([notification for notification in notifications if process_notification(notification)])
+
+
+def process_pending_notifications(batch_size=None, shards=None):
+    """
+    Drains one batch of the inbox.
+
+    Accounts are processed concurrently on a ShardedWorkerPool (see
+    RECURLY_WORKER_SHARDS), the notifications of each account serially.
+
+    Returns a (processed, failed) tuple of counts.
+    """
+    coalesce_window = conf.NOTIFICATION_COALESCE_WINDOW
+    claimed = claim_pending_notifications(batch_size=batch_size, coalesce_window=coalesce_window)
+
+    with ShardedWorkerPool(shards=shards) as pool:
+        jobs = [pool.submit(account_code, _process_account_notifications,
+                            account_code, notifications, coalesce=bool(coalesce_window))
+                for account_code, notifications in _group_by_account_code(claimed)]
+
+    processed = sum(job.result or 0 for job in jobs)
+    return processed, len(claimed) - processed
+
+
+def purge_processed_notifications(older_than_days):
+    """Deletes successfully processed notifications, to keep the inbox table small."""
+    threshold = timezone.now() - datetime.timedelta(days=older_than_days)
+    deleted, _ = PushNotification.objects.filter(state="processed", processed_at__lt=threshold).delete()
+    return deleted
@@ -1,12 +1,22 @@
 
 import copy
+import hashlib
+import json
+from collections import OrderedDict
+from xml.etree import ElementTree
 
 import recurly
 
 from recurly.errors import NotFoundError
 
+from django.db import transaction
+from six.moves.urllib.parse import quote, unquote
+
+from . import cache as resource_cache
 from .exceptions import PreVerificationTransactionRecurlyError
-from .models import logger, Account, BillingInfo, Subscription, SubscriptionAddOn
+from .metrics import attribute_calls, bind_caller
+from .models import logger, Account, BillingInfo, Plan, PlanAddOn, Subscription, SubscriptionAddOn
+from .workers import get_fetch_executor
 
 
 def _construct_recurly_account_resource(account_params, billing_info_params=None):
@@ -29,8 +39,22 @@ def _construct_recurly_account_resource(account_params, billing_info_params=None
     return account_params
 
 
+def _get_account_url(account_code):
+    """Same URL as the href of the remote account, to write to it without fetching it first."""
+    return recurly.base_uri() + (recurly.Account.member_path % (quote(str(account_code)),))
+
 
+def get_linked_account_code(resource):
+    """Extracts the account_code from the account link of a subscription or transaction, without fetching it."""
+    account_elem = resource._elem.find("account")
+    if account_elem is None:
+        return None
+    if account_elem.findtext("account_code"):
+        return account_elem.findtext("account_code")
+    return unquote(account_elem.attrib.get("href", "").rstrip("/").rsplit("/", 1)[-1]) or None
 
+
+@attribute_calls
 def create_and_sync_recurly_account(account_params, billing_info_params=None, acquisition_params=None):
     """
     Creates a remote recurly Account, with a BillingInfo if provided.
@@ -41,82 +65,161 @@ def create_and_sync_recurly_account(account_params, billing_info_params=None, ac
     recurly_account = _construct_recurly_account_resource(account_params,
                                                           billing_info_params=billing_info_params)
 
-    recurly_account.save()  # WS API call
+    recurly_account.save()  # WS API call, the resource is then refreshed from its response (see monkey.py)
+
+    if not billing_info_params:
+        recurly_account.__dict__["billing_info"] = None  # no need to ask for it
+    # else the (masked) billing info is only linked by the response, and fetched by modelify
 
     if acquisition_params:
         set_acquisition_data(recurly_account.account_code, acquisition_params)
 
-    # FULL RELOAD because recurly APi client refresh is damn buggy
-    recurly_account = recurly.Account.get(recurly_account.account_code)
-    '''
-    if 'billing_info' in recurly_account.__dict__:
-        # UGLY bug, some attributes like this are not updated by resource.update_from_element()
-        del recurly_account.__dict__["billing_info"]
-    '''
     local_account = update_local_account_data_from_recurly_resource(recurly_account=recurly_account)
     return local_account
 
 
-
-
-
+@attribute_calls
 def update_and_sync_recurly_billing_info(account, billing_info_params):
     """
     Gets and returns a LOCAL Account instance.
     """
-    recurly_account = account.get_recurly_account()
+    recurly_account = recurly.Account(account_code=account.account_code)
+    recurly_account._url = _get_account_url(account.account_code)
     billing_info = recurly.BillingInfo(**billing_info_params)
-    recurly_account.update_billing_info(billing_info)
-    if hasattr(account, "billing_info"):
-        account.billing_info.purge_billing_info()
-    recurly_account = account.get_recurly_account()  # refresh
-    local_account = update_local_account_data_from_recurly_resource(recurly_account=recurly_account)
+    recurly_account.update_billing_info(billing_info)  # billing_info is refreshed from the response
+    resource_cache.invalidate(account_code=account.account_code)
+
+    local_account = Account.objects.get(pk=account.pk)
+    local_billing_info = getattr(local_account, "billing_info", None)
+    if local_billing_info is not None:
+        local_billing_info.purge_billing_info()
+
+    def _link_to_account(_local_billing_info):
+        _local_billing_info.account = local_account
+
+    modelify(billing_info, BillingInfo, existing_instance=local_billing_info, presave_callback=_link_to_account)
     return local_account
 
 
+@attribute_calls
 def delete_and_sync_recurly_billing_info(account):
     """
         Remove Billing Info from remote account then synchronize with local recurly
     """
-    remote_recurly_account = account.get_recurly_account()
-    billing_info = remote_recurly_account.billing_info
-    if billing_info:
+    billing_info = recurly.BillingInfo()
+    billing_info._url = _get_account_url(account.account_code) + "/billing_info"
+    try:
         billing_info.delete()
-    else:
+    except NotFoundError:
         raise Exception("User billing info doesn't exist")
+    resource_cache.invalidate(account_code=account.account_code)
 
     try:
-        remote_recurly_account = account.get_recurly_account()  # refresh
-        local_account = update_local_account_data_from_recurly_resource(recurly_account=remote_recurly_account)
+        local_account = Account.objects.get(pk=account.pk)
+        BillingInfo.objects.filter(account=local_account).delete()
     except Exception as e:
         raise Exception("User billing info update_local_account Error: {}".format(e))
 
     return local_account
 
 
-def sync_local_add_ons_from_recurly_resource(remote_subscription, local_subscription):
-    def __modelify_add_on(_local_subscription, _remote_subscription_add_on, _local_existing_add_on):
-        assert isinstance(_remote_subscription_add_on, recurly.SubscriptionAddOn)
-
-        # Update
-        if _local_existing_add_on:
-            modelify(_remote_subscription_add_on, SubscriptionAddOn, existing_instance=_local_existing_add_on)
-        # Create
+def _reconcile_add_ons(remote_add_ons, local_add_ons, model_class, **parent):
+    """
+    Makes local add-on rows (of a subscription or a plan, given as "parent")
+    match exactly the remote ones, with bulk writes (add-ons are matched by add_on_code).
+    """
+    modelify_plan = None
+    existing_add_ons = {}
+    obsolete_add_on_ids = []
+    for local_add_on in local_add_ons:
+        if local_add_on.add_on_code in existing_add_ons:
+            obsolete_add_on_ids.append(local_add_on.pk)  # duplicate row
+        else:
+            existing_add_ons[local_add_on.add_on_code] = local_add_on
+
+    created = {}
+    updated = {}
+    for remote_add_on in remote_add_ons:
+        modelify_plan = modelify_plan or get_modelify_plan(type(remote_add_on), model_class)
+        model_updates = _get_model_updates(remote_add_on, modelify_plan)
+        add_on_code = model_updates["add_on_code"]
+
+        local_add_on = existing_add_ons.get(add_on_code)
+        if local_add_on is None:
+            created[add_on_code] = model_class(**dict(model_updates, **parent))
         else:
-            subscription_add_on = modelify(_remote_subscription_add_on, SubscriptionAddOn)
-            _local_subscription.subscription_add_ons.add(subscription_add_on)
+            for k, v in model_updates.items():
+                setattr(local_add_on, k, v)
+            updated[add_on_code] = local_add_on
+
+    obsolete_add_on_ids.extend(local_add_on.pk for (add_on_code, local_add_on) in existing_add_ons.items()
+                               if add_on_code not in updated)
+
+    local_add_ons = list(created.values()) + list(updated.values())
+    if obsolete_add_on_ids:
+        with transaction.atomic():
+            model_class.objects.filter(pk__in=obsolete_add_on_ids).delete()
+            model_class.objects.bulk_save_dirty(local_add_ons)
+    else:
+        model_class.objects.bulk_save_dirty(local_add_ons)
+
 
-    for recurly_subscription_add_on in remote_subscription.subscription_add_ons:
-        local_subscription_add_on = \
-            local_subscription.subscription_add_ons.filter(add_on_code=recurly_subscription_add_on.add_on_code).first()
+def sync_local_add_ons_from_recurly_resource(remote_subscription, local_subscription, local_add_ons=None):
+    """
+    Makes the local add-ons of a subscription match exactly the remote ones,
+    with a single prefetch and bulk writes (add-ons are matched by add_on_code).
 
-        __modelify_add_on(_local_subscription=local_subscription,
-                          _remote_subscription_add_on=recurly_subscription_add_on,
-                          _local_existing_add_on=local_subscription_add_on,)
+    The current local add-ons may be provided, if already fetched.
+    """
+    if local_add_ons is None:
+        local_add_ons = local_subscription.subscription_add_ons.all()
 
+    remote_add_ons = remote_subscription.subscription_add_ons
+    assert all(isinstance(remote_add_on, recurly.SubscriptionAddOn) for remote_add_on in remote_add_ons)
+    _reconcile_add_ons(remote_add_ons, local_add_ons, SubscriptionAddOn, subscription=local_subscription)
     return local_subscription
 
 
+@attribute_calls
+def sync_plan(recurly_plan, force=False):
+    """
+    Mirrors a remote plan and its add-ons (one more API call) in the local
+    catalog, and returns the local Plan.
+    """
+    remote_add_ons = list(recurly_plan.add_ons())
+    with transaction.atomic():
+        local_plan = modelify(recurly_plan, Plan, force=force)
+        _reconcile_add_ons(remote_add_ons, local_plan.plan_add_ons.all(), PlanAddOn, plan=local_plan)
+    return local_plan
+
+
+@attribute_calls
+def sync_plans(force=False):
+    """Mirrors the whole remote plan catalog, and returns the local plans."""
+    local_plans = [sync_plan(recurly_plan, force=force) for recurly_plan in recurly.Plan.all()]
+    Plan.objects.exclude(plan_code__in=[local_plan.plan_code for local_plan in local_plans]).delete()
+    return local_plans
+
+
+@attribute_calls
+def get_local_plan(plan_code, refresh=False):
+    """
+    Returns the local Plan, with its add-ons prefetched.
+
+    On a miss of the local catalog (or if refresh=True), the plan is fetched
+    from Recurly and mirrored first; recurly.NotFoundError is raised if it
+    doesn't exist there either.
+    """
+    local_plans = Plan.objects.prefetch_related("plan_add_ons")
+    if not refresh:
+        try:
+            return local_plans.get(plan_code=plan_code)
+        except Plan.DoesNotExist:
+            logger.info("Plan %s missing in local catalog, fetching it from Recurly", plan_code)
+    sync_plan(recurly.Plan.get(plan_code))
+    return local_plans.get(plan_code=plan_code)
+
+
 def create_remote_subsciption(subscription_params, account_params, billing_info_params=None):
     assert "account" not in subscription_params, subscription_params
     recurly_account = _construct_recurly_account_resource(account_params,
@@ -131,9 +234,12 @@ def create_remote_subsciption(subscription_params, account_params, billing_info_
 
 def create_remote_subscription_with_add_on(subscription_params, account_params, add_ons_data, billing_info_params=None):
     def __check_add_ons_code(_subscription_params, _add_ons_data):
-        plan = recurly.Plan.get(_subscription_params["plan_code"])
-        remote_add_ons_code = [add_on.add_on_code for add_on in plan.add_ons()]
-        submitted_add_ons_code = [add_on["add_on_code"] for add_on in _add_ons_data]
+        plan_code = _subscription_params["plan_code"]
+        submitted_add_ons_code = set(add_on["add_on_code"] for add_on in _add_ons_data)
+        plan = get_local_plan(plan_code)
+        if not submitted_add_ons_code.issubset(add_on.add_on_code for add_on in plan.plan_add_ons.all()):
+            plan = get_local_plan(plan_code, refresh=True)  # local catalog may be outdated
+        remote_add_ons_code = [add_on.add_on_code for add_on in plan.plan_add_ons.all()]
         for submit_code in submitted_add_ons_code:
             if submit_code not in remote_add_ons_code:
                 raise PreVerificationTransactionRecurlyError(transaction_error_code="invalid_add_ons_code",)
@@ -150,6 +256,7 @@ def create_remote_subscription_with_add_on(subscription_params, account_params,
     return remote_subscription
 
 
+@attribute_calls
 def create_and_sync_recurly_subscription(subscription_params, account_params,
                                          billing_info_params=None, add_ons_data=None):
     """
@@ -167,10 +274,9 @@ def create_and_sync_recurly_subscription(subscription_params, account_params,
     else:
         remote_subscription = create_remote_subsciption(subscription_params, account_params, billing_info_params)
     remote_subscription.save()
-    remote_account = remote_subscription.account()
 
-    # FULL RELOAD because lots of stuffs may have changed, and recurly API client refresh is damn buggy
-    account = update_full_local_data_for_account_code(account_code=remote_account.account_code)
+    # FULL RELOAD of the account, because its billing info and other subscriptions may have changed too
+    account = update_full_local_data_for_account_code(account_code=get_linked_account_code(remote_subscription))
     assert account.subscriptions.count()
 
     subscription = account.subscriptions.filter(uuid=remote_subscription.uuid).first()
@@ -178,62 +284,208 @@ def create_and_sync_recurly_subscription(subscription_params, account_params,
     return subscription
 
 
+@attribute_calls
 def update_and_sync_recurly_subscription(subscription, subscription_params):
     """
     Gets and returns a LOCAL Subscription instance.
     """
     assert isinstance(subscription, Subscription), subscription
 
-    recurly_subscription = subscription.get_recurly_subscription()
+    # only locally set values are sent, so the remote subscription needn't be fetched first
+    recurly_subscription = recurly.Subscription()
+    recurly_subscription._url = recurly.base_uri() + (recurly.Subscription.member_path % (quote(str(subscription.uuid)),))
+    del recurly_subscription.currency  # recurly.DEFAULT_CURRENCY, not necessarily the one of the subscription
 
     for (k, v) in subscription_params.items():
         setattr(recurly_subscription, k, v)
 
-    recurly_subscription.save()
+    recurly_subscription.save()  # the resource is then refreshed from the response (see monkey.py)
+    resource_cache.invalidate(subscription_uuid=subscription.uuid)
 
-    recurly_subscription = subscription.get_recurly_subscription()
     return update_local_subscription_data_from_recurly_resource(
         recurly_subscription=recurly_subscription
     )
 
 
-def modelify(resource, model_class, existing_instance=None, remove_empty=False, presave_callback=None, save=True):
+# maps substructures of recurly records to corresponding django models
+SUBMODEL_MAPPER = {
+    #'account': Account,  NOPE
+    'billing_info': BillingInfo,
+    #'subscription': Subscription,
+    #'transaction': Payment,
+}
+
+UNTOUCHABLE_MODEL_FIELDS = ["id", "user", "account"] + list(SUBMODEL_MAPPER.keys())  # pk and foreign keys
+EXTRA_ATTRIBUTES = ("hosted_login_token", "state", "closed_at")  # missing in resource.attributes
+
+
+class ModelifyPlan(object):
+    """
+    How the attributes of a recurly resource class map to the fields of a
+    django model, computed once per (resource class, model class) pair.
     """
-    Convert recurly resource objects to django models, by creating new instances or updating existing ones.
 
-    Saves immediately the models created/updated, unless save=False if given.
+    def __init__(self, resource_class, model_class):
+        model_fields_by_name = dict((field.name, field) for field in model_class._meta.fields
+                                    if field.name not in UNTOUCHABLE_MODEL_FIELDS)
+
+        # remote attributes mirrored in SQL DB, in resource order
+        self.field_names = tuple(name for name in OrderedDict.fromkeys(resource_class.attributes + EXTRA_ATTRIBUTES)
+                                 if name in model_fields_by_name)
+
+        # fields with limited choices should always be lower case
+        self.lowercased_field_names = frozenset(name for name in self.field_names
+                                                if model_fields_by_name[name].choices)
+
+        # whether the model stores a fingerprint of the remote payload
+        self.fingerprinted = any(field.name == "remote_fingerprint" for field in model_class._meta.fields)
+
+        # whether the model stores the HTTP validators of the remote resource
+        self.validated = any(field.name == "remote_etag" for field in model_class._meta.fields)
+
+        # substructures of the resource, stored in related models
+        self.submodels = tuple((relation, submodel_class) for (relation, submodel_class) in SUBMODEL_MAPPER.items()
+                               if hasattr(model_class, relation))
+
+
+_modelify_plans = {}
+
+
+def get_modelify_plan(resource_class, model_class):
+    key = (resource_class, model_class)
+    plan = _modelify_plans.get(key)
+    if plan is None:
+        plan = _modelify_plans[key] = ModelifyPlan(resource_class, model_class)
+    return plan
+
+
+def clear_modelify_plans():
+    """To be called if resource attributes or model fields are changed at runtime (eg. by monkey-patching)."""
+    _modelify_plans.clear()
+
+
+def get_remote_fingerprint(resource):
+    """
+    Returns a digest of the XML payload of a resource, or None if it has
+    none or if some of its attributes were modified locally.
     """
+    elem = getattr(resource, "_elem", None)
+    if elem is None or any(name in resource.__dict__ for name in resource.attributes):
+        return None
+    tail, elem.tail = elem.tail, None  # whitespace following the element in its document
+    try:
+        return hashlib.sha1(ElementTree.tostring(elem)).hexdigest()
+    finally:
+        elem.tail = tail
 
-    __old = '''Modelify handles the dirty work of converting Recurly Resource objects to
-    Django model instances, including resolving any additional Resource objects
-    required to satisfy foreign key relationships. This method will query for
-    existing instances based on unique model fields, or return a new instance if
-    there is no match. Modelify does not save any models back to the database,
-    it is left up to the application logic to decide when to do that.'''
 
-    sentinel = object()
+def _is_unchanged(obj, fingerprint):
+    return bool(fingerprint and obj is not None and obj.pk and obj.remote_fingerprint == fingerprint)
+
 
-    # maps substructures of recurly records to corresponding django models
-    SUBMODEL_MAPPER = {
-        #'account': Account,  NOPE
-        'billing_info': BillingInfo,
-        #'subscription': Subscription,
-        #'transaction': Payment,
-    }
+def _get_remote_validators(resource):
+    """HTTP validators of a resource fetched with get_resource_if_modified(), None for others."""
+    return {"remote_etag": getattr(resource, "_etag", None),
+            "remote_last_modified": getattr(resource, "_last_modified", None)}
 
-    UNTOUCHABLE_MODEL_FIELDS = ["id", "user", "account"] + list(SUBMODEL_MAPPER.keys())  # pk and foreign keys
-    EXTRA_ATTRIBUTES = ("hosted_login_token", "state", "closed_at")  # missing in resource.attributes
-    model_fields_by_name = dict((field.name, field) for field in model_class._meta.fields
-                                if field.name not in UNTOUCHABLE_MODEL_FIELDS)
-    model_fields = set(model_fields_by_name.keys())
+
+def _set_remote_validators(obj, resource):
+    # validators of a resource obtained otherwise (eg. in a list) are kept only if its payload is the same
+    validators = _get_remote_validators(resource)
+    if any(validators.values()):
+        for k, v in validators.items():
+            setattr(obj, k, v)
+
+
+def _get_model_updates(resource, plan, remove_empty=False):
+    sentinel = object()
 
     # we ensure that missing attributes of xml payload don't lead to bad overrides of model fields
     # some values may be present and None though, due to nil="nil" xml attribute
-    remote_data = {key: getattr(resource, key, sentinel) for key in resource.attributes + EXTRA_ATTRIBUTES}
+    remote_data = {key: getattr(resource, key, sentinel) for key in plan.field_names}
     remote_data = {key: value for (key, value) in remote_data.items() if value is not sentinel}
 
     logger.debug("Modelify %s record input: %s", resource.nodename, remote_data)
 
+    model_updates = {}
+
+    for k, v in remote_data.items():
+
+        if v and k in plan.lowercased_field_names:
+            v = v.lower()  # this shall be a string
+
+        if isinstance(v, recurly.resource.Money):
+            v = json.dumps(v.currencies, sort_keys=True)  # amounts per currency, eg. of plans
+
+        if v or not remove_empty:
+            model_updates[k] = v
+
+    logger.debug("Modelify %s model pending updates: %s", resource.nodename, model_updates)
+    return model_updates
+
+
+def _sync_submodels(resource, obj, plan, save=True, force=False):
+    for (relation, subsinstance_klass) in plan.submodels:
+
+        is_one_to_one_relation = not relation.endswith("s")  # quick and dirty
+        if is_one_to_one_relation:
+            def _new_presave_callback(_subobj):
+                setattr(obj, relation, _subobj)
+        else:
+            raise RuntimeError("NOT is_one_to_one_relation case not tested yet")
+            # it's a pool of related objects like "subscriptions"...
+            def _new_presave_callback(_subobj):
+                rels = getattr(obj, relation)
+                rels.add(_subobj)
+
+        local_subinstance = getattr(obj, relation, None)
+
+        #logger.debug("LOOOOOOOOKING UP RESOURCE EXTRACT %s %s %s", resource, relation, resource.__dict__)
+
+        try:
+            remote_subresource = getattr(resource, relation, None)
+        except recurly.errors.NotFoundError:
+            remote_subresource = None
+        #logger.debug("Remote_resource _elem: %s", remote_resource._elem)
+
+        if remote_subresource:
+            # we create or override sub-instance
+            subobj = modelify(remote_subresource, subsinstance_klass,
+                              existing_instance=local_subinstance,
+                              presave_callback=_new_presave_callback, force=force)
+            setattr(obj, relation, subobj)  # might be a NO-OP here
+            if save:
+                obj.save()  # just in case
+        else:
+            assert not remote_subresource
+            if local_subinstance:
+                local_subinstance.delete()  # delete obsolete instance in DB
+                assert getattr(obj, relation) is local_subinstance  # proxy remains
+            else:
+                pass  # both unexisting, it's OK
+
+
+def modelify(resource, model_class, existing_instance=None, remove_empty=False, presave_callback=None, save=True,
+             force=False):
+    """
+    Convert recurly resource objects to django models, by creating new instances or updating existing ones.
+
+    Saves immediately the models created/updated, unless save=False if given.
+
+    Instances whose remote payload is unchanged since last mirrored are left
+    as is, unless force=True is given (eg. to override local changes).
+    """
+
+    __old = '''Modelify handles the dirty work of converting Recurly Resource objects to
+    Django model instances, including resolving any additional Resource objects
+    required to satisfy foreign key relationships. This method will query for
+    existing instances based on unique model fields, or return a new instance if
+    there is no match. Modelify does not save any models back to the database,
+    it is left up to the application logic to decide when to do that.'''
+
+    plan = get_modelify_plan(type(resource), model_class)
+    fingerprint = get_remote_fingerprint(resource) if plan.fingerprinted else None
+
     '''
     for k, v in data.copy().items():
 
@@ -269,23 +521,6 @@ def modelify(resource, model_class, existing_instance=None, remove_empty=False,
             data[k] = modelify(v, MODEL_MAP[k], remove_empty=remove_empty, follow=follow, context=context)
     '''
 
-
-    model_updates = {}
-
-    for k, v in remote_data.items():
-
-        if k not in model_fields:
-            continue  # data not mirrored in SQL DB
-
-        # Fields with limited choices should always be lower case
-        if v and model_fields_by_name[k].choices:
-            v = v.lower()  # this shall be a string
-
-        if v or not remove_empty:
-            model_updates[k] = v
-
-    logger.debug("Modelify %s model pending updates: %s", resource.nodename, model_updates)
-
     # Check for existing model object with the same unique field (account_code, uuid...)
 
     if existing_instance:
@@ -297,12 +532,12 @@ def modelify(resource, model_class, existing_instance=None, remove_empty=False,
 
     elif getattr(model_class, "UNIQUE_LOOKUP_FIELD", None):
 
-        if not model_updates.get(model_class.UNIQUE_LOOKUP_FIELD):
+        unique_value = getattr(resource, model_class.UNIQUE_LOOKUP_FIELD, None)
+        if not unique_value:
             raise RuntimeError("Remote recurly record has no value for unique field %s" %
                                  model_class.UNIQUE_LOOKUP_FIELD)
 
-        unique_field_filter = {model_class.UNIQUE_LOOKUP_FIELD:
-                               model_updates[model_class.UNIQUE_LOOKUP_FIELD]}
+        unique_field_filter = {model_class.UNIQUE_LOOKUP_FIELD: unique_value}
 
         try:
             existing_instance = model_class.objects.get(**unique_field_filter)
@@ -315,75 +550,128 @@ def modelify(resource, model_class, existing_instance=None, remove_empty=False,
     else:
         pass  # eg. case of a billing_info not existing locally yet
 
-    if existing_instance:
-        # Update fields of existing object (even with None values)
+    if not force and _is_unchanged(existing_instance, fingerprint):
+        logger.debug("Remote data of %s instance id=%s is unchanged, skipping conversion",
+                     model_class.__name__, existing_instance.pk)
         obj = existing_instance
-        for k, v in model_updates.items():
-            setattr(obj, k, v)
+        if plan.validated:
+            _set_remote_validators(obj, resource)
     else:
-        # Create a new model instance
-        obj = model_class(**model_updates)
+        model_updates = _get_model_updates(resource, plan, remove_empty=remove_empty)
+        if plan.fingerprinted:
+            model_updates["remote_fingerprint"] = fingerprint
+        if plan.validated:
+            model_updates.update(_get_remote_validators(resource))
+
+        if existing_instance:
+            # Update fields of existing object (even with None values)
+            obj = existing_instance
+            for k, v in model_updates.items():
+                setattr(obj, k, v)
+        else:
+            # Create a new model instance
+            obj = model_class(**model_updates)
 
     if presave_callback:
         presave_callback(obj)
     if save:
         obj.save()  # sets primary key if not present
 
-    for (relation, subsinstance_klass) in SUBMODEL_MAPPER.items():
+    _sync_submodels(resource, obj, plan, save=save, force=force)
 
-        if not hasattr(model_class, relation):
-            continue  # this model doesn't contain such a relation
+    return obj
 
-        is_one_to_one_relation = not relation.endswith("s")  # quick and dirty
-        if is_one_to_one_relation:
-            def _new_presave_callback(_subobj):
-                setattr(obj, relation, _subobj)
-        else:
-            raise RuntimeError("NOT is_one_to_one_relation case not tested yet")
-            # it's a pool of related objects like "subscriptions"...
-            def _new_presave_callback(_subobj):
-                rels = getattr(obj, relation)
-                rels.add(_subobj)
 
-        local_subinstance = getattr(obj, relation, None)
+MODELIFY_MANY_CHUNK_SIZE = 500
 
-        #logger.debug("LOOOOOOOOKING UP RESOURCE EXTRACT %s %s %s", resource, relation, resource.__dict__)
 
-        try:
-            remote_subresource = getattr(resource, relation, None)
-        except recurly.errors.NotFoundError:
-            remote_subresource = None
-        #logger.debug("Remote_resource _elem: %s", remote_resource._elem)
+def _iter_chunks(items, chunk_size):
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
 
-        if remote_subresource:
-            # we create or override sub-instance
-            subobj = modelify(remote_subresource, subsinstance_klass,
-                              existing_instance=local_subinstance,
-                              presave_callback=_new_presave_callback)
-            setattr(obj, relation, subobj)  # might be a NO-OP here
-            if save:
-                obj.save()  # just in case
+
+def _modelify_chunk(resources, model_class, remove_empty, presave_callback, force):
+    unique_field = model_class.UNIQUE_LOOKUP_FIELD
+
+    records = []
+    for resource in resources:
+        unique_value = getattr(resource, unique_field, None)
+        if not unique_value:
+            raise RuntimeError("Remote recurly record has no value for unique field %s" % unique_field)
+        records.append((resource, get_modelify_plan(type(resource), model_class), unique_value))
+
+    unique_values = set(unique_value for (_, _, unique_value) in records)
+    instances_by_key = dict((getattr(obj, unique_field), obj) for obj in
+                            model_class.objects.filter(**{unique_field + "__in": unique_values}).order_by())
+
+    instances = []
+    for (resource, plan, unique_value) in records:
+        obj = instances_by_key.get(unique_value)
+        fingerprint = get_remote_fingerprint(resource) if plan.fingerprinted else None
+
+        if not force and _is_unchanged(obj, fingerprint):
+            if plan.validated:
+                _set_remote_validators(obj, resource)
         else:
-            assert not remote_subresource
-            if local_subinstance:
-                local_subinstance.delete()  # delete obsolete instance in DB
-                assert getattr(obj, relation) is local_subinstance  # proxy remains
+            model_updates = _get_model_updates(resource, plan, remove_empty=remove_empty)
+            if plan.fingerprinted:
+                model_updates["remote_fingerprint"] = fingerprint
+            if plan.validated:
+                model_updates.update(_get_remote_validators(resource))
+
+            if obj is None:
+                obj = instances_by_key[unique_value] = model_class(**model_updates)
             else:
-                pass  # both unexisting, it's OK
+                # Update fields of existing object (even with None values)
+                for k, v in model_updates.items():
+                    setattr(obj, k, v)
 
-    return obj
+        if presave_callback:
+            presave_callback(obj)
+        instances.append(obj)
+
+    # new and modified instances are written in bulk, with signals
+    model_class.objects.bulk_save_dirty(list(instances_by_key.values()))
+
+    for (resource, plan, _), obj in zip(records, instances):
+        _sync_submodels(resource, obj, plan, force=force)
+
+    return instances
+
+
+def modelify_many(resources, model_class, remove_empty=False, presave_callback=None, chunk_size=None, force=False):
+    """
+    Bulk counterpart of modelify(), for models having a UNIQUE_LOOKUP_FIELD.
+
+    Existing rows are looked up with one query per chunk of resources, and
+    only new or modified instances are written, with bulk_create() and one
+    UPDATE per set of changed columns.
+
+    Returns the saved instances, in the order of resources.
+    """
+    if not getattr(model_class, "UNIQUE_LOOKUP_FIELD", None):
+        raise RuntimeError("modelify_many() requires a model with a UNIQUE_LOOKUP_FIELD, not %s" %
+                           model_class.__name__)
+
+    resources = list(resources)
+    instances = []
+    for chunk in _iter_chunks(resources, chunk_size or MODELIFY_MANY_CHUNK_SIZE):
+        instances.extend(_modelify_chunk(chunk, model_class, remove_empty=remove_empty,
+                                         presave_callback=presave_callback, force=force))
+    return instances
 
 
 
 
 
-def update_local_account_data_from_recurly_resource(recurly_account):
+@attribute_calls
+def update_local_account_data_from_recurly_resource(recurly_account, force=False):
     """
     Overrides local Account and BillingInfo fields with remote ones.
     """
 
     logger.debug("update_local_account_data_from_recurly_resource for %s", recurly_account.account_code)
-    account = modelify(recurly_account, Account)
+    account = modelify(recurly_account, Account, force=force)
 
     ## useless account.save()
     ''' NOPE
@@ -415,7 +703,8 @@ def ______update_local_billing_info_data_from_recurly_resource(recurly_billing_i
     return billing_info
 
 
-def update_local_subscription_data_from_recurly_resource(recurly_subscription):
+@attribute_calls
+def update_local_subscription_data_from_recurly_resource(recurly_subscription, force=False):
     """
     Overrides local fields of this Subscription with remote ones.
     """
@@ -424,33 +713,171 @@ def update_local_subscription_data_from_recurly_resource(recurly_subscription):
     assert isinstance(recurly_subscription, recurly.Subscription)
 
     logger.debug("update_local_subscription_data_from_recurly_resource for %s", recurly_subscription.uuid)
-    subscription = modelify(recurly_subscription, Subscription)
+    subscription = modelify(recurly_subscription, Subscription, force=force)
 
     return subscription
 
 
-def update_full_local_data_for_account_code(account_code):
+def _prefetch_billing_info(recurly_account):
+    """
+    Fetches the billing info of a remote account now, so that it's not
+    lazily fetched later (eg. in the middle of a DB transaction).
+    """
+    try:
+        billing_info = recurly_account.billing_info
+    except (AttributeError, NotFoundError):
+        billing_info = None
+    recurly_account.__dict__["billing_info"] = billing_info
 
-    recurly_account = recurly.Account.get(account_code)
-    assert isinstance(recurly_account, recurly.Account), recurly_account
 
-    account = update_local_account_data_from_recurly_resource(recurly_account)
+def _get_linked_resource(url):
+    """Fetches a resource or list of resources, like the link attributes of recurly resources."""
+    resp, elem = recurly.Resource.element_for_url(url)
+    value = recurly.Resource.value_for_element(elem)
+    if isinstance(value, list):
+        return recurly.Page.page_for_value(resp, value)
+    return value
 
-    legit_uuids = []
-    for recurly_subscription in recurly_account.subscriptions():
-        local_subscription = update_local_subscription_data_from_recurly_resource(recurly_subscription)
-        local_subscription = sync_local_add_ons_from_recurly_resource(recurly_subscription, local_subscription)
-        account.subscriptions.add(local_subscription)  # model linking
-        legit_uuids.append(local_subscription.uuid)
 
-    for subscription in account.subscriptions.all():
-        if subscription.uuid not in legit_uuids:
-            # TODO - issue a warning, it's ABNORMAL that subscriptions disappear in recurly servers!
-            subscription.delete()  # remove obsolete subscription
+def _get_billing_info_for_url(url):
+    try:
+        return _get_linked_resource(url)
+    except NotFoundError:
+        return None
+
+
+NOT_MODIFIED = 304
+
+
+def get_resource_if_modified(resource_class, key, local_instance=None):
+    """
+    GETs a remote resource, conditionally to the HTTP validators (ETag,
+    Last-Modified) stored on its local instance by modelify().
+
+    Returns None if it's unchanged since (304 response, nothing to parse nor
+    to write), else the resource, carrying its new validators.
+    """
+    url = recurly.base_uri() + (resource_class.member_path % (quote(str(key)),))
+    headers = {}
+    if local_instance is not None and local_instance.remote_etag:
+        headers["If-None-Match"] = local_instance.remote_etag
+    if local_instance is not None and local_instance.remote_last_modified:
+        headers["If-Modified-Since"] = local_instance.remote_last_modified
+
+    response = resource_class.http_request(url, 'GET', None, headers)
+    if response.status == NOT_MODIFIED:
+        response.read()
+        return None
+    if response.status != 200:
+        resource_class.raise_http_error(response)
+
+    resource = resource_class.from_element(ElementTree.fromstring(response.read()))
+    resource._etag = response.getheader("etag")
+    resource._last_modified = response.getheader("last-modified")
+    return resource
+
+
+def _fetch_remote_account_data(account_code, local_account=None):
+    """
+    Returns the remote account (None if unchanged since local_account was
+    fetched), its billing info and the list of its subscriptions.
+
+    With a fetch executor (see RECURLY_REMOTE_FETCH_WORKERS), the three
+    GETs are issued concurrently, instead of one after the other.
+    """
+    # same URLs as the links of the account resource
+    account_url = _get_account_url(account_code)
+
+    executor = get_fetch_executor()
+    if executor is None:
+        recurly_account = get_resource_if_modified(recurly.Account, account_code, local_account)
+        if recurly_account is not None:
+            _prefetch_billing_info(recurly_account)
+            recurly_billing_info = recurly_account.billing_info
+        else:
+            recurly_billing_info = _get_billing_info_for_url(account_url + "/billing_info")
+        return recurly_account, recurly_billing_info, list(_get_linked_resource(account_url + "/subscriptions"))
+
+    account_future = executor.submit(bind_caller(get_resource_if_modified), recurly.Account, account_code, local_account)
+    billing_info_future = executor.submit(bind_caller(_get_billing_info_for_url), account_url + "/billing_info")
+    subscriptions_future = executor.submit(bind_caller(lambda: list(_get_linked_resource(account_url + "/subscriptions"))))
+
+    return account_future.result(), billing_info_future.result(), subscriptions_future.result()
+
+
+def _sync_local_billing_info(local_account, recurly_billing_info):
+    """Mirrors the remote billing info of an account (None if it has none), like modelify() does."""
+    holder = recurly.Account()
+    holder.__dict__["billing_info"] = recurly_billing_info
+    _sync_submodels(holder, local_account, get_modelify_plan(recurly.Account, Account))
+
+
+@attribute_calls
+def refresh_local_subscription(uuid, force=False):
+    """
+    Overrides the local Subscription of this uuid with the remote one,
+    unless it's unchanged since last fetched (conditional GET) and force=False.
+    """
+    local_subscription = Subscription.objects.filter(uuid=uuid).first()
+    recurly_subscription = get_resource_if_modified(recurly.Subscription, uuid,
+                                                    None if force else local_subscription)
+    if recurly_subscription is None:
+        logger.debug("Remote subscription %s is unchanged, skipping conversion", uuid)
+        return local_subscription
+    return modelify(recurly_subscription, Subscription, existing_instance=local_subscription, force=force)
+
+
+@attribute_calls
+def update_full_local_data_for_account_code(account_code, force=False):
+    """
+    Overrides the local Account, BillingInfo, Subscriptions and add-ons
+    of an account with remote ones, in a single transaction.
+
+    All remote data is fetched first (concurrently, see
+    RECURLY_REMOTE_FETCH_WORKERS), and then written with a number of
+    queries independent of the number of subscriptions (apart from add-ons
+    writes). The account is fetched with a conditional GET, and left as is
+    if unchanged, unless force=True is given.
+    """
+
+    local_account = Account.objects.filter(account_code=account_code).first()
+    recurly_account, recurly_billing_info, recurly_subscriptions = \
+        _fetch_remote_account_data(account_code, local_account=None if force else local_account)
+
+    with transaction.atomic():
+        if recurly_account is None:
+            logger.debug("Remote account %s is unchanged, skipping conversion", account_code)
+            account = local_account
+            _sync_local_billing_info(account, recurly_billing_info)
+        else:
+            recurly_account.__dict__["billing_info"] = recurly_billing_info
+            account = modelify(recurly_account, Account, existing_instance=local_account, force=force)
+
+        def _link_to_account(local_subscription):
+            local_subscription.account = account  # model linking
+
+        local_subscriptions = modelify_many(recurly_subscriptions, Subscription,
+                                            presave_callback=_link_to_account, force=force)
+
+        local_add_ons_by_subscription = dict((local_subscription.pk, []) for local_subscription in local_subscriptions)
+        for local_add_on in SubscriptionAddOn.objects.filter(subscription__in=local_subscriptions).order_by("id"):
+            local_add_ons_by_subscription[local_add_on.subscription_id].append(local_add_on)
+
+        for recurly_subscription, local_subscription in zip(recurly_subscriptions, local_subscriptions):
+            local_add_ons = local_add_ons_by_subscription.pop(local_subscription.pk, None)
+            if local_add_ons is None:
+                continue  # duplicate remote subscription, already sync'ed
+            sync_local_add_ons_from_recurly_resource(recurly_subscription, local_subscription,
+                                                     local_add_ons=local_add_ons)
+
+        # TODO - issue a warning, it's ABNORMAL that subscriptions disappear in recurly servers!
+        legit_uuids = [local_subscription.uuid for local_subscription in local_subscriptions]
+        account.subscriptions.exclude(uuid__in=legit_uuids).delete()  # remove obsolete subscriptions
 
     return account
 
 
+@attribute_calls
 def set_acquisition_data(account_code, acquisition_params):
     """
     add acquisition data to a remote recurly account
@@ -462,10 +889,23 @@ def set_acquisition_data(account_code, acquisition_params):
     recurly_account_acquisition.save()
 
 
+def _make_not_found_error(description):
+    """Builds the error that the recurly client raises on a 404 response."""
+    error = ElementTree.Element("error")
+    ElementTree.SubElement(error, "symbol").text = "not_found"
+    ElementTree.SubElement(error, "description").text = description
+    return NotFoundError(ElementTree.tostring(error))
+
+
+@attribute_calls
 def lookup_plan_add_on(plan_code, add_on_code=None):
+    """
+    Describes a plan and its add-ons (or only the given one), from the local
+    catalog; raises recurly.NotFoundError for a plan or add-on unknown to Recurly.
+    """
     def _serializer_add_on(add_on1):
         serialized_add_on_data = {"add_on_code": add_on1.add_on_code, "name": add_on1.name,
-                                  "currencies": add_on1.unit_amount_in_cents.currencies}
+                                  "currencies": add_on1.get_unit_amounts_in_cents()}
         return serialized_add_on_data
 
     def _serializer_plan(plan, add_on_list):
@@ -476,12 +916,15 @@ def lookup_plan_add_on(plan_code, add_on_code=None):
         }
         return serialized_plan_data
 
-    add_on_list = []
-    plan = recurly.Plan.get(plan_code)
-    if not add_on_code:
-        for add_on0 in plan.add_ons():
-            add_on_list.append(add_on0)
-    else:
-        add_on_list.append(plan.get_add_on(add_on_code))
+    plan = get_local_plan(plan_code)
+    add_on_list = list(plan.plan_add_ons.all())
+    if add_on_code:
+        add_on_list = [add_on for add_on in add_on_list if add_on.add_on_code == add_on_code]
+        if not add_on_list:
+            plan = get_local_plan(plan_code, refresh=True)  # local catalog may be outdated
+            try:
+                add_on_list = [plan.plan_add_ons.get(add_on_code=add_on_code)]
+            except PlanAddOn.DoesNotExist:
+                raise _make_not_found_error("Couldn't find AddOn with add_on_code = %s" % add_on_code)
 
     return _serializer_plan(plan, add_on_list)
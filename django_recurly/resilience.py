@@ -0,0 +1,181 @@
+"""
+Retries and circuit breaker around the API calls of the recurly client.
+
+When Recurly is slow or failing, each provisioning call or push notification
+would otherwise wait for its own timeout before failing, piling up threads.
+Once installed (see RECURLY_RETRY_ATTEMPTS and RECURLY_CIRCUIT_BREAKER_*):
+
+- idempotent calls (GET, HEAD) failing with a network error or a 5xx status
+  are retried a few times, after a jittered exponential backoff;
+- a process-wide CircuitBreaker tracks the outcome of recent calls, and
+  once too many of them failed, makes all calls fail fast with
+  RecurlyUnavailableError until a trial call succeeds again.
+
+See get_counters() for the calls, failures, retries and rejections so far.
+"""
+import collections
+import logging
+import random
+import socket
+import threading
+import time
+
+import recurly
+from six.moves import http_client
+
+from . import conf
+from .exceptions import RecurlyUnavailableError
+
+logger = logging.getLogger(__name__)
+
+NETWORK_ERRORS = (socket.error, http_client.HTTPException)
+
+# statuses showing that Recurly (or its front servers) failed to handle the call
+SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+
+RETRYABLE_METHODS = ("GET", "HEAD")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+def get_backoff(attempt):
+    """Returns the (full jitter) delay in seconds before the n-th retry."""
+    return random.uniform(0, min(conf.RETRY_BACKOFF_MAX, conf.RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """
+    Usage:
+
+        breaker.before_call()  # raises RecurlyUnavailableError if open
+        ...
+        breaker.record(success)  # or breaker.cancel_call() if the call couldn't be made
+    """
+
+    def __init__(self, threshold=-1, window=None, min_calls=None, cooldown=None, clock=time.time):
+        self.threshold = conf.CIRCUIT_BREAKER_THRESHOLD if threshold == -1 else threshold
+        self.min_calls = conf.CIRCUIT_BREAKER_MIN_CALLS if min_calls is None else min_calls
+        self.cooldown = conf.CIRCUIT_BREAKER_COOLDOWN if cooldown is None else cooldown
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_at = None
+        self.stats = {"calls": 0, "failures": 0, "retries": 0, "rejected": 0, "opened": 0}
+        self._outcomes = collections.deque(maxlen=conf.CIRCUIT_BREAKER_WINDOW if window is None else window)
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = self.clock()
+        self.stats["opened"] += 1
+        self._outcomes.clear()
+        logger.error("Recurly API calls are failing, failing fast for %ss", self.cooldown)
+
+    def before_call(self):
+        with self._lock:
+            if self.state == OPEN and self.clock() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+            if self.state == OPEN or (self.state == HALF_OPEN and self._trial_running):
+                self.stats["rejected"] += 1
+                raise RecurlyUnavailableError(retry_at=self.opened_at + self.cooldown)
+            if self.state == HALF_OPEN:
+                self._trial_running = True  # other calls keep failing fast meanwhile
+            self.stats["calls"] += 1
+
+    def record(self, success):
+        with self._lock:
+            if not success:
+                self.stats["failures"] += 1
+
+            if self.state == HALF_OPEN:
+                self._trial_running = False
+                if success:
+                    self.state = CLOSED
+                    logger.info("Recurly API calls succeed again")
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(success)
+            if (self.threshold is not None and len(self._outcomes) >= self.min_calls
+                    and self._outcomes.count(False) >= self.threshold * len(self._outcomes)):
+                self._open()
+
+    def cancel_call(self):
+        """Ends a call which failed without telling anything of Recurly's health (eg. an invalid request body)."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_running = False  # the next call will be the trial
+
+    def record_retry(self):
+        with self._lock:
+            self.stats["retries"] += 1
+
+
+_breaker = None
+
+
+def get_breaker():
+    return _breaker
+
+
+def get_counters():
+    """Returns the counters of the installed CircuitBreaker, with its current state."""
+    if _breaker is None:
+        return {}
+    with _breaker._lock:
+        return dict(_breaker.stats, state=_breaker.state)
+
+
+## Integration with the recurly client ##
+
+_wrapped_http_request = recurly.Resource.__dict__["http_request"]  # the implementation in place when installed
+
+
+def _resilient_http_request(cls, url, method='GET', body=None, headers=None):
+    breaker = _breaker
+    retries = conf.RETRY_ATTEMPTS if method in RETRYABLE_METHODS else 0
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            response = _wrapped_http_request.__get__(None, cls)(url, method, body, headers)
+        except NETWORK_ERRORS as e:
+            breaker.record(False)
+            if attempt >= retries:
+                raise
+            logger.warning("Recurly API call %s %s failed (%r), retrying", method, url, e)
+        except BaseException:
+            breaker.cancel_call()  # else a trial call would keep the breaker half-open forever
+            raise
+        else:
+            failed = response.status in SERVER_ERROR_STATUSES
+            breaker.record(not failed)
+            if not failed or attempt >= retries:
+                return response
+            logger.warning("Recurly API call %s %s failed (%s), retrying", method, url, response.status)
+            response.read()
+
+        attempt += 1
+        breaker.record_retry()
+        time.sleep(get_backoff(attempt))
+
+
+def install(breaker=None):
+    """Wraps API calls with retries and this breaker (a new CircuitBreaker by default), and returns it."""
+    global _breaker, _wrapped_http_request
+    if _breaker is None:
+        _wrapped_http_request = recurly.Resource.__dict__["http_request"]
+        recurly.Resource.http_request = classmethod(_resilient_http_request)
+    _breaker = breaker or CircuitBreaker()
+    return _breaker
+
+
+def uninstall():
+    """Restores the previous implementation (wrappers installed since then must be uninstalled first)."""
+    global _breaker
+    if _breaker is not None:
+        recurly.Resource.http_request = _wrapped_http_request
+        _breaker = None
@@ -114,3 +114,36 @@ class RequestFactory(Client):
         environ.update(self.defaults)
         environ.update(request)
         return WSGIRequest(environ)
+
+
+class FakeResponse(object):
+    """Stand-in for the HTTP responses of the recurly client, with rate limit headers if given."""
+
+    def __init__(self, status=200, body=b"", remaining=None, resets_at=None, retry_after=None):
+        self.status = status
+        self.body = body
+        self.headers = {"content-length": str(len(body))}
+        if remaining is not None:
+            self.headers.update({"x-ratelimit-limit": "100", "x-ratelimit-remaining": str(remaining),
+                                 "x-ratelimit-reset": str(resets_at)})
+        if retry_after is not None:
+            self.headers["retry-after"] = str(retry_after)
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+    def read(self):
+        return self.body
+
+
+class FakeClock(object):
+    """Stand-in for time.time(), whose sleep() just moves it forward."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
@@ -0,0 +1,72 @@
+from xml.etree import ElementTree
+
+import recurly
+from django.core.cache import caches
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+from django.http import HttpResponse
+from mock import patch
+
+from django_recurly import cache, conf
+from django_recurly.middleware import RecurlyResourceCacheMiddleware
+from django_recurly.models import Account
+
+ACCOUNT_XML = b"""<account href="https://api.recurly.com/v2/accounts/verena@test.com">
+  <account_code>verena@test.com</account_code>
+  <email>verena@test.com</email>
+</account>"""
+
+
+def _get_remote_account(account_code):
+    return recurly.Account.from_element(ElementTree.fromstring(ACCOUNT_XML))
+
+
+@patch.object(recurly.Account, "get", side_effect=_get_remote_account)
+class ResourceCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        caches[conf.RESOURCE_CACHE_ALIAS].clear()
+
+    def test_no_cache_by_default(self, get):
+        account = Account(account_code="verena@test.com")
+        account.get_recurly_account()
+        account.get_recurly_account()
+        self.assertEqual(get.call_count, 2)
+
+    def test_request_scope(self, get):
+        account = Account(account_code="verena@test.com")
+        with cache.request_scope():
+            remote_account = account.get_recurly_account()
+            self.assertEqual(remote_account.email, "verena@test.com")
+            assert account.get_recurly_account() is remote_account
+            self.assertEqual(get.call_count, 1)
+
+            assert account.get_recurly_account(cached=False) is not remote_account  # before writes
+            self.assertEqual(get.call_count, 2)
+            account.get_recurly_account()
+            self.assertEqual(get.call_count, 3)
+
+        account.get_recurly_account()
+        self.assertEqual(get.call_count, 4)
+
+    def test_middleware(self, get):
+        middleware = RecurlyResourceCacheMiddleware()
+        request = RequestFactory().get("/")
+        middleware.process_request(request)
+        Account(account_code="verena@test.com").get_recurly_account()
+        Account(account_code="verena@test.com").get_recurly_account()
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(cache._get_request_scope(), None)
+
+    @patch.object(conf, "RESOURCE_CACHE_TTL", 60)
+    def test_ttl_cache(self, get):
+        account = Account(account_code="verena@test.com")
+        self.assertEqual(account.get_recurly_account().email, "verena@test.com")
+        self.assertEqual(account.get_recurly_account().email, "verena@test.com")  # rebuilt from cached XML
+        self.assertEqual(get.call_count, 1)
+
+        # eg. on push notifications
+        cache.invalidate(account_code="verena@test.com")
+        account.get_recurly_account()
+        self.assertEqual(get.call_count, 2)
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+
+import recurly
+from django.db import connection, connections
+from django.test import SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from mock import patch
+from six import StringIO
+
+from django_recurly import conf, metrics, resilience, throttling, workers
+from django_recurly.fake_recurly import fake_recurly_api
+from django_recurly.management.commands import recurly_replay, recurly_stats, recurlysync
+from django_recurly.models import Payment
+
+NOTIFICATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "push_notifications")
+
+
+class RecurlyReplayTest(TransactionTestCase):  # handlers run in the posting threads
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        shutil.copy(os.path.join(NOTIFICATIONS_DIRECTORY, "accounts", "new_account_notification-ok"), self.directory)
+
+    def _replay(self, **options):
+        options = dict(dict(directory=self.directory, repeat=1, concurrency=1, rate=None,
+                            authentication=conf.HTTP_AUTHENTICATION, api_base_uri=None,
+                            fake_api=True, fake_api_latency=0, fake_api_error_rate=0), **options)
+        with patch("sys.stdout", StringIO()) as stdout:
+            recurly_replay.Command().handle(**options)
+        return stdout.getvalue().splitlines()
+
+    def test_load_notifications(self):
+        notifications = recurly_replay.load_notifications(NOTIFICATIONS_DIRECTORY)
+        self.assertEqual(len(notifications), 13)
+        self.assertIn("new_account_notification", [notification_type for notification_type, xml in notifications])
+
+    def test_replay_through_fake_api(self):
+        lines = self._replay(repeat=3, concurrency=2)
+        assert lines[0].startswith("3 notifications posted in "), lines[0]
+        self.assertEqual(lines[2].split()[:3], ["new_account_notification", "3", "0"])
+
+        lines = self._replay(authentication="wrong:credentials")
+        self.assertEqual(lines[2].split()[:3], ["new_account_notification", "1", "1"])  # 401
+
+
+class RecurlySyncTest(TransactionTestCase):
+
+    def _sync(self, **options):
+        options = dict(dict(accounts=False, account=None, subscriptions=False, subscription=None,
+                            payments=False, payment=None, verify_payments=False, plans=False, plan=None,
+                            force=False, shards=1, workers=0), **options)
+        with patch("sys.stdout", StringIO()) as stdout:
+            recurlysync.Command().handle(**options)
+        return stdout.getvalue().splitlines()
+
+    def test_priority_is_restored(self):
+        priorities = []
+
+        def _sync_plans(force):
+            priorities.append(throttling.get_priority())
+
+        with patch.object(recurlysync, "sync_plans", side_effect=_sync_plans):
+            self._sync(plans=True)
+        self.assertEqual(priorities, [throttling.BULK])
+        self.assertEqual(throttling.get_priority(), throttling.INTERACTIVE)
+
+        with patch.object(recurlysync, "sync_plans", side_effect=ValueError("boom")):
+            self.assertRaises(ValueError, self._sync, plans=True)
+        self.assertEqual(throttling.get_priority(), throttling.INTERACTIVE)
+
+    def test_sync_in_worker_processes(self):
+        fake_api = fake_recurly_api()
+        server = fake_api.__enter__()
+        self.addCleanup(fake_api.__exit__, None, None, None)
+        if resilience.get_breaker() is not None:  # not tripped by the failures of other tests
+            patcher = patch.object(resilience, "_breaker", resilience.CircuitBreaker())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        server.add_plan("premium", unit_amount_in_cents={"EUR": 1100})
+        transaction_ids = []
+        for index in range(5):
+            subscription = recurly.Subscription(plan_code="premium", currency="EUR", account=recurly.Account(
+                account_code="account-%d" % index, billing_info=recurly.BillingInfo(
+                    first_name="Jane", number="4111-1111-1111-1111", month=5, year=2030)))
+            subscription.save()
+            transaction_ids.extend(transaction.uuid for transaction in subscription.account().transactions())
+        for transaction_id in transaction_ids:
+            Payment.objects.create(transaction_id=transaction_id, action="purchase", status="success",
+                                   needs_verification=True)
+
+        # workers are forked before the payments are iterated over, as forking closes the DB connection
+        queries_at_fork = []
+        close_all = connections.close_all
+
+        def _close_all():
+            queries_at_fork.append(len(queries))
+            close_all()
+
+        with CaptureQueriesContext(connection) as queries, \
+                patch.object(workers.connections, "close_all", side_effect=_close_all):
+            lines = self._sync(verify_payments=True, workers=2)
+        self.assertEqual(queries_at_fork, [0])
+        self.assertEqual(lines[-1], "5 records synced, 0 failed.")
+        self.assertEqual(sorted(request for request in server.requests if request.startswith("GET /v2/transactions/")),
+                         sorted("GET /v2/transactions/%s" % transaction_id for transaction_id in transaction_ids))
+
+        # with the account and subscription of the fixtures
+        lines = self._sync(accounts=True, subscriptions=True, workers=2)
+        self.assertEqual(lines[-1], "12 records synced, 0 failed.")
+
+
+class RecurlyStatsTest(SimpleTestCase):
+
+    def test_metrics_are_installed_under_throttling_and_resilience(self):
+        previous_throttle, previous_breaker = throttling.get_throttle(), resilience.get_breaker()
+        resilience.uninstall()
+        throttling.uninstall()
+        transport_http_request = recurly.Resource.__dict__["http_request"]
+        throttle = throttling.install()
+        breaker = resilience.install()
+        try:
+            assert not metrics.is_installed()
+            recurly_stats._reinstall_metrics(install=True)
+            self.assertEqual(recurly.Resource.__dict__["http_request"].__func__, resilience._resilient_http_request)
+            self.assertEqual(resilience._wrapped_http_request.__func__, throttling._throttled_http_request)
+            self.assertEqual(throttling._wrapped_http_request.__func__, metrics._instrumented_http_request)
+            self.assertEqual(metrics._wrapped_http_request, transport_http_request)
+            self.assertEqual((throttling.get_throttle(), resilience.get_breaker()), (throttle, breaker))
+
+            recurly_stats._reinstall_metrics(install=False)
+            assert not metrics.is_installed()
+            self.assertEqual(throttling._wrapped_http_request, transport_http_request)
+            self.assertEqual((throttling.get_throttle(), resilience.get_breaker()), (throttle, breaker))
+        finally:
+            resilience.uninstall()
+            throttling.uninstall()
+            if previous_throttle is not None:
+                throttling.install(previous_throttle)
+            if previous_breaker is not None:
+                resilience.install(previous_breaker)
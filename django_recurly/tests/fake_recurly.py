@@ -0,0 +1,82 @@
+import time
+
+import recurly
+from django.test import SimpleTestCase
+from mock import patch
+
+from django_recurly import resilience
+from django_recurly.fake_recurly import FakeRecurlyServer, fake_recurly_api
+
+
+class FakeRecurlyServerTest(SimpleTestCase):
+
+    def setUp(self):
+        fake_api = fake_recurly_api()
+        self.server = fake_api.__enter__()
+        self.addCleanup(fake_api.__exit__, None, None, None)
+
+        if resilience.get_breaker() is not None:  # not tripped by the failures of other tests
+            patcher = patch.object(resilience, "_breaker", resilience.CircuitBreaker())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_fixtures(self):
+        account = recurly.Account.get("verena@test.com")
+        self.assertEqual(account.first_name, "Verena")
+        subscriptions = list(account.subscriptions())
+        self.assertEqual([subscription.uuid for subscription in subscriptions], ["403bfb8cefa599c6a3af954293b64987"])
+        self.assertEqual(subscriptions[0].plan.name, "Gold plan")
+        self.assertFalse(hasattr(account, "billing_info"))  # not linked, as there is none
+
+    def test_pagination(self):
+        for index in range(4):
+            self.server.add_plan("plan-%d" % index)
+        plan_codes = [plan.plan_code for plan in recurly.Plan.all(per_page=2)]
+        self.assertEqual(plan_codes, ["gold", "plan-0", "plan-1", "plan-2", "plan-3"])
+        self.assertEqual(self.server.requests.count("GET /v2/plans"), 3)
+        self.assertEqual(recurly.Plan.count(), 5)
+
+    def test_subscription_charges(self):
+        self.server.add_plan("premium", unit_amount_in_cents={"EUR": 1100}, add_ons=[("extra", {"EUR": 200})])
+        subscription = recurly.Subscription(
+            plan_code="premium", currency="EUR", quantity=2,
+            account=recurly.Account(account_code="jane", billing_info=recurly.BillingInfo(
+                first_name="Jane", number="4111-1111-1111-1111", month=5, year=2030)),
+            subscription_add_ons=[recurly.SubscriptionAddOn(add_on_code="extra", quantity=1)])
+        subscription.save()
+
+        account = subscription.account()
+        self.assertEqual(account.billing_info.last_four, "1111")
+        transaction, = account.transactions()
+        self.assertEqual((transaction.action, transaction.status, transaction.amount_in_cents), ("purchase", "success", 2400))
+        self.assertEqual(transaction.invoice().total_in_cents, 2400)
+
+        subscription.cancel()
+        self.assertEqual(subscription.state, "canceled")
+        self.assertEqual(subscription.expires_at, subscription.current_period_ends_at)
+        self.assertRaises(recurly.ValidationError, recurly.Subscription(plan_code="unknown", account=account).save)
+
+    def test_conditional_get(self):
+        url = recurly.base_uri() + "accounts/verena%40test.com"
+        etag = recurly.Account.http_request(url).getheader("etag")
+        self.assertEqual(recurly.Account.http_request(url, headers={"If-None-Match": etag}).status, 304)
+
+    def test_error_injection(self):
+        url = recurly.base_uri() + "accounts"
+        self.server.faults = [502]
+        self.assertEqual(recurly.Account.http_request(url, "POST").status, 502)  # not retried
+
+        # random faults are reproducible
+        faults = []
+        for server in (self.server, FakeRecurlyServer(error_rate=0.3, seed=1), FakeRecurlyServer(error_rate=0.3, seed=1)):
+            faults.append([server.get_fault() for _ in range(100)])
+            server.server_close()
+        self.assertEqual(faults[0], [None] * 100)
+        self.assertEqual(faults[1], faults[2])
+        self.assertTrue(20 <= faults[1].count(503) <= 40, faults[1].count(503))
+
+    def test_latency(self):
+        self.server.latency = 0.05
+        start = time.time()
+        recurly.Account.get("verena@test.com")
+        self.assertTrue(time.time() - start >= 0.05)
@@ -0,0 +1,90 @@
+import recurly
+from django.test import SimpleTestCase
+from mock import Mock, patch
+
+from django_recurly import metrics
+from django_recurly.tests.base import FakeResponse
+
+
+def _fake_http_request(cls, url, method='GET', body=None, headers=None):
+    return FakeResponse(body=b" " * 2048)
+
+
+@patch.object(metrics, "_wrapped_http_request", classmethod(_fake_http_request))
+class MetricsTest(SimpleTestCase):
+
+    def setUp(self):
+        metrics.reset_stats()
+
+    def tearDown(self):
+        metrics.reset_stats()
+
+    def request(self, url, method="GET"):
+        return metrics._instrumented_http_request(recurly.Account, url, method)
+
+    def test_endpoint_templates(self):
+        self.assertEqual(metrics.get_endpoint_template(
+            "https://api.recurly.com/v2/accounts/verena%40test.com/subscriptions?state=live"),
+            "accounts/{code}/subscriptions")
+        self.assertEqual(metrics.get_endpoint_template(
+            "https://api.recurly.com/v2/subscriptions/3b6a5b8e8c2c4e3ab4b5a1d2/cancel"),
+            "subscriptions/{uuid}/cancel")
+        self.assertEqual(metrics.get_endpoint_template(
+            "https://api.recurly.com/v2/plans/gold/add_ons/ipaddresses"), "plans/{code}/add_ons/{code}")
+
+    def test_aggregation_and_attribution(self):
+        self.request("https://api.recurly.com/v2/accounts/1")
+        with metrics.api_caller("update_full_local_data_for_account_code"):
+            self.request("https://api.recurly.com/v2/accounts/2")
+            self.request("https://api.recurly.com/v2/accounts/2/subscriptions")
+
+        stats = metrics.get_stats()
+        self.assertEqual(sorted(stats), [("GET", "accounts/{code}"), ("GET", "accounts/{code}/subscriptions")])
+        account_stats = stats[("GET", "accounts/{code}")]
+        self.assertEqual((account_stats.count, account_stats.errors, account_stats.bytes), (2, 0, 4096))
+        self.assertEqual(account_stats.statuses, {200: 2})
+        self.assertEqual(account_stats.get_percentile_bound(95), 10)
+
+        stats = metrics.get_stats(by_caller=True)
+        self.assertEqual(stats[(None, "GET", "accounts/{code}")].count, 1)
+        self.assertEqual(stats[("update_full_local_data_for_account_code", "GET", "accounts/{code}")].count, 1)
+
+    def test_failed_calls(self):
+        with patch.object(metrics, "_wrapped_http_request", classmethod(Mock(return_value=FakeResponse(status=404)))):
+            self.request("https://api.recurly.com/v2/accounts/1")
+        with patch.object(metrics, "_wrapped_http_request", classmethod(Mock(side_effect=IOError))):
+            self.assertRaises(IOError, self.request, "https://api.recurly.com/v2/accounts/1")
+
+        stats = metrics.get_stats()[("GET", "accounts/{code}")]
+        self.assertEqual((stats.count, stats.errors), (2, 2))
+        self.assertEqual(stats.statuses, {404: 1, None: 1})
+
+    def test_sinks(self):
+        calls = []
+        statsd = Mock()
+        metrics.add_sink(calls.append)
+        metrics.add_sink(metrics.make_statsd_sink(statsd))
+        try:
+            with metrics.api_caller("set_acquisition_data"):
+                self.request("https://api.recurly.com/v2/accounts/1/acquisition", method="PUT")
+        finally:
+            metrics.remove_sink(calls.append)
+            del metrics._sinks[:]
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][:3], ("PUT", "accounts/{code}/acquisition", 200))
+        self.assertEqual(calls[0].caller, "set_acquisition_data")
+        statsd.incr.assert_called_once_with("recurly.PUT.accounts.code.acquisition.200")
+        self.assertEqual(statsd.timing.call_args[0][0], "recurly.PUT.accounts.code.acquisition")
+
+
+class MetricsInstallTest(SimpleTestCase):
+
+    def test_install(self):
+        assert not metrics.is_installed()
+        metrics.install()
+        try:
+            assert metrics.is_installed()
+        finally:
+            metrics.uninstall()
+        assert not metrics.is_installed()
@@ -1,24 +1,50 @@
 import unittest
-import time
+import uuid
 import datetime
 import sys
+import threading
+from xml.etree import ElementTree
 
 import pytest
 from django.test import TestCase
+from django.db import connection, transaction
+from django.db.models.signals import post_save, pre_save
+from django.test.utils import CaptureQueriesContext
 from mock import patch, Mock
 import recurly
 
 from django_recurly.provisioning import update_local_account_data_from_recurly_resource, \
     update_local_subscription_data_from_recurly_resource, update_full_local_data_for_account_code, \
     create_and_sync_recurly_account, create_and_sync_recurly_subscription,\
-    update_and_sync_recurly_billing_info, update_and_sync_recurly_subscription
+    update_and_sync_recurly_billing_info, delete_and_sync_recurly_billing_info, update_and_sync_recurly_subscription, modelify, modelify_many, get_modelify_plan, \
+    sync_local_add_ons_from_recurly_resource, get_local_plan, lookup_plan_add_on, refresh_local_subscription
+from django_recurly import conf, handlers, resilience
+from django_recurly.exceptions import RecurlyUnavailableError
 from django_recurly.tests.base import BaseTest
+from django_recurly.fake_recurly import fake_recurly_api
 from django_recurly.models import *
+from django_recurly.models import BillingInfo, SubscriptionAddOn
 
 
 
 
 class AccountModelTest(BaseTest):
+    """Provisioning round trips, against a FakeRecurlyServer with the plans of our Recurly site."""
+
+    def setUp(self):
+        super(AccountModelTest, self).setUp()
+        fake_api = fake_recurly_api()
+        self.fake_api = fake_api.__enter__()
+        self.addCleanup(fake_api.__exit__, None, None, None)
+
+        if resilience.get_breaker() is not None:  # not tripped by the failures of other tests
+            patcher = patch.object(resilience, "_breaker", resilience.CircuitBreaker())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.fake_api.add_plan("premium-monthly", "PREMIUM Monthly", {"EUR": 1100})
+        self.fake_api.add_plan("premium-annual", "PREMIUM Annual", {"EUR": 11000}, plan_interval_length=12)
+        self.fake_api.add_plan("gift-3-months", "GIFT 3 months", {"EUR": 0}, plan_interval_length=3)
 
     def _get_billing_info_creation_params(self, **kwargs):
         res = dict(
@@ -56,7 +82,7 @@ class AccountModelTest(BaseTest):
 
     def _get_account_creation_params(self):
         return dict(
-            account_code="mytest_%s" % int(time.time()),
+            account_code="mytest_%s" % uuid.uuid4().hex[:12],  # unique, even when created within a second
             ## IGNORED state = "closed",
             username = "jane_username",
             email = "jane@doe.fr",
@@ -130,7 +156,7 @@ class AccountModelTest(BaseTest):
     def _create_coupon_code():
         from recurly import Coupon
         coupon = Coupon(
-            coupon_code='coupon_code_%s' % int(time.time()),
+            coupon_code='coupon_code_%s' % uuid.uuid4().hex[:12],
             duration='single_use',
             applies_to_all_plans=True,
             discount_type='percent',
@@ -400,6 +426,606 @@ class AccountModelTest(BaseTest):
         #addbreakage
 
 
+class ModelifyTest(BaseTest):
+
+    def _get_recurly_subscription(self, **replacements):
+        xml = self.resources["subscription-ok"]
+        for (old, new) in replacements.items():
+            xml = xml.replace(old, new)
+        return recurly.Subscription.from_element(ElementTree.fromstring(xml.encode("utf8")))
+
+    def test_modelify_plan(self):
+        plan = get_modelify_plan(recurly.Subscription, Subscription)
+        assert plan is get_modelify_plan(recurly.Subscription, Subscription)  # cached
+        assert plan is not get_modelify_plan(recurly.Subscription, Payment)
+
+        assert "plan_name" in plan.field_names  # monkey-patched attribute
+        assert "account" not in plan.field_names  # untouchable foreign key
+        assert "subscription_add_ons" not in plan.field_names  # not mirrored
+        self.assertEqual(plan.lowercased_field_names, set(["state", "collection_method"]))
+        self.assertEqual(plan.submodels, ())
+
+    def test_modelify_subscription(self):
+        recurly_subscription = self._get_recurly_subscription(**{"<state>active": "<state>ACTIVE"})
+        subscription = modelify(recurly_subscription, Subscription)
+
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        self.assertEqual(subscription.uuid, "403bfb8cefa599c6a3af954293b64987")
+        self.assertEqual(subscription.state, "active")
+        self.assertEqual(subscription.plan_code, "gold")
+        self.assertEqual(subscription.unit_amount_in_cents, 800)
+        assert subscription.canceled_at is None
+
+        recurly_subscription = self._get_recurly_subscription(**{"<state>active": "<state>canceled"})
+        subscription2 = modelify(recurly_subscription, Subscription)
+        self.assertEqual(subscription2.pk, subscription.pk)
+        self.assertEqual(Subscription.objects.get().state, "canceled")
+
+    def test_modelify_skips_unchanged_records(self):
+        recurly_subscription = self._get_recurly_subscription()
+        subscription = modelify(recurly_subscription, Subscription)
+        fingerprint = Subscription.objects.get().remote_fingerprint
+        self.assertEqual(len(fingerprint), 40)
+
+        with patch("django_recurly.provisioning._get_model_updates") as get_model_updates, \
+                self.assertNumQueries(2):  # lookups only
+            subscription2 = modelify(self._get_recurly_subscription(), Subscription)
+            subscriptions = modelify_many([self._get_recurly_subscription()], Subscription)
+        assert not get_model_updates.called
+        self.assertEqual(subscription2.pk, subscription.pk)
+        self.assertEqual(subscriptions[0].pk, subscription.pk)
+
+        recurly_subscription = self._get_recurly_subscription(**{"<quantity type=\"integer\">1": "<quantity type=\"integer\">2"})
+        modelify(recurly_subscription, Subscription)
+        subscription = Subscription.objects.get()
+        self.assertEqual(subscription.quantity, 2)
+        assert subscription.remote_fingerprint != fingerprint
+
+        recurly_subscription.quantity = 5  # local modification, payload doesn't reflect it
+        modelify(recurly_subscription, Subscription)
+        subscription = Subscription.objects.get()
+        self.assertEqual(subscription.quantity, 5)
+        assert subscription.remote_fingerprint is None
+
+    def test_sync_local_add_ons(self):
+        subscription = modelify(self._get_recurly_subscription(), Subscription)
+        for (add_on_code, quantity) in [("movie-1", 1), ("movie-2", 1), ("movie-2", 1), ("movie-3", 1)]:
+            SubscriptionAddOn.objects.create(subscription=subscription, add_on_code=add_on_code, quantity=quantity)
+
+        add_ons_xml = "".join(
+            "<subscription_add_on><add_on_code>%s</add_on_code>"
+            "<quantity type=\"integer\">%d</quantity></subscription_add_on>" % (add_on_code, quantity)
+            for (add_on_code, quantity) in [("movie-1", 1), ("movie-2", 2), ("movie-4", 1), ("movie-5", 1)])
+        recurly_subscription = self._get_recurly_subscription(**{
+            '<subscription_add_ons type="array">': '<subscription_add_ons type="array">' + add_ons_xml})
+
+        with self.assertNumQueries(6):  # prefetch, delete, insert and update (in a savepoint)
+            sync_local_add_ons_from_recurly_resource(recurly_subscription, subscription)
+
+        self.assertEqual(sorted(subscription.subscription_add_ons.values_list("add_on_code", "quantity")),
+                         [("movie-1", 1), ("movie-2", 2), ("movie-4", 1), ("movie-5", 1)])
+
+        with self.assertNumQueries(1):  # nothing to write
+            sync_local_add_ons_from_recurly_resource(recurly_subscription, subscription)
+
+    def test_modelify_many(self):
+        uuids = ["403bfb8cefa599c6a3af954293b6498%d" % i for i in range(4)]
+
+        saved = []
+        def _post_save_receiver(sender, instance, created, **kwargs):
+            saved.append((instance.uuid, created))
+        post_save.connect(_post_save_receiver, sender=Subscription, weak=False, dispatch_uid="test_modelify_many")
+        self.addCleanup(post_save.disconnect, sender=Subscription, dispatch_uid="test_modelify_many")
+
+        recurly_subscriptions = [self._get_recurly_subscription(**{"403bfb8cefa599c6a3af954293b64987": uuid})
+                                 for uuid in uuids[:3]]
+        with self.assertNumQueries(3):  # lookup, insert and pk lookup
+            subscriptions = modelify_many(recurly_subscriptions, Subscription)
+        self.assertEqual([subscription.uuid for subscription in subscriptions], uuids[:3])
+        assert all(subscription.pk for subscription in subscriptions)
+        self.assertEqual(Subscription.objects.count(), 3)
+        self.assertEqual(sorted(saved), [(uuid, True) for uuid in uuids[:3]])
+
+        del saved[:]
+        recurly_subscriptions = [
+            self._get_recurly_subscription(**{"403bfb8cefa599c6a3af954293b64987": uuids[3]}),  # new
+            self._get_recurly_subscription(**{"403bfb8cefa599c6a3af954293b64987": uuids[2],
+                                              "<state>active": "<state>canceled"}),
+            self._get_recurly_subscription(**{"403bfb8cefa599c6a3af954293b64987": uuids[1]}),  # unchanged
+            self._get_recurly_subscription(**{"403bfb8cefa599c6a3af954293b64987": uuids[0],
+                                              "<quantity type=\"integer\">1": "<quantity type=\"integer\">3"}),
+        ]
+        with self.assertNumQueries(5):  # lookup, insert, pk lookup and 2 updates
+            subscriptions = modelify_many(recurly_subscriptions, Subscription)
+        self.assertEqual([subscription.uuid for subscription in subscriptions], [uuids[3], uuids[2], uuids[1], uuids[0]])
+        self.assertEqual(sorted(saved), [(uuids[0], False), (uuids[2], False), (uuids[3], True)])
+
+        self.assertEqual(subscriptions[0].pk, Subscription.objects.get(uuid=uuids[3]).pk)
+        self.assertEqual([(s.uuid, s.state, s.quantity) for s in Subscription.objects.order_by("uuid")],
+                         [(uuids[0], "active", 3), (uuids[1], "active", 1),
+                          (uuids[2], "canceled", 1), (uuids[3], "active", 1)])
+        assert not any(subscription.is_dirty() for subscription in subscriptions)
+
+
+class SaveDirtyModelTest(BaseTest):
+
+    def test_dirty_save_updates_modified_columns_only(self):
+        subscription = Subscription.objects.create(uuid="403bfb8cefa599c6a3af954293b64987", xml="<xml/>" * 1000)
+        subscription = Subscription.objects.get(pk=subscription.pk)
+
+        subscription.state = "canceled"
+        with CaptureQueriesContext(connection) as queries:
+            subscription.save()
+        self.assertEqual(len(queries), 1)
+        assert queries[0]["sql"].startswith("UPDATE")
+        assert '"state"' in queries[0]["sql"]
+        assert '"xml"' not in queries[0]["sql"]
+        assert not subscription.is_dirty()
+        self.assertEqual(Subscription.objects.get().state, "canceled")
+
+        with self.assertNumQueries(0):
+            subscription.save()  # not dirty
+
+        account = Account.objects.create(account_code="verena@test.com")
+        account = Account.objects.get(pk=account.pk)
+        modified = account.modified
+        account.first_name = "Verena"
+        with CaptureQueriesContext(connection) as queries:
+            account.save()
+        assert '"first_name"' in queries[0]["sql"]
+        assert '"modified"' in queries[0]["sql"]  # auto_now field
+        assert '"email"' not in queries[0]["sql"]
+        assert Account.objects.get().modified > modified
+
+    def test_dirty_save_of_deleted_row(self):
+        subscription = Subscription.objects.create(uuid="403bfb8cefa599c6a3af954293b64987", xml="<xml/>")
+        Subscription.objects.all().delete()  # eg. by a concurrent sync
+
+        subscription.state = "canceled"
+        with transaction.atomic():
+            subscription.save()  # inserted again whole, like a full save
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        self.assertEqual((subscription.state, subscription.xml), ("canceled", "<xml/>"))
+
+    def test_state_snapshots(self):
+        subscription = Subscription(uuid="403bfb8cefa599c6a3af954293b64987")
+        assert isinstance(subscription._original_values, tuple)
+        self.assertEqual(subscription._original_state["uuid"], "403bfb8cefa599c6a3af954293b64987")
+        assert "account" in subscription._original_state  # foreign keys are tracked by id
+        subscription.save()
+
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        self.assertEqual(subscription.dirty_fields(), {})
+        subscription.state = "expired"
+        subscription.quantity = 2
+        self.assertEqual(subscription.dirty_fields(),
+                         {"state": {"new": "expired", "old": "active"}, "quantity": {"new": 2, "old": 1}})
+
+        subscription.save()
+        self.assertEqual(subscription._previous_state["state"], "active")
+        self.assertEqual(subscription._original_state["state"], "expired")
+        assert not subscription.is_dirty()
+
+    def test_bulk_save_dirty(self):
+        subscriptions = [Subscription.objects.create(uuid="uuid-%d" % i) for i in range(4)]
+        subscriptions = list(Subscription.objects.order_by("uuid"))
+        subscriptions[0].state = "canceled"
+        subscriptions[1].state = "canceled"
+        subscriptions[2].quantity = 3
+        new_subscription = Subscription(uuid="uuid-new")
+
+        saving = []
+        saved = []
+        def _on_pre_save(sender, instance, update_fields, **kwargs):
+            saving.append((instance.uuid, update_fields))
+        def _on_post_save(sender, instance, created, update_fields, **kwargs):
+            saved.append((instance.uuid, created, update_fields))
+        pre_save.connect(_on_pre_save, sender=Subscription)
+        post_save.connect(_on_post_save, sender=Subscription)
+        try:
+            with self.assertNumQueries(4):  # insert, pk lookup, and 1 update per set of dirty fields
+                created, updated = Subscription.objects.bulk_save_dirty(subscriptions + [new_subscription])
+        finally:
+            pre_save.disconnect(_on_pre_save, sender=Subscription)
+            post_save.disconnect(_on_post_save, sender=Subscription)
+
+        self.assertEqual(created, [new_subscription])
+        self.assertEqual(sorted(subscription.uuid for subscription in updated), ["uuid-0", "uuid-1", "uuid-2"])
+        self.assertEqual(sorted(saved), [("uuid-0", False, frozenset(["state"])),
+                                         ("uuid-1", False, frozenset(["state"])),
+                                         ("uuid-2", False, frozenset(["quantity"])),
+                                         ("uuid-new", True, None)])
+        self.assertEqual(sorted(saving), [(uuid, update_fields) for (uuid, created, update_fields) in sorted(saved)])
+        assert new_subscription.pk
+        assert not any(subscription.is_dirty() for subscription in subscriptions + [new_subscription])
+        self.assertEqual(subscriptions[0]._previous_state["state"], "active")
+        self.assertEqual(subscriptions[0]._original_state["state"], "canceled")
+
+        self.assertEqual(dict(Subscription.objects.values_list("uuid", "state")),
+                         {"uuid-0": "canceled", "uuid-1": "canceled", "uuid-2": "active",
+                          "uuid-3": "active", "uuid-new": "active"})
+        self.assertEqual(Subscription.objects.get(uuid="uuid-2").quantity, 3)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Subscription.objects.bulk_save_dirty(subscriptions), ([], []))
+
+    def test_bulk_save_dirty_without_lookup_field(self):
+        subscription = Subscription.objects.create(uuid="uuid-0")
+        add_on = SubscriptionAddOn(subscription=subscription, add_on_code="extra", quantity=2)
+
+        saved = []
+        def _on_post_save(sender, instance, **kwargs):
+            saved.append(instance)
+        post_save.connect(_on_post_save, sender=SubscriptionAddOn)
+        try:
+            created, updated = SubscriptionAddOn.objects.bulk_save_dirty([add_on])
+        finally:
+            post_save.disconnect(_on_post_save, sender=SubscriptionAddOn)
+
+        self.assertEqual((created, updated), ([add_on], []))
+        self.assertEqual(SubscriptionAddOn.objects.filter(subscription=subscription, add_on_code="extra").count(), 1)
+        if add_on.pk is None:  # the backend didn't return it
+            assert add_on._state.adding
+            self.assertEqual(saved, [])
+        else:
+            self.assertEqual(saved, [add_on])
+            assert not add_on.is_dirty()
+
+
+class FullAccountResyncTest(BaseTest):
+
+    BILLING_INFO_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<billing_info href="https://api.recurly.com/v2/accounts/1/billing_info">
+  <account href="https://api.recurly.com/v2/accounts/1"/>
+  <first_name>Verena</first_name>
+  <last_name>Test</last_name>
+  <country>FR</country>
+</billing_info>"""
+
+    def _get_remote_elements(self, subscription_count):
+        subscriptions_xml = "".join(
+            self.resources["subscription-ok"].split("?>", 1)[1].replace(
+                "403bfb8cefa599c6a3af954293b64987", "403bfb8cefa599c6a3af954293b6498%d" % i)
+            for i in range(subscription_count))
+        return {
+            "https://api.recurly.com/v2/accounts/1/billing_info": self.BILLING_INFO_XML,
+            "https://api.recurly.com/v2/accounts/1/subscriptions":
+                '<subscriptions type="array">%s</subscriptions>' % subscriptions_xml,
+        }
+
+    def setUp(self):
+        super(FullAccountResyncTest, self).setUp()
+        self.fetching_threads = set()
+
+    def _resync(self, subscription_count, queries=None, unchanged=False, force=False):
+        remote_elements = self._get_remote_elements(subscription_count)
+
+        def _element_for_url(url):
+            self.fetching_threads.add(threading.current_thread().name)
+            xml = remote_elements[url.replace("/accounts/verena%40test.com/", "/accounts/1/")]
+            return Mock(getheader=Mock(return_value="")), ElementTree.fromstring(xml.encode("utf8"))
+
+        recurly_account = recurly.Account.from_element(ElementTree.fromstring(self.resources["account-ok"].encode("utf8")))
+        with patch("django_recurly.provisioning.get_resource_if_modified",
+                   return_value=None if unchanged else recurly_account) as self.get_resource_if_modified, \
+                patch.object(recurly.Resource, "element_for_url", side_effect=_element_for_url):
+            if queries is None:
+                return update_full_local_data_for_account_code(account_code="verena@test.com", force=force)
+            with self.assertNumQueries(queries):
+                return update_full_local_data_for_account_code(account_code="verena@test.com", force=force)
+
+    def test_full_resync_query_count(self):
+        # account lookup (twice, as it's new)/insert, billing info lookup/insert, subscriptions
+        # lookup/insert/pk lookup, add-ons prefetch, obsolete subscriptions lookup, and savepoints
+        account = self._resync(subscription_count=5, queries=12)
+        self.assertEqual(account.subscriptions.count(), 5)
+        self.assertEqual(account.billing_info.country, "FR")
+
+        # account and billing info are unchanged
+        account = self._resync(subscription_count=20, queries=9)
+        self.assertEqual(account.subscriptions.count(), 20)
+
+        # nothing changed
+        account = self._resync(subscription_count=20, queries=7)
+        self.assertEqual(account.subscriptions.count(), 20)
+
+        account = self._resync(subscription_count=3)
+        self.assertEqual(sorted(account.subscriptions.values_list("uuid", flat=True)),
+                         ["403bfb8cefa599c6a3af954293b6498%d" % i for i in range(3)])
+
+    @patch.object(conf, "REMOTE_FETCH_WORKERS", 2)
+    def test_full_resync_with_concurrent_fetches(self):
+        account = self._resync(subscription_count=5, queries=12)
+        self.assertEqual(account.subscriptions.count(), 5)
+        self.assertEqual(account.billing_info.country, "FR")
+        assert threading.current_thread().name not in self.fetching_threads
+
+    def test_full_resync_of_unchanged_account(self):
+        self._resync(subscription_count=2)
+        Account.objects.update(first_name="Local")
+
+        # the remote account answered "304 Not Modified", its billing info and subscriptions are still sync'ed
+        BillingInfo.objects.all().delete()
+        account = self._resync(subscription_count=3, unchanged=True)
+        self.assertEqual(account.first_name, "Local")
+        self.assertEqual(account.billing_info.country, "FR")
+        self.assertEqual(account.subscriptions.count(), 3)
+
+    def test_forced_full_resync(self):
+        self._resync(subscription_count=2)
+        Account.objects.update(first_name="Local")
+        Subscription.objects.update(quantity=7)
+
+        account = self._resync(subscription_count=2)  # remote data unchanged, local changes are kept
+        self.assertEqual(account.first_name, "Local")
+
+        account = self._resync(subscription_count=2, force=True)
+        self.get_resource_if_modified.assert_called_once_with(recurly.Account, "verena@test.com", None)  # no validators
+        self.assertEqual(account.first_name, "Verena")
+        self.assertEqual(set(account.subscriptions.values_list("quantity", flat=True)), set([1]))
+
+    def test_full_resync_is_atomic(self):
+        with patch("django_recurly.provisioning.sync_local_add_ons_from_recurly_resource",
+                   side_effect=ValueError("boom")):
+            with self.assertRaises(ValueError):
+                self._resync(subscription_count=2)
+        self.assertEqual(Account.objects.count(), 0)
+        self.assertEqual(Subscription.objects.count(), 0)
+
+
+class WriteRoundTripTest(BaseTest):
+    """Local data is sync'ed from the responses of writes, without fetching remote resources again."""
+
+    def setUp(self):
+        super(WriteRoundTripTest, self).setUp()
+        recurly_account = recurly.Account.from_element(ElementTree.fromstring(self.resources["account-ok"].encode("utf8")))
+        recurly_account.__dict__["billing_info"] = None
+        self.account = update_local_account_data_from_recurly_resource(recurly_account)
+
+        self.requests = []
+        self.request_bodies = []
+        self.responses = {}
+
+        def _http_request(cls, url, method='GET', body=None, headers=None):
+            self.requests.append((method, url))
+            self.request_bodies.append(ElementTree.tostring(body.to_element()) if body is not None else None)
+            status, xml = self.responses[(method, url)]
+            return Mock(status=status, getheader=Mock(return_value=None), read=Mock(return_value=xml.encode("utf8")))
+
+        patcher = patch.object(recurly.Resource, "http_request", classmethod(_http_request))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_update_subscription(self):
+        subscription_url = "https://api.recurly.com/v2/subscriptions/403bfb8cefa599c6a3af954293b64987"
+        self.responses[("PUT", subscription_url)] = (200, self.resources["subscription-ok"])
+
+        subscription = update_and_sync_recurly_subscription(
+            Subscription(uuid="403bfb8cefa599c6a3af954293b64987"), dict(quantity=1))
+        self.assertEqual(self.requests, [("PUT", subscription_url)])
+        self.assertEqual(self.request_bodies,  # no currency
+                         [b'<subscription><quantity type="integer">1</quantity><timeframe>now</timeframe></subscription>'])
+        self.assertEqual(subscription.plan_code, "gold")
+        self.assertEqual(Subscription.objects.get().pk, subscription.pk)
+
+    def test_update_and_delete_billing_info(self):
+        billing_info_url = "https://api.recurly.com/v2/accounts/verena%40test.com/billing_info"
+        self.responses[("PUT", billing_info_url)] = (200, FullAccountResyncTest.BILLING_INFO_XML)
+        self.responses[("DELETE", billing_info_url)] = (204, "")
+
+        account = update_and_sync_recurly_billing_info(self.account, dict(first_name="Verena", country="FR",
+                                                                            number="4111-1111-1111-1111"))
+        self.assertEqual(self.requests, [("PUT", billing_info_url)])
+        self.assertEqual(account.pk, self.account.pk)
+        self.assertEqual(BillingInfo.objects.get(account=account).country, "FR")
+
+        account = delete_and_sync_recurly_billing_info(account)
+        self.assertEqual(self.requests[1:], [("DELETE", billing_info_url)])
+        self.assertEqual(BillingInfo.objects.count(), 0)
+
+
+class ConditionalGetTest(BaseTest):
+
+    SUBSCRIPTION_URL = "https://api.recurly.com/v2/subscriptions/403bfb8cefa599c6a3af954293b64987"
+
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        self.requests = []
+
+        def _http_request(cls, url, method='GET', body=None, headers=None):
+            self.requests.append((url, headers))
+            if headers.get("If-None-Match") == '"v1"':
+                return Mock(status=304, read=Mock(return_value=b""))
+            response_headers = {"etag": '"v1"', "last-modified": "Tue, 25 Oct 2011 12:00:00 GMT"}
+            return Mock(status=200, getheader=response_headers.get,
+                        read=Mock(return_value=self.resources["subscription-ok"].encode("utf8")))
+
+        patcher = patch.object(recurly.Resource, "http_request", classmethod(_http_request))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refresh_local_subscription(self):
+        subscription = refresh_local_subscription("403bfb8cefa599c6a3af954293b64987")
+        self.assertEqual(self.requests, [(self.SUBSCRIPTION_URL, {})])
+        self.assertEqual((subscription.remote_etag, subscription.remote_last_modified),
+                         ('"v1"', "Tue, 25 Oct 2011 12:00:00 GMT"))
+        self.assertEqual(subscription.plan_code, "gold")
+
+        # unchanged: only the local lookup, no parsing nor writes
+        with self.assertNumQueries(1), \
+                patch("django_recurly.provisioning.modelify", side_effect=AssertionError("no conversion expected")):
+            self.assertEqual(refresh_local_subscription("403bfb8cefa599c6a3af954293b64987").pk, subscription.pk)
+        self.assertEqual(self.requests[1], (self.SUBSCRIPTION_URL, {"If-None-Match": '"v1"',
+                                                                    "If-Modified-Since": "Tue, 25 Oct 2011 12:00:00 GMT"}))
+
+    def test_validators_are_dropped_with_other_payloads(self):
+        subscription = refresh_local_subscription("403bfb8cefa599c6a3af954293b64987")
+
+        # eg. from a list or a push notification, so without validators
+        xml = self.resources["subscription-ok"].replace('<quantity type="integer">1<', '<quantity type="integer">2<')
+        update_local_subscription_data_from_recurly_resource(
+            recurly.Subscription.from_element(ElementTree.fromstring(xml.encode("utf8"))))
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        self.assertEqual((subscription.quantity, subscription.remote_etag), (2, None))
+
+
+class PlanCatalogTest(BaseTest):
+
+    PLAN_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<plan href="https://api.recurly.com/v2/plans/gold">
+  <add_ons href="https://api.recurly.com/v2/plans/gold/add_ons"/>
+  <plan_code>gold</plan_code>
+  <name>Gold plan</name>
+  <plan_interval_length type="integer">1</plan_interval_length>
+  <plan_interval_unit>months</plan_interval_unit>
+  <unit_amount_in_cents>
+    <USD type="integer">1000</USD>
+    <EUR type="integer">800</EUR>
+  </unit_amount_in_cents>
+  <setup_fee_in_cents>
+    <USD type="integer">0</USD>
+  </setup_fee_in_cents>
+  <created_at type="datetime">2011-04-19T07:00:00Z</created_at>
+</plan>"""
+
+    ADD_ON_XML = """<add_on href="https://api.recurly.com/v2/plans/gold/add_ons/%(code)s">
+    <add_on_code>%(code)s</add_on_code>
+    <name>Movie %(code)s</name>
+    <default_quantity type="integer">1</default_quantity>
+    <unit_amount_in_cents>
+      <EUR type="integer">300</EUR>
+    </unit_amount_in_cents>
+  </add_on>"""
+
+    def setUp(self):
+        super(PlanCatalogTest, self).setUp()
+        self.add_on_codes = ["movie_100", "movie_200"]
+
+        def _element_for_url(url):
+            assert url.endswith("/add_ons"), url
+            xml = '<add_ons type="array">%s</add_ons>' % "".join(self.ADD_ON_XML % dict(code=code)
+                                                                 for code in self.add_on_codes)
+            return Mock(getheader=Mock(return_value="")), ElementTree.fromstring(xml.encode("utf8"))
+
+        patchers = [
+            patch("recurly.Plan.get", side_effect=lambda plan_code: recurly.Plan.from_element(
+                ElementTree.fromstring(self.PLAN_XML.replace(b"gold", plan_code.encode("utf8"))))),
+            patch.object(recurly.Resource, "element_for_url", side_effect=_element_for_url),
+        ]
+        self.plan_get = patchers[0].start()
+        patchers[1].start()
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def test_plan_is_mirrored_on_miss(self):
+        plan = get_local_plan("gold")
+        self.assertEqual(self.plan_get.call_count, 1)
+        self.assertEqual(plan.name, "Gold plan")
+        self.assertEqual(plan.plan_interval_unit, "months")
+        self.assertEqual(plan.get_unit_amounts_in_cents(), {"USD": 1000, "EUR": 800})
+        self.assertEqual(plan.get_setup_fees_in_cents(), {"USD": 0})
+        self.assertEqual(sorted(add_on.add_on_code for add_on in plan.plan_add_ons.all()), self.add_on_codes)
+
+        with self.assertNumQueries(2):  # plan and its add-ons
+            description = lookup_plan_add_on("gold", "movie_200")
+        self.assertEqual(self.plan_get.call_count, 1)
+        self.assertEqual(description, {
+            "plan_duration": 1,
+            "plan_duration_unit": "months",
+            "add_on_list": [{"add_on_code": "movie_200", "name": "Movie movie_200", "currencies": {"EUR": 300}}],
+        })
+        self.assertEqual(len(lookup_plan_add_on("gold")["add_on_list"]), 2)
+
+    def test_outdated_catalog_is_refreshed(self):
+        get_local_plan("gold")
+        self.add_on_codes = ["movie_200", "movie_300"]
+
+        self.assertEqual(lookup_plan_add_on("gold", "movie_300")["add_on_list"][0]["add_on_code"], "movie_300")
+        self.assertEqual(self.plan_get.call_count, 2)
+        self.assertEqual(sorted(PlanAddOn.objects.values_list("add_on_code", flat=True)), self.add_on_codes)
+
+        with self.assertRaises(recurly.NotFoundError) as context:
+            lookup_plan_add_on("gold", "movie_400")
+        self.assertEqual(context.exception.symbol, "not_found")
+        self.assertEqual(self.plan_get.call_count, 3)
+
+    def test_subscription_notification_mirrors_plan(self):
+        data = self.parse_xml(self.push_notifications["new_subscription_notification-ok"])
+        handlers.plan(sender=recurly, **data)
+        self.assertEqual(list(Plan.objects.values_list("plan_code", flat=True)), ["bronze"])
+
+        handlers.plan(sender=recurly, **data)  # already known
+        self.assertEqual(self.plan_get.call_count, 1)
+
+    def test_plan_mirroring_failure_is_ignored(self):
+        data = self.parse_xml(self.push_notifications["new_subscription_notification-ok"])
+        self.plan_get.side_effect = RecurlyUnavailableError(retry_at=0)
+        handlers.plan(sender=recurly, **data)
+        self.assertEqual(Plan.objects.count(), 0)
+
+
+class PaymentNotificationTest(BaseTest):
+
+    TRANSACTION_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<transaction href="https://api.recurly.com/v2/transactions/a5143c1d3a6f4a8287d0e2cc1d4c0427">
+  <account href="https://api.recurly.com/v2/accounts/verena%40test.com"/>
+  <invoice href="https://api.recurly.com/v2/invoices/1108"/>
+  <uuid>a5143c1d3a6f4a8287d0e2cc1d4c0427</uuid>
+  <action>purchase</action>
+  <amount_in_cents type="integer">1000</amount_in_cents>
+  <currency>USD</currency>
+  <status>success</status>
+  <reference>12345</reference>
+  <created_at type="datetime">2009-11-22T21:10:38Z</created_at>
+</transaction>"""
+
+    @patch.object(conf, "TRUST_PAYMENT_NOTIFICATIONS", True)
+    @patch("recurly.Transaction.get", side_effect=AssertionError("no remote call expected"))
+    def test_trusted_payment_notification(self, transaction_get):
+        account = Account.objects.create(account_code="verena@test.com")
+
+        data = self.parse_xml(self.push_notifications["successful_payment_notification-ok"])
+        payment = Payment.handle_notification(**data)
+
+        payment = Payment.objects.get(pk=payment.pk)
+        assert payment.needs_verification
+        assert payment.account == account
+        assert payment.transaction_id == "a5143c1d3a6f4a8287d0e2cc1d4c0427"
+        assert payment.invoice_id == "ffc64d71d4b5404e93f13aac9c63bxxx"
+        assert payment.action == "purchase"
+        assert payment.status == "success"
+        assert payment.amount_in_cents == 1000
+        assert payment.message == "Bogus Gateway: Forced success"
+        assert payment.created_at == datetime.datetime(2009, 11, 22, 21, 10, 38, tzinfo=payment.created_at.tzinfo)
+
+        # same transaction, now failed
+        data = self.parse_xml(self.push_notifications["failed_payment_notification-ok"])
+        payment = Payment.handle_notification(**data)
+        assert Payment.objects.count() == 1
+        assert Payment.objects.get().status == "declined"
+
+    @patch.object(conf, "TRUST_PAYMENT_NOTIFICATIONS", True)
+    def test_verify_trusted_payment(self):
+        data = self.parse_xml(self.push_notifications["successful_payment_notification-ok"])
+        payment = Payment.handle_notification(**data)
+        assert payment.account is None  # not mirrored yet
+        account = Account.objects.create(account_code="verena@test.com")
+
+        recurly_transaction = recurly.Transaction.from_element(ElementTree.fromstring(self.TRANSACTION_XML))
+        recurly_invoice = Mock(uuid="ffc64d71d4b5404e93f13aac9c63b007")
+        with patch("recurly.Transaction.get", return_value=recurly_transaction), \
+             patch.object(recurly.Transaction, "invoice", create=True, return_value=recurly_invoice):
+            payment.verify()
+
+        payment = Payment.objects.get(pk=payment.pk)
+        assert not payment.needs_verification
+        assert payment.invoice_id == "ffc64d71d4b5404e93f13aac9c63b007"
+        assert payment.reference == "12345"
+        assert payment.account == account
+        assert "<reference>12345</reference>" in payment.xml
+        assert payment.message == "Bogus Gateway: Forced success"  # only known from notification
+
+
 '''
     # ------------------------------------- BROKEN STUFFS BELOW
 
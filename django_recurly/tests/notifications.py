@@ -0,0 +1,213 @@
+import datetime
+
+from django.utils import timezone
+from mock import patch
+
+from django_recurly import conf, notifications, views
+from django_recurly.models import NotificationReceipt, PushNotification
+from django_recurly.tests.base import BaseTest, RequestFactory
+
+rf = RequestFactory()
+
+
+class NotificationInboxTest(BaseTest):
+
+    def _post_notification(self, name):
+        request = rf.post("/junk", self.push_notifications[name].encode("utf8"), content_type="text/xml")
+        return views.push_notifications(request)
+
+    def test_inbox_defers_signals(self):
+        with patch.object(conf, "NOTIFICATION_INBOX", True):
+            response = self._post_notification("new_account_notification-ok")
+        self.assertEqual(response.status_code, 204)
+
+        self.assertNoSignal("push_notification")
+        self.assertNoSignal("new_account_notification")
+
+        notification = PushNotification.objects.get()
+        self.assertEqual(notification.state, "pending")
+        self.assertEqual(notification.notification_type, "new_account_notification")
+        self.assertEqual(notification.account_code, "verena@test.com")
+
+        processed, failed = notifications.process_pending_notifications()
+        self.assertEqual((processed, failed), (1, 0))
+
+        self.assertSignal("push_notification")
+        self.assertSignal("new_account_notification")
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.state, "processed")
+        self.assertEqual(notification.attempts, 1)
+        assert notification.processed_at
+
+        # nothing left to do
+        self.assertEqual(notifications.process_pending_notifications(), (0, 0))
+
+    def test_inbox_rejects_invalid_notification(self):
+        with patch.object(conf, "NOTIFICATION_INBOX", True):
+            response = self._post_notification("new_account_notification-ok")
+            self.assertEqual(response.status_code, 204)
+
+            request = rf.post("/junk", b"<unknown_notification></unknown_notification>", content_type="text/xml")
+            response = views.push_notifications(request)
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(PushNotification.objects.count(), 1)
+
+    def test_inbox_failure_and_retries(self):
+        with patch.object(conf, "NOTIFICATION_INBOX", True):
+            self._post_notification("new_account_notification-ok")
+
+        with patch.object(conf, "NOTIFICATION_INBOX_MAX_ATTEMPTS", 2), \
+             patch.object(notifications, "dispatch_notification", side_effect=ValueError("boom")):
+
+            self.assertEqual(notifications.process_pending_notifications(), (0, 1))
+            notification = PushNotification.objects.get()
+            self.assertEqual(notification.state, "pending")  # will be retried
+            self.assertEqual(notification.attempts, 1)
+            assert "boom" in notification.last_error
+
+            self.assertEqual(notifications.process_pending_notifications(), (0, 1))
+            notification.refresh_from_db()
+            self.assertEqual(notification.state, "failed")
+            self.assertEqual(notification.attempts, 2)
+
+        self.assertEqual(notifications.process_pending_notifications(), (0, 0))
+
+    def test_partial_failure_of_an_account(self):
+        with patch.object(conf, "NOTIFICATION_INBOX", True):
+            self._post_notification("new_account_notification-ok")
+            self._post_notification("billing_info_updated_notification-ok")  # same account
+
+        def _dispatch(xml):
+            if b"billing_info_updated_notification" in xml:
+                raise ValueError("boom")
+
+        with patch.object(notifications, "dispatch_notification", side_effect=_dispatch):
+            self.assertEqual(notifications.process_pending_notifications(), (1, 1))
+
+        self.assertEqual(PushNotification.objects.get(notification_type="new_account_notification").state,
+                         "processed")
+        self.assertEqual(PushNotification.objects.get(notification_type="billing_info_updated_notification").state,
+                         "pending")
+
+    def test_stale_notifications_are_requeued(self):
+        with patch.object(conf, "NOTIFICATION_INBOX", True):
+            self._post_notification("new_account_notification-ok")
+
+        claimed = notifications.claim_pending_notifications()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(notifications.claim_pending_notifications(), [])  # already claimed
+
+        self.assertEqual(notifications.requeue_stale_notifications(stale_seconds=3600), 0)
+        self.assertEqual(notifications.requeue_stale_notifications(stale_seconds=-1), 1)
+        self.assertEqual(len(notifications.claim_pending_notifications()), 1)
+
+
+class NotificationCoalescingTest(BaseTest):
+
+    NOTIFICATION_NAMES = (
+        "new_subscription_notification-ok",
+        "billing_info_updated_notification-ok",
+        "successful_payment_notification-ok",
+        "failed_payment_notification-ok",  # same transaction as above
+        "successful_refund_notification-ok",
+        "canceled_subscription_notification-ok",
+    )
+
+    def setUp(self):
+        super(NotificationCoalescingTest, self).setUp()
+        for name in self.NOTIFICATION_NAMES:
+            notifications.enqueue_notification(self.push_notifications[name].encode("utf8"))
+
+    @patch.object(conf, "NOTIFICATION_COALESCE_WINDOW", 60)
+    @patch("django_recurly.models.Payment.handle_notification")
+    @patch("django_recurly.provisioning.update_full_local_data_for_account_code")
+    def test_burst_is_coalesced(self, update_full_local_data, handle_payment_notification):
+
+        # too recent, more notifications might come for these accounts
+        self.assertEqual(notifications.process_pending_notifications(), (0, 0))
+        assert not update_full_local_data.called
+
+        PushNotification.objects.update(created=timezone.now() - datetime.timedelta(seconds=120))
+
+        processed, failed = notifications.process_pending_notifications()
+        self.assertEqual((processed, failed), (len(self.NOTIFICATION_NAMES), 0))
+
+        update_full_local_data.assert_called_once_with(account_code="verena@test.com")
+        transaction_ids = sorted(call[1]["transaction"].id for call in handle_payment_notification.call_args_list)
+        self.assertEqual(transaction_ids, ["2c7a2e30547e49869efd4e8a44b2be34", "a5143c1d3a6f4a8287d0e2cc1d4c0427"])
+
+        # listeners are still notified of each notification
+        self.assertSignal("new_subscription_notification")
+        self.assertSignal("billing_info_updated_notification")
+        self.assertSignal("failed_payment_notification")
+        self.assertEqual(PushNotification.objects.filter(state="processed").count(), len(self.NOTIFICATION_NAMES))
+
+    @patch.object(conf, "NOTIFICATION_COALESCE_WINDOW", 60)
+    @patch("django_recurly.provisioning.update_full_local_data_for_account_code", side_effect=ValueError("boom"))
+    def test_coalesced_failure(self, update_full_local_data):
+        PushNotification.objects.update(created=timezone.now() - datetime.timedelta(seconds=120))
+
+        self.assertEqual(notifications.process_pending_notifications(), (0, len(self.NOTIFICATION_NAMES)))
+        self.assertEqual(update_full_local_data.call_count, 1)
+        self.assertNoSignal("push_notification")
+        self.assertEqual(PushNotification.objects.filter(state="pending", attempts=1).count(),
+                         len(self.NOTIFICATION_NAMES))
+
+
+@patch.object(conf, "NOTIFICATION_LEDGER", True)
+class NotificationLedgerTest(BaseTest):
+
+    def setUp(self):
+        super(NotificationLedgerTest, self).setUp()
+        notifications.reset_ledger_stats()
+
+    def _post_notification(self, name):
+        request = rf.post("/junk", self.push_notifications[name].encode("utf8"), content_type="text/xml")
+        return views.push_notifications(request)
+
+    def test_redelivery_is_ignored(self):
+        response = self._post_notification("new_account_notification-ok")
+        self.assertEqual(response.status_code, 204)
+        self.assertSignal("new_account_notification")
+
+        self.resetSignals()
+        response = self._post_notification("new_account_notification-ok")
+        self.assertEqual(response.status_code, 204)
+        self.assertNoSignal("new_account_notification")
+
+        self.assertEqual(notifications.get_ledger_stats(), {"hits": 1, "misses": 1})
+        receipt = NotificationReceipt.objects.get()
+        self.assertEqual(receipt.notification_type, "new_account_notification")
+        self.assertEqual(receipt.account_code, "verena@test.com")
+
+    def test_failed_dispatch_is_not_recorded(self):
+        with patch.object(notifications, "dispatch_notification", side_effect=ValueError("boom")):
+            with self.assertRaises(ValueError):
+                self._post_notification("new_account_notification-ok")
+        self.assertEqual(NotificationReceipt.objects.count(), 0)
+
+        self._post_notification("new_account_notification-ok")
+        self.assertSignal("new_account_notification")
+
+    def test_expired_receipts(self):
+        self._post_notification("new_account_notification-ok")
+        NotificationReceipt.objects.update(received_at=timezone.now() - datetime.timedelta(days=30))
+
+        self.resetSignals()
+        self._post_notification("new_account_notification-ok")
+        self.assertSignal("new_account_notification")  # too old to be a redelivery
+        self.assertEqual(NotificationReceipt.objects.count(), 1)
+
+        NotificationReceipt.objects.update(received_at=timezone.now() - datetime.timedelta(days=30))
+        self.assertEqual(notifications.purge_expired_notification_receipts(), 1)
+
+    def test_redelivery_is_enqueued_once(self):
+        with patch.object(conf, "NOTIFICATION_INBOX", True):
+            self._post_notification("new_account_notification-ok")
+            self._post_notification("new_account_notification-ok")
+            self._post_notification("canceled_account_notification-ok")
+
+        self.assertEqual(PushNotification.objects.count(), 2)
+        self.assertEqual(notifications.get_ledger_stats(), {"hits": 1, "misses": 2})
@@ -0,0 +1,100 @@
+import pickle
+
+import recurly
+from django.test import SimpleTestCase
+from mock import patch
+
+from django_recurly import conf, resilience
+from django_recurly.exceptions import RecurlyUnavailableError
+from django_recurly.fake_recurly import DROP, fake_recurly_api
+from django_recurly.tests.base import FakeClock
+
+ACCOUNT_CODE = "verena@test.com"  # of the fixtures
+
+
+@patch.object(conf, "RETRY_BACKOFF", 0)
+class ResilienceTest(SimpleTestCase):
+
+    def setUp(self):
+        fake_api = fake_recurly_api()
+        self.server = fake_api.__enter__()
+        self.addCleanup(fake_api.__exit__, None, None, None)
+
+        self.previous_breaker = resilience.get_breaker()
+        self.clock = FakeClock()
+        self.breaker = resilience.install(resilience.CircuitBreaker(
+            threshold=0.5, window=4, min_calls=4, cooldown=30, clock=self.clock))
+
+    def tearDown(self):
+        if self.previous_breaker is None:
+            resilience.uninstall()
+        else:
+            resilience.install(self.previous_breaker)
+
+    def test_gets_are_retried(self):
+        self.server.faults = [DROP, 503, None]
+        self.assertEqual(recurly.Account.get(ACCOUNT_CODE).email, "verena@test.com")
+        self.assertEqual(len(self.server.requests), 3)
+        counters = resilience.get_counters()
+        self.assertEqual((counters["calls"], counters["failures"], counters["retries"]), (3, 2, 2))
+
+    def test_retries_are_bounded(self):
+        self.server.faults = [503, 503, 503, 503]
+        self.assertRaises(recurly.errors.ServiceUnavailableError, recurly.Account.get, ACCOUNT_CODE)
+        self.assertEqual(len(self.server.requests), 1 + conf.RETRY_ATTEMPTS)
+
+    def test_posts_are_not_retried(self):
+        self.server.faults = [502]
+        response = recurly.Account.http_request(recurly.base_uri() + "accounts", "POST")
+        self.assertEqual(response.status, 502)
+        self.assertEqual(len(self.server.requests), 1)
+
+    @patch.object(conf, "RETRY_ATTEMPTS", 0)
+    def test_circuit_breaker(self):
+        self.server.faults = [None, 500, 503, None]
+        for _ in range(4):
+            try:
+                recurly.Account.get(ACCOUNT_CODE)
+            except recurly.errors.ServerError:
+                pass
+        self.assertEqual(self.breaker.state, resilience.OPEN)
+
+        # calls fail fast, without reaching the server
+        self.assertRaises(RecurlyUnavailableError, recurly.Account.get, ACCOUNT_CODE)
+        self.assertEqual(len(self.server.requests), 4)
+
+        # after the cooldown, a failing trial call opens the breaker again
+        self.clock.now += 30
+        self.server.faults = [503]
+        self.assertRaises(recurly.errors.ServiceUnavailableError, recurly.Account.get, ACCOUNT_CODE)
+        self.assertRaises(RecurlyUnavailableError, recurly.Account.get, ACCOUNT_CODE)
+
+        # and a successful one closes it
+        self.clock.now += 30
+        self.assertEqual(recurly.Account.get(ACCOUNT_CODE).email, "verena@test.com")
+        self.assertEqual(self.breaker.state, resilience.CLOSED)
+        self.assertEqual(resilience.get_counters()["opened"], 2)
+        self.assertEqual(resilience.get_counters()["rejected"], 2)
+
+    @patch.object(conf, "RETRY_ATTEMPTS", 0)
+    def test_failed_trial_call_setup(self):
+        self.breaker.state, self.breaker.opened_at = resilience.OPEN, self.clock.now
+        self.clock.now += 30
+
+        # the trial call can't be made, the next call is the trial
+        with self.assertRaises(Exception) as context:
+            recurly.Account.http_request("http://example.com/v2/accounts")
+        self.assertEqual(str(context.exception), "Only a recurly domain may be called")
+        self.assertEqual(self.breaker.state, resilience.HALF_OPEN)
+        self.assertEqual(recurly.Account.get(ACCOUNT_CODE).email, "verena@test.com")
+        self.assertEqual(self.breaker.state, resilience.CLOSED)
+
+    def test_unavailable_error(self):
+        error = RecurlyUnavailableError(retry_at=1030)
+        assert isinstance(error, recurly.errors.ServerError)
+        self.assertEqual(error.symbol, "service_unavailable")
+        self.assertEqual(str(error), "Recurly API calls are failing, circuit breaker open until 1030")
+
+        error = pickle.loads(pickle.dumps(error))  # eg. failures of worker processes
+        self.assertEqual(error.retry_at, 1030)
+        self.assertEqual(error.symbol, "service_unavailable")
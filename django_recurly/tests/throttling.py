@@ -0,0 +1,76 @@
+import recurly
+from django.test import SimpleTestCase
+from mock import patch
+
+from django_recurly import throttling
+from django_recurly.tests.base import FakeClock, FakeResponse
+
+
+class RateLimitThrottleTest(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.throttle = throttling.RateLimitThrottle(reserved_share=0.2, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_unknown_quota(self):
+        self.assertEqual(self.throttle.get_delay(), 0)
+        self.throttle.update(FakeResponse())  # eg. no headers
+        self.assertEqual(self.throttle.get_delay(), 0)
+
+    def test_full_speed_then_paced(self):
+        self.throttle.update(FakeResponse(remaining=90, resets_at=1100))
+        self.assertEqual(self.throttle.get_delay(), 0)  # 70 of the 80 bulk requests left
+
+        self.throttle.update(FakeResponse(remaining=40, resets_at=1100))
+        self.assertEqual(self.throttle.get_delay(), 0)
+        self.assertEqual(self.throttle.get_delay(), 5.0)  # 100s left for the 20 bulk requests left
+        self.assertAlmostEqual(self.throttle.get_delay(), 5.0 + 100 / 19.0)
+
+    def test_reserved_share(self):
+        self.throttle.update(FakeResponse(remaining=20, resets_at=1100))
+        self.assertEqual(self.throttle.wait(), 100)
+        self.assertEqual(self.clock.now, 1100)
+
+        # the quota is back with the new window
+        self.assertEqual(self.throttle.wait(), 0)
+        self.assertEqual(self.throttle.remaining, 100)
+
+    def test_too_many_requests(self):
+        self.throttle.update(FakeResponse(status=429, retry_after=30))
+        self.assertEqual(self.throttle.get_delay(), 30)
+
+
+class ThrottledRequestTest(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.responses = []
+        throttle = throttling.RateLimitThrottle(reserved_share=0.2, clock=self.clock, sleep=self.clock.sleep)
+        patcher = patch.object(throttling, "_throttle", throttle)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def fake_http_request(cls, url, method='GET', body=None, headers=None):
+            return self.responses.pop(0)
+        patcher = patch.object(throttling, "_wrapped_http_request", classmethod(fake_http_request))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self):
+        return throttling._throttled_http_request(recurly.Account, recurly.base_uri() + "accounts")
+
+    def test_interactive_calls_are_not_delayed(self):
+        self.responses = [FakeResponse(remaining=0, resets_at=1100), FakeResponse(status=429, retry_after=10)]
+        self.assertEqual(self.request().status, 200)
+        self.assertEqual(self.request().status, 429)
+        self.assertEqual(self.clock.now, 1000)
+
+    def test_bulk_calls_are_delayed_and_retried(self):
+        self.responses = [FakeResponse(remaining=10, resets_at=1100), FakeResponse(status=429, retry_after=10),
+                          FakeResponse(remaining=99, resets_at=1400)]
+        with throttling.priority(throttling.BULK):
+            self.assertEqual(self.request().status, 200)
+            self.assertEqual(self.request().status, 200)
+        self.assertEqual(self.clock.now, 1110)  # end of the window, then Retry-After
+        self.assertEqual(self.responses, [])
+        self.assertEqual(throttling.get_priority(), throttling.INTERACTIVE)
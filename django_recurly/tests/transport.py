@@ -0,0 +1,70 @@
+from xml.etree import ElementTree
+
+import recurly
+from django.test import SimpleTestCase
+from mock import patch
+
+from django_recurly import resilience, transport
+from django_recurly.fake_recurly import fake_recurly_api
+
+ACCOUNT_CODE = "verena@test.com"  # of the fixtures
+
+
+class PooledTransportTest(SimpleTestCase):
+
+    def setUp(self):
+        fake_api = fake_recurly_api()
+        self.server = fake_api.__enter__()
+        self.addCleanup(fake_api.__exit__, None, None, None)
+
+        self.previous_pool = transport.get_pool()
+        self.pool = transport.install(transport.ConnectionPool(size=2, idle_timeout=30))
+
+        if resilience.get_breaker() is not None:  # not tripped by the failures of other tests
+            patcher = patch.object(resilience, "_breaker", resilience.CircuitBreaker())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if self.previous_pool is None:
+            transport.uninstall()
+        else:
+            transport.install(self.previous_pool)
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            self.assertEqual(recurly.Account.get(ACCOUNT_CODE).email, "verena@test.com")
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.pool.stats, {"opened": 1, "reused": 4})
+
+    def test_responses_are_buffered(self):
+        response = recurly.Account.http_request(self.server.url("accounts/" + ACCOUNT_CODE))
+        self.assertEqual(response.status, 200)
+        assert response.getheader("content-type").startswith("application/xml")
+        content_length = int(recurly.Account.headers_as_dict(response)["content-length"])
+
+        # the connection is already available for other requests
+        recurly.Account.get(ACCOUNT_CODE)
+        self.assertEqual(self.server.connections, 1)
+        body = response.read()
+        self.assertEqual(len(body), content_length)
+        self.assertEqual(recurly.Account.from_element(ElementTree.fromstring(body)).email, "verena@test.com")
+
+    def test_stale_connections_are_replaced(self):
+        self.server.keep_alive = False
+        for _ in range(3):
+            self.assertEqual(recurly.Account.get(ACCOUNT_CODE).email, "verena@test.com")
+        self.assertEqual(self.server.connections, 3)
+
+    def test_expired_connections_are_discarded(self):
+        self.pool.idle_timeout = 0
+        recurly.Account.get(ACCOUNT_CODE)
+        recurly.Account.get(ACCOUNT_CODE)
+        self.assertEqual(self.pool.stats, {"opened": 2, "reused": 0})
+
+    def test_uninstall(self):
+        transport.uninstall()
+        assert transport.get_pool() is None
+        recurly.Account.get(ACCOUNT_CODE)
+        recurly.Account.get(ACCOUNT_CODE)
+        self.assertEqual(self.server.connections, 2)
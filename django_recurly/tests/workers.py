@@ -0,0 +1,145 @@
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+import recurly
+from django.test import SimpleTestCase
+
+from django_recurly.workers import ShardedProcessPool, ShardedWorkerPool, WorkerProcessError, get_shard_index
+
+
+class ShardedWorkerPoolTest(SimpleTestCase):
+
+    def test_shard_index_is_stable(self):
+        self.assertEqual(get_shard_index("verena@test.com", 8), get_shard_index(u"verena@test.com", 8))
+        self.assertEqual(get_shard_index(None, 8), 0)
+        indexes = set(get_shard_index("account-%d" % i, 4) for i in range(100))
+        self.assertEqual(indexes, set(range(4)))
+
+    def test_single_shard_runs_inline(self):
+        with ShardedWorkerPool(shards=1) as pool:
+            job = pool.submit("verena@test.com", threading.current_thread)
+            assert job.done.is_set()
+        self.assertEqual(job.result, threading.current_thread())
+
+    def test_accounts_are_processed_serially(self):
+        account_codes = ["account-%d" % i for i in range(10)]
+        running = {}
+        overlaps = []
+        events = []
+        lock = threading.Lock()
+
+        def _job(account_code, index):
+            with lock:
+                if running.get(account_code):
+                    overlaps.append(account_code)
+                running[account_code] = True
+            time.sleep(0.001)
+            with lock:
+                running[account_code] = False
+                events.append((account_code, index, threading.current_thread().name))
+
+        with ShardedWorkerPool(shards=4) as pool:
+            for index in range(5):
+                for account_code in account_codes:
+                    pool.submit(account_code, _job, account_code, index)
+
+        self.assertEqual(len(events), 50)
+        self.assertEqual(overlaps, [])
+
+        for account_code in account_codes:
+            account_events = [event for event in events if event[0] == account_code]
+            self.assertEqual([event[1] for event in account_events], list(range(5)))  # submission order
+            self.assertEqual(len(set(event[2] for event in account_events)), 1)  # same thread
+        self.assertTrue(len(set(event[2] for event in events)) > 1)
+
+    def test_failures_are_isolated(self):
+        def _job(value):
+            if value == 2:
+                raise ValueError("boom")
+            return value * 10
+
+        with ShardedWorkerPool(shards=3) as pool:
+            jobs = [pool.submit("account-%d" % value, _job, value) for value in range(5)]
+
+        self.assertEqual([job.result for job in jobs], [0, 10, None, 30, 40])
+        self.assertEqual(pool.submitted, 5)
+        self.assertEqual(pool.failed_jobs, [jobs[2]])
+        assert isinstance(jobs[2].exception, ValueError)
+
+    def test_submit_blocks_when_workers_lag(self):
+        unblocked = threading.Event()
+
+        with ShardedWorkerPool(shards=2, queue_size=2) as pool:
+            submitter = threading.Thread(target=lambda: [pool.submit("verena@test.com", unblocked.wait)
+                                                         for _ in range(10)])
+            submitter.start()
+            time.sleep(0.1)
+            self.assertEqual(pool.submitted, 4)  # 1 running, 2 queued, 1 waiting for room
+            unblocked.set()
+            submitter.join()
+
+        self.assertEqual(pool.submitted, 10)
+        self.assertEqual(pool.failed_jobs, [])
+
+
+def _record_job(path, account_code, index):
+    with open(path, "a") as f:
+        f.write("%s %d %d\n" % (account_code, index, os.getpid()))
+
+
+def _failing_job(value):
+    if value == 2:
+        raise ValueError("boom")
+    if value == 3:
+        raise recurly.NotFoundError(b"<error><symbol>not_found</symbol><description>Gone</description></error>")
+
+
+class ShardedProcessPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_accounts_are_processed_by_a_single_process(self):
+        path = os.path.join(self.directory, "events")
+        account_codes = ["account-%d" % i for i in range(10)]
+        with ShardedProcessPool(processes=3) as pool:
+            for index in range(5):
+                for account_code in account_codes:
+                    pool.submit(account_code, _record_job, path, account_code, index)
+
+        with open(path) as f:
+            events = [line.split() for line in f]
+        self.assertEqual(len(events), 50)
+        self.assertEqual(pool.submitted, 50)
+        self.assertEqual(pool.failed_jobs, [])
+
+        for account_code in account_codes:
+            account_events = [event for event in events if event[0] == account_code]
+            self.assertEqual([int(event[1]) for event in account_events], list(range(5)))  # submission order
+            self.assertEqual(len(set(event[2] for event in account_events)), 1)  # same process
+        pids = set(int(event[2]) for event in events)
+        self.assertEqual(len(pids), 3)
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_failures_are_reported(self):
+        progress = []
+        with ShardedProcessPool(processes=2, progress=lambda *args: progress.append(args)) as pool:
+            jobs = [pool.submit("account-%d" % value, _failing_job, value) for value in range(5)]
+
+        self.assertEqual([job.failed for job in jobs], [False, False, True, True, False])
+        self.assertEqual(sorted(pool.failed_jobs, key=jobs.index), [jobs[2], jobs[3]])
+        assert isinstance(jobs[2].exception, ValueError)
+        assert isinstance(jobs[3].exception, WorkerProcessError)
+        self.assertEqual(str(jobs[3].exception), "NotFoundError: not_found: Gone")
+        self.assertEqual(len(progress), 5)
+        self.assertEqual(progress[-1], (5, 5, 2))
+
+    def test_jobs_must_be_picklable(self):
+        with ShardedProcessPool(processes=2) as pool:
+            self.assertRaises((pickle.PicklingError, AttributeError), pool.submit, "account-1", lambda: None)
+        self.assertEqual(pool.submitted, 0)
@@ -0,0 +1,191 @@
+"""
+Pacing of bulk API calls against the rate limit of the Recurly API.
+
+Recurly reports, in the X-RateLimit-* headers of each response, the size of
+the current rate limit window, the requests left in it and when it resets.
+The quota is shared by all processes using the API key, so when bulk jobs
+(eg. "recurlysync --accounts") exhaust it, checkouts fail as well.
+
+Calls are either "interactive" (the default) or "bulk" (see priority() and
+set_default_priority()). Interactive calls are never delayed. Bulk calls are
+paced by a process-wide RateLimitThrottle:
+
+- at full speed while more than half of their share of the window is left;
+- then spread evenly over the remainder of the window;
+- and suspended until the window resets once only the share reserved to
+  interactive calls (RECURLY_THROTTLE_RESERVED_SHARE) is left.
+
+Bulk calls rejected anyway with "429 Too Many Requests" are retried after
+the reset, instead of failing the job midway.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import recurly
+
+from . import conf
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+TOO_MANY_REQUESTS = 429
+
+
+## Priority of calls ##
+
+_local = threading.local()
+_default_priority = INTERACTIVE
+
+
+def set_default_priority(value):
+    """
+    Sets the priority of calls of all threads of this process, eg. BULK in
+    batch commands, and returns the previous one, to be restored afterwards.
+    """
+    global _default_priority
+    assert value in (INTERACTIVE, BULK), value
+    previous, _default_priority = _default_priority, value
+    return previous
+
+
+def get_priority():
+    return getattr(_local, "priority", None) or _default_priority
+
+
+@contextmanager
+def priority(value):
+    """Sets the priority of the API calls made within this block (by this thread)."""
+    assert value in (INTERACTIVE, BULK), value
+    previous = getattr(_local, "priority", None)
+    _local.priority = value
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+## Throttle ##
+
+def _get_int_header(response, name):
+    try:
+        return int(response.getheader(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitThrottle(object):
+
+    def __init__(self, reserved_share=None, clock=time.time, sleep=time.sleep):
+        self.reserved_share = conf.THROTTLE_RESERVED_SHARE if reserved_share is None else reserved_share
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.resets_at = None
+        self._next_call_at = 0
+
+    def update(self, response):
+        """Updates the quota from the headers of an API response."""
+        limit = _get_int_header(response, "x-ratelimit-limit")
+        remaining = _get_int_header(response, "x-ratelimit-remaining")
+        resets_at = _get_int_header(response, "x-ratelimit-reset")
+
+        with self._lock:
+            if limit is not None and remaining is not None and resets_at is not None:
+                self.limit, self.remaining, self.resets_at = limit, remaining, resets_at
+
+            if response.status == TOO_MANY_REQUESTS:
+                self.remaining = 0
+                retry_after = _get_int_header(response, "retry-after")
+                if retry_after is not None:
+                    self.resets_at = self.clock() + retry_after
+                elif self.resets_at is None or self.resets_at <= self.clock():
+                    self.resets_at = self.clock() + 1
+
+    def get_delay(self):
+        """Books the next slot for a bulk call, and returns the seconds to wait for it."""
+        with self._lock:
+            now = self.clock()
+            if self.resets_at is not None and self.resets_at <= now:
+                # new window, whose quota is unknown until the next response
+                self.remaining = self.limit
+                self.resets_at = None
+            if self.resets_at is None:
+                return 0
+
+            limit = self.limit or 0  # unknown after a bare 429 response
+            reserved = int(limit * self.reserved_share)
+            available = self.remaining - reserved
+            if available <= 0:
+                self._next_call_at = max(self._next_call_at, self.resets_at)
+                interval = 0
+            elif available * 2 < limit - reserved:
+                interval = float(self.resets_at - now) / available
+            else:
+                interval = 0
+
+            slot = max(now, self._next_call_at)
+            self._next_call_at = slot + interval
+            self.remaining -= 1  # until the response tells the actual quota
+            return slot - now
+
+    def wait(self):
+        delay = self.get_delay()
+        if delay > 0:
+            logger.debug("Delaying bulk Recurly API call by %.2fs (%s/%s requests left)",
+                         delay, self.remaining, self.limit)
+            self.sleep(delay)
+        return delay
+
+
+_throttle = None
+
+
+def get_throttle():
+    return _throttle
+
+
+## Integration with the recurly client ##
+
+_wrapped_http_request = recurly.Resource.__dict__["http_request"]  # the implementation in place when installed
+
+
+def _throttled_http_request(cls, url, method='GET', body=None, headers=None):
+    throttle = _throttle
+    bulk = get_priority() == BULK
+    attempts = 0
+    while True:
+        if bulk:
+            throttle.wait()
+        response = _wrapped_http_request.__get__(None, cls)(url, method, body, headers)
+        throttle.update(response)
+
+        if (response.status != TOO_MANY_REQUESTS or not bulk
+                or attempts >= conf.THROTTLE_MAX_RETRIES):
+            return response
+        attempts += 1
+        logger.warning("Rate limit of the Recurly API exceeded, retrying %s %s", method, url)
+        response.read()  # the request was rejected, so it can be safely retried
+
+
+def install(throttle=None):
+    """Paces bulk API calls with this throttle (a new RateLimitThrottle by default), and returns it."""
+    global _throttle, _wrapped_http_request
+    if _throttle is None:
+        _wrapped_http_request = recurly.Resource.__dict__["http_request"]
+        recurly.Resource.http_request = classmethod(_throttled_http_request)
+    _throttle = throttle or RateLimitThrottle()
+    return _throttle
+
+
+def uninstall():
+    """Restores the previous implementation (wrappers installed since then must be uninstalled first)."""
+    global _throttle
+    if _throttle is not None:
+        recurly.Resource.http_request = _wrapped_http_request
+        _throttle = None
@@ -0,0 +1,219 @@
+"""
+Pooled, keep-alive HTTP transport for the recurly client.
+
+Out of the box, the recurly client opens a new connection (so, with a full
+TLS handshake) for each API call. Once this transport is installed (see
+RECURLY_HTTP_POOL_SIZE), connections are kept alive and reused, per host, by
+all the threads of the process.
+
+The transport stands in for the http_client module used by recurly.resource,
+so authentication, logging and rate-limit tracking are left to the client.
+Responses are read entirely before their connection goes back to the pool,
+and can be used like the http_client.HTTPResponse they stand for.
+"""
+import io
+import logging
+import socket
+import threading
+import time
+
+import recurly.resource
+from six.moves import http_client
+
+from . import conf
+
+logger = logging.getLogger(__name__)
+
+# errors showing that a kept-alive connection was closed by the server in the meantime
+STALE_CONNECTION_ERRORS = (http_client.BadStatusLine, http_client.CannotSendRequest, socket.error)
+
+# requests which may be sent again if their response was lost with a stale connection
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+
+class BufferedResponse(object):
+    """Fully read HTTPResponse, whose connection may already be reused."""
+
+    def __init__(self, response, body):
+        self.status = response.status
+        self.reason = response.reason
+        self.version = response.version
+        self.msg = response.msg
+        self._body = io.BytesIO(body)
+
+    @property
+    def headers(self):
+        return self.msg
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name, default)
+
+    def getheaders(self):
+        return list(self.msg.items())
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+    def close(self):
+        pass
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe store of idle connections, per (connection class, netloc).
+
+    At most "size" idle connections are kept per host (more may be opened
+    concurrently, they are closed when released), and connections idle for
+    more than "idle_timeout" seconds are discarded.
+    """
+
+    def __init__(self, size=None, idle_timeout=None):
+        self.size = conf.HTTP_POOL_SIZE if size is None else size
+        self.idle_timeout = conf.HTTP_POOL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.stats = {"opened": 0, "reused": 0}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def open(self, key, options):
+        connection_class, netloc = key
+        with self._lock:
+            self.stats["opened"] += 1
+        return connection_class(netloc, **options)
+
+    def acquire(self, key):
+        """Returns an idle connection to this host, or None."""
+        expired = []
+        connection = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            threshold = time.time() - self.idle_timeout
+            while idle:
+                candidate, released_at = idle.pop()  # most recently used first
+                if released_at >= threshold:
+                    connection = candidate
+                    self.stats["reused"] += 1
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        return connection
+
+    def release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+
+
+class PooledConnection(object):
+    """
+    Stand-in for the http_client connections created by the recurly client,
+    for a single request/response exchange.
+    """
+
+    def __init__(self, pool, connection_class, netloc, options):
+        self._pool = pool
+        self._key = (connection_class, netloc)
+        self._options = options
+        self._request = None
+
+    def request(self, method, url, body=None, headers=None):
+        self._request = (method, url, body, headers or {})
+
+    def _exchange(self, connection, reused):
+        method = self._request[0]
+        try:
+            connection.request(*self._request)
+        except socket.timeout:
+            connection.close()
+            raise
+        except STALE_CONNECTION_ERRORS:
+            connection.close()
+            if reused:
+                return None  # nothing was sent, the request can go through another connection
+            raise
+        except Exception:
+            connection.close()
+            raise
+
+        try:
+            response = connection.getresponse()
+            body = response.read()
+        except socket.timeout:
+            connection.close()
+            raise
+        except STALE_CONNECTION_ERRORS:
+            connection.close()
+            if reused and method in IDEMPOTENT_METHODS:
+                return None
+            raise
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._pool.release(self._key, connection)
+        return BufferedResponse(response, body)
+
+    def getresponse(self):
+        connection = self._pool.acquire(self._key)
+        if connection is not None:
+            response = self._exchange(connection, reused=True)
+            if response is not None:
+                return response
+            logger.debug("Stale connection to %s, retrying on a new one", self._key[1])
+
+        return self._exchange(self._pool.open(self._key, self._options), reused=False)
+
+    def close(self):
+        pass
+
+
+class PooledHTTPClient(object):
+    """Replacement for the http_client module of recurly.resource."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def HTTPConnection(self, netloc, **options):
+        return PooledConnection(self.pool, http_client.HTTPConnection, netloc, options)
+
+    def HTTPSConnection(self, netloc, **options):
+        return PooledConnection(self.pool, http_client.HTTPSConnection, netloc, options)
+
+    def __getattr__(self, name):
+        return getattr(http_client, name)
+
+
+def get_pool():
+    """Returns the ConnectionPool used by the recurly client, or None if not installed."""
+    client = recurly.resource.http_client
+    return client.pool if isinstance(client, PooledHTTPClient) else None
+
+
+def install(pool=None):
+    """Makes the recurly client use a (new by default) ConnectionPool, and returns it."""
+    uninstall()
+    pool = pool or ConnectionPool()
+    recurly.resource.http_client = PooledHTTPClient(pool)
+    return pool
+
+
+def uninstall():
+    """Restores one connection per request in the recurly client."""
+    pool = get_pool()
+    if pool is not None:
+        pool.clear()
+    recurly.resource.http_client = http_client
@@ -3,6 +3,7 @@ import urllib.parse
 import random
 import string
 import json
+import math
 import re
 from django.core.serializers.json import DjangoJSONEncoder
 from copy import deepcopy
@@ -173,3 +174,25 @@ def from_camel(content):
     underscored_data = underscorize(data)
 
     return underscored_data
+
+
+def use_api_base_uri(base_uri):
+    '''Point the recurly client to another API server, eg. a local fake
+    Recurly API for tests and load tests. Like recurly.BASE_URI, base_uri may
+    contain a "%s" placeholder for the subdomain.'''
+    if "%s" not in base_uri:
+        base_uri = base_uri.replace("%", "%%") + "%.0s"  # subdomain is ignored
+    recurly.BASE_URI = base_uri
+
+    netloc = urllib.parse.urlparse(base_uri).netloc
+    if not any(netloc.endswith(domain) for domain in recurly.VALID_DOMAINS):
+        recurly.VALID_DOMAINS += (netloc,)
+
+
+def percentile(values, percent):
+    '''Nearest-rank percentile of a sequence of numbers (None if empty).'''
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(percent / 100.0 * len(values))))
+    return values[rank - 1]
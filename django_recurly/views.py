@@ -7,8 +7,9 @@ from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 
 from .decorators import recurly_basic_authentication
+from .exceptions import InvalidNotificationError
 from .utils import safe_redirect, recurly
-from . import models, signals
+from . import models, notifications, signals
 
 import logging
 logger = logging.getLogger(__name__)
@@ -19,17 +20,12 @@ logger = logging.getLogger(__name__)
 @require_POST
 def push_notifications(request):
     xml = request.body
-    objects = recurly.objects_for_push_notification(xml.strip())
 
     try:
-        signal = getattr(signals, objects['type'])
-    except AttributeError:
+        notifications.receive_notification(xml)
+    except InvalidNotificationError:
         return HttpResponseBadRequest("Invalid notification type.")
 
-    logger.debug("Received Recurly push notification (type: '%s', account_code: '%s')",
-        objects['type'], objects['account'].account_code)
-    signals.push_notification.send(sender=recurly, xml=xml, **objects)
-    signal.send(sender=recurly, xml=xml, **objects)
     return HttpResponse(status=204)
 
 
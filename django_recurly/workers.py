@@ -0,0 +1,311 @@
+"""
+Pool of worker threads, sharded by account_code.
+
+Each job is routed to a shard by hashing the account_code it concerns, and
+each shard runs its jobs serially, in submission order. So jobs touching the
+same Account never run concurrently (no duplicate inserts or lost updates in
+modelify's get-then-save), while different accounts are handled in parallel.
+
+With a single shard (the default, see RECURLY_WORKER_SHARDS), jobs are simply
+run in the calling thread. ShardedProcessPool shards jobs the same way over
+worker processes instead, for CPU-bound bulk work (XML parsing, model
+conversions) which threads can't parallelize.
+
+A separate, process-wide thread pool (see get_fetch_executor()) issues
+independent API calls concurrently, without touching the DB.
+"""
+import logging
+import multiprocessing
+import pickle
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection, connections
+from six.moves import queue
+
+from . import conf, transport
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # queue sentinel
+
+
+def get_shard_index(account_code, shards):
+    """
+    Returns the shard in [0, shards) responsible for this account_code.
+
+    The result is stable across processes and runs (unlike hash()).
+    """
+    if account_code is None:
+        return 0
+    if not isinstance(account_code, bytes):
+        account_code = account_code.encode("utf-8")
+    return (zlib.crc32(account_code) & 0xffffffff) % shards
+
+
+class Job(object):
+    """Result holder for a function submitted to a ShardedWorkerPool."""
+
+    def __init__(self, account_code, func, args, kwargs):
+        self.account_code = account_code
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+    @property
+    def failed(self):
+        return self.exception is not None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            logger.exception("Job %r failed for account_code '%s'", self.func, self.account_code)
+            self.exception = e
+        finally:
+            self.done.set()
+
+
+class ShardedWorkerPool(object):
+    """
+    Usage:
+
+        with ShardedWorkerPool() as pool:
+            for account_code in account_codes:
+                pool.submit(account_code, sync_function, account_code=account_code)
+        failed_jobs = pool.failed_jobs
+
+    Exceptions raised by jobs are logged and stored on their Job instance,
+    they don't interrupt the other jobs.
+
+    The pool only keeps the count of submitted jobs and the failed ones, so
+    that bulk syncs don't hold every remote record until join(). Shard queues
+    are bounded: when workers lag behind, submit() blocks.
+    """
+
+    def __init__(self, shards=None, queue_size=100):
+        self.shards = max(1, shards or conf.WORKER_SHARDS)
+        self.queue_size = queue_size
+        self.submitted = 0
+        self.failed_jobs = []
+        self._queues = None
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+
+    def _start(self):
+        self._queues = [queue.Queue(self.queue_size) for _ in range(self.shards)]
+        for index, shard_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(shard_queue,),
+                                      name="recurly-shard-%d" % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self, job):
+        job.run()
+        if job.failed:
+            self.failed_jobs.append(job)
+
+    def _work(self, shard_queue):
+        try:
+            while True:
+                job = shard_queue.get()
+                if job is _STOP:
+                    break
+                self._run(job)
+        finally:
+            connection.close()  # each thread has its own DB connection
+
+    def submit(self, account_code, func, *args, **kwargs):
+        """Schedules func(*args, **kwargs) on the shard of account_code, and returns its Job."""
+        job = Job(account_code, func, args, kwargs)
+        self.submitted += 1
+
+        if self.shards == 1:
+            self._run(job)
+            return job
+
+        if self._queues is None:
+            self._start()
+        self._queues[get_shard_index(account_code, self.shards)].put(job)
+        return job
+
+    def join(self):
+        """Waits until all submitted jobs are done, stops the worker threads, and returns the failed jobs."""
+        if self._queues is not None:
+            for shard_queue in self._queues:
+                shard_queue.put(_STOP)
+            for thread in self._threads:
+                thread.join()
+            self._queues = None
+            self._threads = []
+        return self.failed_jobs
+
+
+class WorkerProcessError(Exception):
+    """Failure of a job in a worker process, whose exception couldn't be sent back as is."""
+
+
+def _get_transferable_exception(exception):
+    try:
+        return pickle.loads(pickle.dumps(exception))
+    except Exception:  # eg. recurly errors, which can't be rebuilt from their args
+        return WorkerProcessError("%s: %s" % (type(exception).__name__, exception))
+
+
+def _work_in_process(shard_queue, result_queue):
+    global _fetch_executor
+    _fetch_executor = None  # its threads don't survive the fork
+    try:
+        while True:
+            payload = shard_queue.get()
+            if payload is None:
+                break
+            index, account_code, func, args, kwargs = pickle.loads(payload)
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.exception("Job %r failed for account_code '%s'", func, account_code)
+                result_queue.put((index, _get_transferable_exception(e)))
+            else:
+                result_queue.put((index, None))
+    finally:
+        connections.close_all()
+
+
+class ShardedProcessPool(object):
+    """
+    Usage:
+
+        with ShardedProcessPool(processes=4, progress=print_progress) as pool:
+            for recurly_account in recurly.Account.all():
+                pool.submit(recurly_account.account_code, sync_function, recurly_account=recurly_account)
+        failed_jobs = pool.failed_jobs
+
+    Like ShardedWorkerPool, but jobs run in forked worker processes, each
+    with its own DB connection and HTTP connection pool. Jobs (functions and
+    arguments) must be picklable; only their failures are sent back, so the
+    result of Job instances is always None.
+
+    Shard queues are bounded: when workers lag behind, submit() blocks, so
+    that remote records are listed only as fast as they're processed.
+    progress(done, submitted, failed) is called each time jobs complete.
+
+    Starting the workers closes the DB connections of this process, so call
+    start() before iterating over a queryset to submit jobs.
+    """
+
+    def __init__(self, processes, progress=None, queue_size=100):
+        self.processes = max(1, processes)
+        self.progress = progress
+        self.queue_size = queue_size
+        self.submitted = 0
+        self.failed_jobs = []
+        self._pending = {}
+        self._queues = None
+        self._results = None
+        self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+
+    def start(self):
+        """Forks the worker processes, unless already done (else the first submit() does it)."""
+        if self._queues is not None:
+            return
+
+        # the children mustn't share the sockets of this process
+        connections.close_all()
+        pool = transport.get_pool()
+        if pool is not None:
+            pool.clear()
+
+        context = multiprocessing.get_context("fork")  # workers inherit the configured Django
+        self._results = context.Queue()
+        self._queues = [context.Queue(self.queue_size) for _ in range(self.processes)]
+        for index, shard_queue in enumerate(self._queues):
+            process = context.Process(target=_work_in_process, args=(shard_queue, self._results),
+                                      name="recurly-shard-%d" % index)
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+    def _collect(self, timeout):
+        """Records the outcome of a completed job, returns False if none came within timeout (0: don't wait)."""
+        try:
+            index, exception = self._results.get(timeout=timeout) if timeout else self._results.get_nowait()
+        except queue.Empty:
+            return False
+        self._complete(self._pending.pop(index), exception)
+        return True
+
+    def _complete(self, job, exception):
+        job.exception = exception
+        if exception is not None:
+            self.failed_jobs.append(job)
+        job.done.set()
+        if self.progress is not None:
+            self.progress(self.submitted - len(self._pending), self.submitted, len(self.failed_jobs))
+
+    def submit(self, account_code, func, *args, **kwargs):
+        """Schedules func(*args, **kwargs) on the process of the shard of account_code, and returns its Job."""
+        payload = pickle.dumps((self.submitted, account_code, func, args, kwargs))  # raises here if not picklable
+        job = Job(account_code, func, (), {})
+        self._pending[self.submitted] = job
+        self.submitted += 1
+
+        self.start()
+        self._queues[get_shard_index(account_code, self.processes)].put(payload)
+        while self._collect(timeout=0):
+            pass
+        return job
+
+    def join(self):
+        """Waits until all submitted jobs are done, stops the worker processes, and returns the failed jobs."""
+        if self._queues is not None:
+            for shard_queue in self._queues:
+                shard_queue.put(None)
+            while self._pending:
+                if not self._collect(timeout=1) and not any(process.is_alive() for process in self._processes):
+                    break
+            for index in sorted(self._pending):
+                self._complete(self._pending.pop(index), WorkerProcessError("Worker process died"))
+            for process in self._processes:
+                process.join()
+            self._queues = None
+            self._results = None
+            self._processes = []
+        return self.failed_jobs
+
+
+_fetch_executor = None
+_fetch_executor_lock = threading.Lock()
+
+
+def get_fetch_executor():
+    """
+    Returns the ThreadPoolExecutor shared by the whole process to issue API
+    calls concurrently, or None if RECURLY_REMOTE_FETCH_WORKERS is 0.
+
+    Its size bounds the number of concurrent API calls, whatever the number
+    of threads submitting them.
+    """
+    global _fetch_executor
+    if not conf.REMOTE_FETCH_WORKERS:
+        return None
+    with _fetch_executor_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(max_workers=conf.REMOTE_FETCH_WORKERS)
+        return _fetch_executor